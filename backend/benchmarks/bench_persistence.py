@@ -0,0 +1,110 @@
+# compare the recursive node-by-node insert with the bulk insert of a story tree
+#
+#   python -m benchmarks.bench_persistence --depth 4 --width 3
+#   python -m benchmarks.bench_persistence --postgres-url postgresql+asyncpg://...
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+
+from core.models import StoryLLMResponse
+from core.story_generator import StoryGenerator
+from db.database import Base
+from models.story import Story
+
+
+# full tree of the given depth, every non-ending node has width options
+def build_story(depth: int, width: int) -> StoryLLMResponse:
+    def node(level: int) -> dict:
+        if level == depth:
+            return {"content": "The end", "isEnding": True, "isWinningEnding": True}
+        return {
+            "content": f"Level {level} situation",
+            "isEnding": False,
+            "isWinningEnding": False,
+            "options": [
+                {"text": f"Option {i}", "nextNode": node(level + 1)}
+                for i in range(width)
+            ],
+        }
+
+    return StoryLLMResponse.model_validate(
+        {"title": "Benchmark story", "rootNode": node(1)}
+    )
+
+
+async def persist_recursive(db: AsyncSession, story_structure: StoryLLMResponse):
+    story_db = Story(title=story_structure.title, session_id="bench")
+    db.add(story_db)
+    await db.flush()
+    await StoryGenerator._aprocess_story_node(
+        db, story_db.id, StoryGenerator._root_node(story_structure), is_root=True
+    )
+
+
+async def persist_bulk(db: AsyncSession, story_structure: StoryLLMResponse):
+    await StoryGenerator._apersist_story(db, "bench", story_structure)
+
+
+async def run(url: str, story_structure: StoryLLMResponse, iterations: int):
+    engine = create_async_engine(url)
+    # count statements sent to the database per story
+    statements = []
+    event.listen(
+        engine.sync_engine,
+        "before_cursor_execute",
+        lambda *args, **kwargs: statements.append(1),
+    )
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    session_factory = async_sessionmaker(engine, expire_on_commit=False)
+
+    results = {}
+    for name, persist in (("recursive", persist_recursive), ("bulk", persist_bulk)):
+        timings = []
+        statements.clear()
+        for _ in range(iterations):
+            async with session_factory() as db:
+                start = time.perf_counter()
+                await persist(db, story_structure)
+                await db.commit()
+                timings.append((time.perf_counter() - start) * 1000)
+        results[name] = {
+            "median_ms": statistics.median(timings),
+            "statements_per_story": len(statements) / iterations,
+        }
+    await engine.dispose()
+    return results
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark story tree persistence")
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--width", type=int, default=3)
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--postgres-url", default=os.getenv("BENCH_POSTGRES_URL"))
+    args = parser.parse_args()
+
+    story_structure = build_story(args.depth, args.width)
+    with tempfile.TemporaryDirectory() as tmp:
+        targets = {"sqlite": f"sqlite+aiosqlite:///{tmp}/bench.db"}
+        if args.postgres_url:
+            targets["postgres"] = args.postgres_url
+
+        for target, url in targets.items():
+            results = await run(url, story_structure, args.iterations)
+            for name, result in results.items():
+                print(
+                    f"{target:9} {name:10} "
+                    f"{result['median_ms']:8.2f} ms  "
+                    f"{result['statements_per_story']:5.1f} statements/story"
+                )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
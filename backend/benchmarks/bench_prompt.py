@@ -0,0 +1,72 @@
+# prompt size and setup cost of the story prompt for each format instruction style
+#
+#   python -m benchmarks.bench_prompt
+#
+# token counts use tiktoken when its encoding is available, otherwise ~4 characters per token
+import argparse
+import os
+import time
+
+os.environ.setdefault("OPENAI_API_KEY", "fake")
+
+from core.config import settings  # noqa: E402
+from core.story_generator import StoryGenerator  # noqa: E402
+
+
+def token_counter(model: str):
+    try:
+        import tiktoken
+
+        encoding = tiktoken.encoding_for_model(model)
+    # not installed, unknown model, or the encoding can't be downloaded
+    except Exception:
+        return lambda text: len(text) // 4, "estimated"
+    return lambda text: len(encoding.encode(text)), "tiktoken"
+
+
+def prompt_text(theme: str) -> str:
+    messages, _ = StoryGenerator._build_prompt(theme)
+    return "\n".join(message.content for message in messages.to_messages())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the story prompt")
+    parser.add_argument("--theme", default="haunted lighthouse")
+    parser.add_argument("--iterations", type=int, default=1000)
+    args = parser.parse_args()
+
+    count_tokens, method = token_counter(settings.LLM_MODEL)
+    sizes = {}
+    for prompt_format in ("schema", "compact"):
+        settings.LLM_PROMPT_FORMAT = prompt_format
+        text = prompt_text(args.theme)
+        sizes[prompt_format] = count_tokens(text)
+
+        # first call builds the template and parser, later calls reuse them
+        start = time.perf_counter()
+        for i in range(args.iterations):
+            StoryGenerator._build_prompt(f"{args.theme} {i}")
+        cached_us = (time.perf_counter() - start) / args.iterations * 1e6
+
+        # what every call paid before the template and parser were kept
+        start = time.perf_counter()
+        for i in range(args.iterations):
+            StoryGenerator._prompts.clear()
+            StoryGenerator._story_parser = None
+            StoryGenerator._build_prompt(f"{args.theme} {i}")
+        rebuilt_us = (time.perf_counter() - start) / args.iterations * 1e6
+
+        print(
+            f"{prompt_format:8} {len(text):6d} chars  {sizes[prompt_format]:5d} tokens "
+            f"({method})  {cached_us:7.1f} us/prompt cached, "
+            f"{rebuilt_us:7.1f} us rebuilt"
+        )
+
+    saved = sizes["schema"] - sizes["compact"]
+    print(
+        f"compact saves {saved} input tokens per call ({saved / sizes['schema']:.0%})"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+# cold start cost of the API and the worker, each import timed in a fresh interpreter
+#
+#   python -m benchmarks.bench_startup
+#   python -m benchmarks.bench_startup --runs 10 --budget-ms 1500
+#
+# exits with 1 when the median import of main is over the budget or the API loads
+# the LLM stack, so it can run as a CI check
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+# only processes that generate stories should pay for these
+LLM_MODULES = ("langchain_openai", "langchain_core", "openai", "tiktoken")
+
+# run in the child: import the module and report how long it took and what it loaded
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+print(json.dumps({{
+    "seconds": time.perf_counter() - start,
+    "llm_modules": [name for name in {llm_modules!r} if name in sys.modules],
+}}))
+"""
+
+
+# one cold import, returns the probe's report and the slowest modules by -X importtime
+def import_once(module: str, env: dict) -> dict:
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-c",
+            PROBE.format(module=module, llm_modules=LLM_MODULES),
+        ],
+        capture_output=True,
+        text=True,
+        env=env,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"importing {module} failed:\n{result.stderr[-2000:]}")
+    report = json.loads(result.stdout.strip().splitlines()[-1])
+    report["slowest"] = slowest_modules(result.stderr)
+    return report
+
+
+# top level packages by cumulative import time, from the -X importtime table
+def slowest_modules(importtime: str, count: int = 8) -> list:
+    packages = {}
+    for line in importtime.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        package = name.strip().split(".")[0]
+        packages[package] = max(packages.get(package, 0), int(cumulative))
+    ranked = sorted(packages.items(), key=lambda item: item[1], reverse=True)
+    return [(name, us / 1000) for name, us in ranked[:count]]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark cold start import time")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument(
+        "--budget-ms", type=float, default=1500.0, help="median import time of main"
+    )
+    parser.add_argument(
+        "--modules", nargs="+", default=["main", "core.worker"], help="modules to time"
+    )
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    # the API must start without an OpenAI key, so none is set here
+    env.pop("OPENAI_API_KEY", None)
+    env.setdefault(
+        "DATABASE_URL", f"sqlite:///{tempfile.mkdtemp(prefix='startup-')}/startup.db"
+    )
+
+    failures = []
+    for module in args.modules:
+        reports = [import_once(module, env) for _ in range(args.runs)]
+        median_ms = statistics.median(report["seconds"] for report in reports) * 1000
+        llm_modules = reports[-1]["llm_modules"]
+        print(
+            f"{module:12} median {median_ms:7.1f} ms over {args.runs} runs, "
+            f"LLM modules loaded: {', '.join(llm_modules) or 'none'}"
+        )
+        for name, ms in reports[-1]["slowest"]:
+            print(f"    {name:24} {ms:7.1f} ms")
+
+        if module == "main":
+            if median_ms > args.budget_ms:
+                failures.append(
+                    f"main imports in {median_ms:.0f} ms, over the "
+                    f"{args.budget_ms:.0f} ms budget"
+                )
+            if llm_modules:
+                failures.append(f"main loads the LLM stack: {', '.join(llm_modules)}")
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+# stand-in for ChatOpenAI so load tests measure this service, not the provider
+import asyncio
+import json
+import random
+import time
+from typing import Dict
+
+from langchain_core.messages import AIMessage, AIMessageChunk
+
+from core.llm_router import LLMProvider, llm_router
+
+
+# a connection error, so LLMCallPolicy retries it like a provider outage
+class FakeLLMError(ConnectionError):
+    pass
+
+
+class FakeLLM:
+    def __init__(
+        self,
+        latency: float = 1.0,
+        jitter: float = 0.2,
+        failure_rate: float = 0.0,
+        depth: int = 4,
+        width: int = 2,
+        chunk_size: int = 64,
+        seed: int = 0,
+        tokens_per_second: float = 0.0,
+    ):
+        # seconds per call, uniformly spread by +/- jitter
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.chunk_size = chunk_size
+        # output speed, when set longer answers take longer like a real model
+        self.tokens_per_second = tokens_per_second
+        self.depth = depth
+        self.width = width
+        self.random = random.Random(seed)
+        self.story = json.dumps(self.build_story(depth, width))
+        self.calls = 0
+
+    # full tree of the given depth, every non-ending node has width options
+    @classmethod
+    def build_story(cls, depth: int, width: int) -> dict:
+        return {"title": "Benchmark story", "rootNode": cls.build_node(1, depth, width)}
+
+    @classmethod
+    def build_node(cls, level: int, depth: int, width: int) -> dict:
+        if level == depth:
+            return {"content": "The end", "isEnding": True, "isWinningEnding": True}
+        return {
+            "content": f"Level {level} situation",
+            "isEnding": False,
+            "isWinningEnding": False,
+            "options": [
+                {
+                    "text": f"Option {i}",
+                    "nextNode": cls.build_node(level + 1, depth, width),
+                }
+                for i in range(width)
+            ],
+        }
+
+    # fan-out prompts get an outline or a single branch, anything else the whole story
+    def _answer(self, messages) -> str:
+        prompt = str(messages)
+        if "Start a branching story" in prompt:
+            outline = self.build_story(2, self.width)
+            for option in outline["rootNode"]["options"]:
+                option["nextNode"] = {
+                    "content": "Level 2 situation",
+                    "isEnding": False,
+                    "isWinningEnding": False,
+                }
+            return json.dumps(outline)
+        if "continuing one branch" in prompt:
+            return json.dumps(self.build_node(2, self.depth, self.width))
+        return self.story
+
+    def _delay(self, answer: str) -> float:
+        delay = self.latency + self.random.uniform(-self.jitter, self.jitter)
+        if self.tokens_per_second:
+            delay += len(answer) / 4 / self.tokens_per_second
+        return max(delay, 0.0)
+
+    def _maybe_fail(self):
+        if self.random.random() < self.failure_rate:
+            raise FakeLLMError("fake LLM failure")
+
+    def _usage(self, messages, answer: str) -> dict:
+        # roughly four characters per token, good enough for relative numbers
+        input_tokens = len(str(messages)) // 4
+        output_tokens = len(answer) // 4
+        return {
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "total_tokens": input_tokens + output_tokens,
+        }
+
+    def invoke(self, messages, **kwargs) -> AIMessage:
+        self.calls += 1
+        answer = self._answer(messages)
+        time.sleep(self._delay(answer))
+        self._maybe_fail()
+        return AIMessage(content=answer, usage_metadata=self._usage(messages, answer))
+
+    async def ainvoke(self, messages, **kwargs) -> AIMessage:
+        self.calls += 1
+        answer = self._answer(messages)
+        await asyncio.sleep(self._delay(answer))
+        self._maybe_fail()
+        return AIMessage(content=answer, usage_metadata=self._usage(messages, answer))
+
+    # the delay is spread evenly over the chunks, like tokens arriving over time
+    async def astream(self, messages, **kwargs):
+        self.calls += 1
+        answer = self._answer(messages)
+        chunks = [
+            answer[i : i + self.chunk_size]
+            for i in range(0, len(answer), self.chunk_size)
+        ]
+        pause = self._delay(answer) / len(chunks)
+        for i, text in enumerate(chunks):
+            await asyncio.sleep(pause)
+            if i == len(chunks) // 2:
+                self._maybe_fail()
+            yield AIMessageChunk(content=text)
+        yield AIMessageChunk(content="", usage_metadata=self._usage(messages, answer))
+
+
+# route every LLM call to the fake instead of ChatOpenAI
+def install(fake: FakeLLM) -> FakeLLM:
+    llm_router.configure([LLMProvider("fake", "fake", client=fake)])
+    return fake
+
+
+# one router provider per fake, e.g. a healthy upstream next to a degraded one
+def install_providers(fakes: Dict[str, FakeLLM]) -> Dict[str, FakeLLM]:
+    llm_router.configure(
+        [LLMProvider(name, name, client=fake) for name, fake in fakes.items()]
+    )
+    return fakes
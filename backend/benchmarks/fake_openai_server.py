@@ -0,0 +1,122 @@
+# an OpenAI-compatible chat completions server answered by FakeLLM, a local provider
+# that goes through the real client and HTTP like any other upstream
+#
+#   python -m benchmarks.fake_openai_server --port 8100 --latency 0.5
+#   LLM_PROVIDERS='[{"name": "local", "model": "fake", "base_url": "http://localhost:8100/v1", "api_key": "local"}]'
+import argparse
+import asyncio
+import json
+import time
+import uuid
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from benchmarks.fake_llm import FakeLLM
+
+
+def create_app(fake: FakeLLM) -> FastAPI:
+    app = FastAPI(title="Fake OpenAI")
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        fake.calls += 1
+        answer = fake._answer(body.get("messages", []))
+        usage = fake._usage(body.get("messages", []), answer)
+        usage = {
+            "prompt_tokens": usage["input_tokens"],
+            "completion_tokens": usage["output_tokens"],
+            "total_tokens": usage["total_tokens"],
+        }
+        # a 503 is retried by LLMCallPolicy and failed over by LLMRouter
+        if fake.random.random() < fake.failure_rate:
+            await asyncio.sleep(fake._delay(answer) / 2)
+            return JSONResponse(
+                {"error": {"message": "fake upstream failure", "type": "server_error"}},
+                status_code=503,
+            )
+
+        completion = {
+            "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+            "created": int(time.time()),
+            "model": body.get("model", "fake"),
+        }
+        if not body.get("stream"):
+            await asyncio.sleep(fake._delay(answer))
+            return {
+                **completion,
+                "object": "chat.completion",
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": answer},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": usage,
+            }
+
+        include_usage = (body.get("stream_options") or {}).get("include_usage")
+
+        # server-sent events, the delay spread over the chunks like FakeLLM.astream
+        async def events():
+            chunks = [
+                answer[i : i + fake.chunk_size]
+                for i in range(0, len(answer), fake.chunk_size)
+            ]
+            pause = fake._delay(answer) / len(chunks)
+            for text in chunks:
+                await asyncio.sleep(pause)
+                yield _event(completion, [_delta({"content": text})])
+            yield _event(completion, [_delta({}, finish_reason="stop")])
+            if include_usage:
+                yield _event(completion, [], usage=usage)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    return app
+
+
+def _delta(delta: dict, finish_reason=None) -> dict:
+    return {"index": 0, "delta": delta, "finish_reason": finish_reason}
+
+
+def _event(completion: dict, choices: list, **extra) -> str:
+    chunk = {
+        **completion,
+        "object": "chat.completion.chunk",
+        "choices": choices,
+        **extra,
+    }
+    return f"data: {json.dumps(chunk)}\n\n"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve FakeLLM as an OpenAI API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--latency", type=float, default=1.0, help="seconds per call")
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--depth", type=int, default=4, help="levels in the story tree")
+    parser.add_argument("--width", type=int, default=2, help="options per node")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    import uvicorn
+
+    fake = FakeLLM(
+        latency=args.latency,
+        jitter=args.jitter,
+        failure_rate=args.failure_rate,
+        depth=args.depth,
+        width=args.width,
+        seed=args.seed,
+    )
+    uvicorn.run(create_app(fake), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,259 @@
+# drive the API and a worker in one process against a fake LLM and report throughput
+#
+#   python -m benchmarks.load_test --stories 200 --concurrency 50 --output report.json
+#   python -m benchmarks.load_test --latency 2 --jitter 0.5 --failure-rate 0.05 --stream
+#   python -m benchmarks.load_test --degraded-provider 5 --degraded-failure-rate 0.3
+#
+# the database defaults to a fresh sqlite file, set DATABASE_URL to test postgres
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+from collections import defaultdict
+from typing import Dict, List
+
+# settings are read at import time, so the database has to be chosen first
+_tmp_dir = tempfile.mkdtemp(prefix="loadtest-")
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{_tmp_dir}/loadtest.db")
+os.environ.setdefault("OPENAI_API_KEY", "fake")
+
+import httpx  # noqa: E402
+from sqlalchemy import event  # noqa: E402
+
+from benchmarks.fake_llm import FakeLLM, install, install_providers  # noqa: E402
+from core.config import settings  # noqa: E402
+from core.llm_router import llm_router  # noqa: E402
+from core.worker import Worker  # noqa: E402
+from db.database import async_engine, create_tables, engine  # noqa: E402
+from main import app  # noqa: E402
+
+TERMINAL_STATUSES = ("completed", "failed")
+
+
+# nearest-rank percentile, fine for the sample sizes used here
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(int(round(pct / 100 * len(ordered))) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def summarize(values: List[float]) -> dict:
+    return {
+        "count": len(values),
+        "p50_ms": percentile(values, 50) * 1000,
+        "p95_ms": percentile(values, 95) * 1000,
+        "p99_ms": percentile(values, 99) * 1000,
+        "max_ms": max(values, default=0.0) * 1000,
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+class LoadTest:
+    def __init__(self, stories: int, concurrency: int, poll_interval: float):
+        self.stories = stories
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        # endpoint -> request latencies in seconds
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.end_to_end: List[float] = []
+        self.outcomes: Dict[str, int] = defaultdict(int)
+        self.queries = 0
+
+    def _count_query(self, *args, **kwargs):
+        self.queries += 1
+
+    async def _request(self, client, name: str, method: str, url: str, **kwargs):
+        start = time.perf_counter()
+        response = await client.request(method, url, **kwargs)
+        self.latencies[name].append(time.perf_counter() - start)
+        return response
+
+    # one player: create a story, poll the job, fetch the finished story
+    async def _play(self, theme: str):
+        transport = httpx.ASGITransport(app=app)
+        # a client per story gets its own session cookie, like separate players
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://loadtest"
+        ) as client:
+            start = time.perf_counter()
+            response = await self._request(
+                client,
+                "create",
+                "POST",
+                f"{settings.API_PREFIX}/stories/create",
+                json={"theme": theme},
+            )
+            if response.status_code != 200:
+                self.outcomes[f"create_{response.status_code}"] += 1
+                return
+            job = response.json()
+
+            while job["status"] not in TERMINAL_STATUSES:
+                await asyncio.sleep(self.poll_interval)
+                response = await self._request(
+                    client,
+                    "job_status",
+                    "GET",
+                    f"{settings.API_PREFIX}/jobs/{job['job_id']}",
+                )
+                job = response.json()
+            if job["status"] == "failed":
+                self.outcomes["failed"] += 1
+                return
+
+            response = await self._request(
+                client,
+                "complete",
+                "GET",
+                f"{settings.API_PREFIX}/stories/{job['story_id']}/complete",
+            )
+            if response.status_code != 200:
+                self.outcomes[f"complete_{response.status_code}"] += 1
+                return
+            self.end_to_end.append(time.perf_counter() - start)
+            self.outcomes["completed"] += 1
+
+    async def run(self, worker: Worker, themes: List[str]) -> dict:
+        for target in (engine, async_engine.sync_engine):
+            event.listen(target, "before_cursor_execute", self._count_query)
+
+        worker_task = asyncio.create_task(worker.arun())
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def bounded(i: int):
+            async with semaphore:
+                await self._play(themes[i % len(themes)])
+
+        start = time.perf_counter()
+        await asyncio.gather(*(bounded(i) for i in range(self.stories)))
+        elapsed = time.perf_counter() - start
+
+        worker.stop()
+        await worker_task
+        completed = self.outcomes["completed"]
+        return {
+            "elapsed_s": elapsed,
+            "throughput_stories_per_s": completed / elapsed if elapsed else 0.0,
+            "outcomes": dict(self.outcomes),
+            "end_to_end": summarize(self.end_to_end),
+            "requests": {
+                name: summarize(values) for name, values in self.latencies.items()
+            },
+            "db_queries": {
+                "total": self.queries,
+                "per_story": self.queries / completed if completed else None,
+            },
+        }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Load test story generation")
+    parser.add_argument("--stories", type=int, default=100)
+    parser.add_argument("--concurrency", type=int, default=20, help="players at once")
+    parser.add_argument("--worker-concurrency", type=int, default=None)
+    parser.add_argument("--poll-interval", type=float, default=0.2)
+    parser.add_argument("--latency", type=float, default=1.0, help="fake LLM seconds")
+    parser.add_argument("--jitter", type=float, default=0.2)
+    parser.add_argument("--failure-rate", type=float, default=0.0)
+    parser.add_argument("--depth", type=int, default=4, help="levels in the story tree")
+    parser.add_argument("--width", type=int, default=2, help="options per node")
+    parser.add_argument(
+        "--tokens-per-second",
+        type=float,
+        default=0.0,
+        help="fake LLM output speed, 0 for a fixed latency per call",
+    )
+    parser.add_argument("--stream", action="store_true", help="stream the fake LLM")
+    parser.add_argument(
+        "--fanout", action="store_true", help="generate branches concurrently"
+    )
+    parser.add_argument(
+        "--themes", type=int, default=0, help="distinct themes, 0 for one per story"
+    )
+    parser.add_argument(
+        "--degraded-provider",
+        type=float,
+        default=0.0,
+        help="add a second provider this many times slower, 0 for a single provider",
+    )
+    parser.add_argument("--degraded-failure-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="loadtest-report.json")
+    args = parser.parse_args()
+
+    # the same schema step as python manage.py migrate, on the fresh database
+    create_tables()
+    settings.STORY_STREAMING_ENABLED = args.stream
+    settings.STORY_FANOUT_ENABLED = args.fanout
+    fake_options = dict(
+        jitter=args.jitter,
+        depth=args.depth,
+        width=args.width,
+        seed=args.seed,
+        tokens_per_second=args.tokens_per_second,
+    )
+    fakes = {
+        "fake": FakeLLM(
+            latency=args.latency, failure_rate=args.failure_rate, **fake_options
+        )
+    }
+    if args.degraded_provider:
+        # the router should keep latency close to the healthy provider's
+        fakes["degraded"] = FakeLLM(
+            latency=args.latency * args.degraded_provider,
+            failure_rate=args.degraded_failure_rate,
+            **fake_options,
+        )
+        install_providers(fakes)
+    else:
+        install(fakes["fake"])
+    theme_count = args.themes or args.stories
+    themes = [f"benchmark theme {i}" for i in range(theme_count)]
+
+    worker = Worker(concurrency=args.worker_concurrency, poll_interval=0.05)
+    results = await LoadTest(args.stories, args.concurrency, args.poll_interval).run(
+        worker, themes
+    )
+    results["llm_calls"] = sum(fake.calls for fake in fakes.values())
+    results["llm_calls_by_provider"] = {
+        name: fake.calls for name, fake in fakes.items()
+    }
+    results["providers"] = llm_router.stats()
+
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "database": async_engine.dialect.name,
+        "config": vars(args),
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(
+        f"{results['outcomes'].get('completed', 0)}/{args.stories} stories in "
+        f"{results['elapsed_s']:.1f}s, {results['throughput_stories_per_s']:.2f}/s, "
+        f"p95 {results['end_to_end']['p95_ms']:.0f} ms, "
+        f"{results['db_queries']['total']} queries -> {args.output}"
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
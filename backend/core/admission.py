@@ -0,0 +1,151 @@
+# admission control for story creation: global queue cap and per-session token buckets
+import math
+import time
+from collections import OrderedDict
+from datetime import timedelta
+from typing import Optional, Tuple
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.config import settings
+from core.job_queue import utcnow
+from models.job import StoryJob
+
+ACTIVE_STATUSES = ("pending", "processing")
+# sessions whose buckets are remembered, least recently seen are dropped first
+MAX_TRACKED_SESSIONS = 100_000
+
+
+# raised when a create request should get 429 Too Many Requests
+class AdmissionRejected(Exception):
+    def __init__(self, detail: str, retry_after: int):
+        super().__init__(detail)
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, capacity: float, refill_per_second: float):
+        self.capacity = capacity
+        self.refill_per_second = refill_per_second
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    # take count tokens, or return the seconds until that many are available
+    def take(self, count: int = 1) -> Optional[float]:
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.refill_per_second
+        )
+        self.updated = now
+        if self.tokens >= count:
+            self.tokens -= count
+            return None
+        return (count - self.tokens) / self.refill_per_second
+
+
+class AdmissionController:
+    def __init__(self):
+        # per API process, so the effective limit is this times the replica count
+        self._buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        # (active jobs, finished per second, measured at)
+        self._queue_state: Optional[Tuple[int, float, float]] = None
+
+    # raise AdmissionRejected when the jobs should not be queued; every job takes a
+    # token from the session's bucket, batch jobs are also capped per session
+    async def admit(
+        self, db: AsyncSession, session_id: str, jobs: int = 1, batch: bool = False
+    ) -> None:
+        if settings.ADMISSION_MAX_ACTIVE_JOBS > 0:
+            active, drain_rate = await self._queue_load(db)
+            if active + jobs > settings.ADMISSION_MAX_ACTIVE_JOBS:
+                excess = active + jobs - settings.ADMISSION_MAX_ACTIVE_JOBS
+                raise AdmissionRejected(
+                    "Too many stories are being generated, try again later",
+                    self._retry_after(excess / drain_rate if drain_rate else None),
+                )
+
+        if batch and settings.SESSION_MAX_ACTIVE_BATCH_JOBS > 0:
+            outstanding = await db.scalar(
+                select(func.count())
+                .select_from(StoryJob)
+                .where(
+                    StoryJob.session_id == session_id,
+                    StoryJob.batch_id.is_not(None),
+                    StoryJob.status.in_(ACTIVE_STATUSES),
+                )
+            )
+            if outstanding + jobs > settings.SESSION_MAX_ACTIVE_BATCH_JOBS:
+                _, drain_rate = await self._queue_load(db)
+                excess = outstanding + jobs - settings.SESSION_MAX_ACTIVE_BATCH_JOBS
+                raise AdmissionRejected(
+                    "Too many batch stories are still being generated for this session",
+                    self._retry_after(excess / drain_rate if drain_rate else None),
+                )
+
+        if settings.SESSION_RATE_LIMIT_PER_MINUTE > 0:
+            wait = self._bucket(session_id).take(jobs)
+            if wait is not None:
+                raise AdmissionRejected(
+                    "Too many stories requested, slow down", self._retry_after(wait)
+                )
+
+        # later requests within the stats TTL see these jobs before the next count
+        if self._queue_state is not None:
+            active, drain_rate, measured_at = self._queue_state
+            self._queue_state = (active + jobs, drain_rate, measured_at)
+
+    def _bucket(self, session_id: str) -> TokenBucket:
+        bucket = self._buckets.get(session_id)
+        if bucket is None:
+            bucket = TokenBucket(
+                settings.SESSION_RATE_LIMIT_BURST,
+                settings.SESSION_RATE_LIMIT_PER_MINUTE / 60,
+            )
+            self._buckets[session_id] = bucket
+            if len(self._buckets) > MAX_TRACKED_SESSIONS:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(session_id)
+        return bucket
+
+    # active job count and drain rate, re-read at most once per ADMISSION_STATS_TTL_SECONDS
+    async def _queue_load(self, db: AsyncSession) -> Tuple[int, float]:
+        now = time.monotonic()
+        if (
+            self._queue_state is not None
+            and now - self._queue_state[2] < settings.ADMISSION_STATS_TTL_SECONDS
+        ):
+            return self._queue_state[0], self._queue_state[1]
+
+        active = await db.scalar(
+            select(func.count())
+            .select_from(StoryJob)
+            .where(StoryJob.status.in_(ACTIVE_STATUSES))
+        )
+        window = settings.ADMISSION_DRAIN_WINDOW_SECONDS
+        # only jobs a worker ran drain the queue, warm pool hits finish on creation
+        finished = await db.scalar(
+            select(func.count())
+            .select_from(StoryJob)
+            .where(
+                StoryJob.completed_at > utcnow() - timedelta(seconds=window),
+                StoryJob.started_at.is_not(None),
+            )
+        )
+        drain_rate = finished / window
+        self._queue_state = (active, drain_rate, now)
+        return active, drain_rate
+
+    @staticmethod
+    def _retry_after(seconds: Optional[float]) -> int:
+        # nothing finished lately, so there is no rate to estimate from
+        if seconds is None:
+            return settings.ADMISSION_MAX_RETRY_AFTER_SECONDS
+        return max(
+            1, min(math.ceil(seconds), settings.ADMISSION_MAX_RETRY_AFTER_SECONDS)
+        )
+
+
+admission = AdmissionController()
@@ -0,0 +1,205 @@
+# response cache: bounded in-process LRU in front of an optional shared backend
+import math
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from core.config import settings
+from core.metrics import (
+    registry,
+    response_cache_bytes,
+    response_cache_entries,
+    response_cache_evictions,
+    response_cache_hit_ratio,
+    response_cache_lookups,
+)
+
+
+class CacheBackend(ABC):
+    async def get(self, key: str) -> Optional[bytes]:
+        value, _ = await self.get_with_ttl(key)
+        return value
+
+    # the value and its remaining seconds, None for either when missing or unlimited
+    @abstractmethod
+    async def get_with_ttl(
+        self, key: str
+    ) -> Tuple[Optional[bytes], Optional[float]]: ...
+
+    @abstractmethod
+    async def set(
+        self, key: str, value: bytes, ttl: Optional[float] = None
+    ) -> None: ...
+
+    @abstractmethod
+    async def delete(self, key: str) -> None: ...
+
+    @abstractmethod
+    def stats(self) -> Dict[str, float]: ...
+
+
+# evicts least recently used entries once the stored bytes pass max_bytes
+class LRUCache(CacheBackend):
+    def __init__(self, max_bytes: int, name: str = "local"):
+        self.max_bytes = max_bytes
+        # cache label of its metrics
+        self.name = name
+        # key -> (value, expires at or None)
+        self._entries: "OrderedDict[str, Tuple[bytes, Optional[float]]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    async def get_with_ttl(self, key: str) -> Tuple[Optional[bytes], Optional[float]]:
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] is not None and entry[1] < now:
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(key)
+                self.hits += 1
+        response_cache_lookups.inc(
+            cache=self.name, result="miss" if entry is None else "hit"
+        )
+        if entry is None:
+            return None, None
+        value, expires_at = entry
+        return value, expires_at - now if expires_at is not None else None
+
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        size = self._size(key, value)
+        # never let one value flush the whole cache
+        if size > self.max_bytes:
+            return
+        expires_at = time.monotonic() + ttl if ttl else None
+        evicted = 0
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (value, expires_at)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                evicted += 1
+            self.evictions += evicted
+        if evicted:
+            response_cache_evictions.inc(evicted, cache=self.name)
+
+    async def delete(self, key: str) -> None:
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+    def _remove(self, key: str) -> None:
+        value, _ = self._entries.pop(key)
+        self._bytes -= self._size(key, value)
+
+    @staticmethod
+    def _size(key: str, value: bytes) -> int:
+        return len(key) + len(value)
+
+
+# stand-in for a shared cache such as Redis, lives in this process only
+class LocalSharedCache(LRUCache):
+    pass
+
+
+# checks the local LRU first, then the shared backend, filling the LRU on shared hits
+class TieredCache(CacheBackend):
+    def __init__(self, local: LRUCache, shared: Optional[CacheBackend] = None):
+        self.local = local
+        self.shared = shared
+
+    async def get_with_ttl(self, key: str) -> Tuple[Optional[bytes], Optional[float]]:
+        value, ttl = await self.local.get_with_ttl(key)
+        if value is None and self.shared is not None:
+            value, ttl = await self.shared.get_with_ttl(key)
+            if value is not None:
+                # the local copy expires with the shared one, and never outlives
+                # the response TTL so deletes from other processes show up
+                ttl = min(ttl or math.inf, settings.RESPONSE_CACHE_TTL_SECONDS)
+                await self.local.set(key, value, ttl)
+        return value, ttl
+
+    async def set(self, key: str, value: bytes, ttl: Optional[float] = None) -> None:
+        await self.local.set(key, value, ttl)
+        if self.shared is not None:
+            await self.shared.set(key, value, ttl)
+
+    async def delete(self, key: str) -> None:
+        await self.local.delete(key)
+        if self.shared is not None:
+            await self.shared.delete(key)
+
+    def stats(self) -> Dict[str, float]:
+        stats = {f"local_{name}": value for name, value in self.local.stats().items()}
+        if self.shared is not None:
+            stats.update(
+                {f"shared_{name}": value for name, value in self.shared.stats().items()}
+            )
+        return stats
+
+
+def build_cache(max_bytes: int, shared_backend: str) -> TieredCache:
+    shared = None
+    if shared_backend == "local":
+        shared = LocalSharedCache(max_bytes * 4, name="shared")
+    elif shared_backend:
+        raise ValueError(f"Unknown cache backend: {shared_backend}")
+    return TieredCache(LRUCache(max_bytes), shared)
+
+
+# packs the stored bytes of a story with the headers needed to serve them
+def pack_story_blob(etag: str, encoding: str, payload: bytes) -> bytes:
+    return b"\n".join([etag.encode("utf-8"), encoding.encode("utf-8"), payload])
+
+
+def unpack_story_blob(value: bytes) -> Tuple[str, str, bytes]:
+    etag, encoding, payload = value.split(b"\n", 2)
+    return etag.decode("utf-8"), encoding.decode("utf-8"), payload
+
+
+def job_cache_key(job_id: str) -> str:
+    return f"job:{job_id}"
+
+
+def story_cache_key(story_id: int) -> str:
+    return f"story:{story_id}"
+
+
+app_cache = build_cache(
+    settings.RESPONSE_CACHE_MAX_BYTES, settings.RESPONSE_CACHE_SHARED_BACKEND
+)
+
+
+# sizes and hit ratios of both tiers, read when /metrics is rendered
+@registry.collect_with
+def _collect_cache_metrics() -> None:
+    for cache in (app_cache.local, app_cache.shared):
+        if cache is None:
+            continue
+        stats = cache.stats()
+        response_cache_hit_ratio.set(stats["hit_ratio"], cache=cache.name)
+        response_cache_bytes.set(stats["bytes"], cache=cache.name)
+        response_cache_entries.set(stats["entries"], cache=cache.name)
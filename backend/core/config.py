@@ -1,4 +1,4 @@
-from typing import List
+from typing import Any, Dict, List
 
 # Advance python type handling
 from pydantic_settings import BaseSettings
@@ -11,8 +11,173 @@ class Settings(BaseSettings):
     API_PREFIX: str = "/api"
     DEBUG: bool = False
     DATABASE_URL: str
+    # derived from DATABASE_URL (aiosqlite / asyncpg) when left empty
+    ASYNC_DATABASE_URL: str = ""
+    # Connection pool, per engine and per process
+    DB_POOL_SIZE: int = 10
+    DB_MAX_OVERFLOW: int = 20
+    # seconds to wait for a free connection before giving up
+    DB_POOL_TIMEOUT: float = 30.0
+    DB_POOL_PRE_PING: bool = True
+    # seconds before a connection is replaced, below common server idle timeouts
+    DB_POOL_RECYCLE: int = 1800
+    # postgres only, 0 disables it
+    DB_STATEMENT_TIMEOUT_MS: int = 30000
+    # single-node sqlite deployments
+    SQLITE_WAL: bool = True
+    SQLITE_SYNCHRONOUS: str = "NORMAL"
+    SQLITE_BUSY_TIMEOUT_MS: int = 5000
     ALLOWED_ORIGINS: str = ""
-    OPENAI_API_KEY: str
+    # only processes that generate stories need it, checked when the LLM is created
+    OPENAI_API_KEY: str = ""
+    LLM_MODEL: str = "gpt-4o-mini"
+    # "compact" describes the story JSON in a few lines, "schema" sends the full JSON schema
+    LLM_PROMPT_FORMAT: str = "compact"
+    # ask the API for JSON mode, which only ever returns valid JSON
+    LLM_JSON_MODE: bool = False
+
+    # Story generation workers
+    WORKER_CONCURRENCY: int = 100
+    WORKER_POLL_INTERVAL: float = 1.0
+    # seconds a claimed job stays reserved without being renewed
+    JOB_LEASE_SECONDS: int = 300
+    # claims allowed before a job that keeps losing its worker is failed
+    JOB_MAX_ATTEMPTS: int = 3
+
+    # Admission control on /stories/create
+    # pending plus processing jobs allowed at once, 0 disables the cap
+    ADMISSION_MAX_ACTIVE_JOBS: int = 1000
+    # the Retry-After estimate uses jobs finished over this window
+    ADMISSION_DRAIN_WINDOW_SECONDS: int = 60
+    ADMISSION_STATS_TTL_SECONDS: float = 1.0
+    ADMISSION_MAX_RETRY_AFTER_SECONDS: int = 300
+    # per session token bucket, 0 per minute disables it
+    SESSION_RATE_LIMIT_BURST: int = 5
+    SESSION_RATE_LIMIT_PER_MINUTE: float = 2.0
+    # pending plus processing batch jobs one session may have, 0 disables the cap
+    SESSION_MAX_ACTIVE_BATCH_JOBS: int = 50
+
+    # Batch creation on /stories/batch
+    STORY_BATCH_MAX_THEMES: int = 500
+    # default and upper bound for the jobs of one batch generated at once
+    STORY_BATCH_MAX_CONCURRENCY: int = 10
+
+    # Job status streaming, one batched status query per interval for all listeners
+    JOB_EVENTS_POLL_INTERVAL: float = 1.0
+    JOB_EVENTS_KEEPALIVE_SECONDS: float = 15.0
+
+    # persist the story while the LLM streams it, the root is playable before the end
+    STORY_STREAMING_ENABLED: bool = False
+
+    # gzip the stored JSON of finished stories
+    STORY_BLOB_COMPRESSION: bool = True
+
+    # write options to the story_options edge table next to the JSON column, and read
+    # them from there for stories that have edges
+    STORY_OPTION_EDGES_ENABLED: bool = True
+
+    # Response cache for finished stories and jobs, sized in bytes
+    RESPONSE_CACHE_MAX_BYTES: int = 64 * 1024 * 1024
+    # empty for in-process only, "local" for the shared-cache stand-in
+    RESPONSE_CACHE_SHARED_BACKEND: str = ""
+    RESPONSE_CACHE_TTL_SECONDS: int = 3600
+
+    # Story generation cache, reuses stored stories for repeated themes
+    STORY_CACHE_ENABLED: bool = False
+    # distinct stories generated per key before requests are served from the cache
+    STORY_CACHE_POOL_SIZE: int = 3
+    STORY_CACHE_TTL_SECONDS: int = 7 * 24 * 3600
+    # least recently used keys are evicted past this many
+    STORY_CACHE_MAX_KEYS: int = 1000
+
+    # Jobs with the same theme wait on one in-flight generation instead of each calling the LLM
+    SINGLE_FLIGHT_ENABLED: bool = False
+    SINGLE_FLIGHT_POLL_INTERVAL: float = 0.5
+    # times a follower re-joins after its leader failed before giving up
+    SINGLE_FLIGHT_MAX_ROUNDS: int = 2
+
+    # Warm pool of pre-generated stories for popular themes
+    WARM_POOL_ENABLED: bool = False
+    # unclaimed stories kept per hot theme
+    WARM_POOL_SIZE: int = 3
+    WARM_POOL_MAX_THEMES: int = 10
+    # requests within the window before a theme counts as hot
+    WARM_POOL_MIN_REQUESTS: int = 3
+    WARM_POOL_WINDOW_SECONDS: int = 3600
+    WARM_POOL_REFILL_INTERVAL: float = 30.0
+    # pooled generations a worker runs at once, only while it has no queued jobs
+    WARM_POOL_REFILL_CONCURRENCY: int = 2
+    WARM_POOL_LLM_BUDGET_PER_HOUR: int = 30
+
+    # Retention of finished jobs and abandoned stories, see core/retention.py
+    # workers run a pass every interval when enabled, manage.py retention any time
+    RETENTION_ENABLED: bool = False
+    RETENTION_INTERVAL_SECONDS: float = 3600.0
+    # seconds a finished job is kept after completed_at, per status, 0 keeps it forever
+    RETENTION_COMPLETED_JOB_TTL_SECONDS: int = 30 * 24 * 3600
+    RETENTION_FAILED_JOB_TTL_SECONDS: int = 7 * 24 * 3600
+    # an incomplete story this old lost its generation, keep it well above
+    # JOB_LEASE_SECONDS * JOB_MAX_ATTEMPTS
+    RETENTION_ORPHAN_STORY_TTL_SECONDS: int = 24 * 3600
+    # finished single-flight rows, only read while followers wait on the leader
+    RETENTION_FLIGHT_TTL_SECONDS: int = 24 * 3600
+    # rows per transaction, small so writers never wait long on the deletes
+    RETENTION_BATCH_SIZE: int = 500
+    RETENTION_BATCH_PAUSE_SECONDS: float = 0.05
+    # deleted jobs, batches and stories are appended here as gzipped JSONL first,
+    # empty deletes without a copy
+    RETENTION_ARCHIVE_DIR: str = ""
+
+    # Checks on a generated story before it is stored, one that fails is regenerated
+    STORY_VALIDATION_ENABLED: bool = True
+    # levels including the root
+    STORY_MIN_DEPTH: int = 3
+    # options on every node that is not an ending
+    STORY_MIN_OPTIONS: int = 2
+    STORY_MAX_OPTIONS: int = 3
+    STORY_REQUIRE_WINNING_ENDING: bool = True
+
+    # Fan-out generation: an outline call, then one call per first-level branch
+    STORY_FANOUT_ENABLED: bool = False
+    # options under the root, each one becomes a concurrent branch call
+    STORY_FANOUT_BRANCHES: str = "2-3"
+    STORY_FANOUT_CONCURRENCY: int = 4
+    # levels generated per branch, the story is one level deeper
+    STORY_FANOUT_BRANCH_DEPTH: int = 4
+
+    # LLM call policy
+    LLM_TIMEOUT_SECONDS: float = 120.0
+    # attempts per generation, including the first one
+    LLM_MAX_ATTEMPTS: int = 3
+    LLM_RETRY_BASE_DELAY: float = 1.0
+    LLM_RETRY_MAX_DELAY: float = 20.0
+    # fix fences, trailing commas and truncation before retrying a bad response
+    LLM_JSON_REPAIR: bool = True
+    # send a duplicate request once a call is slower than this percentile
+    LLM_HEDGE_ENABLED: bool = False
+    LLM_HEDGE_PERCENTILE: float = 95.0
+    # calls to observe before hedging starts
+    LLM_HEDGE_MIN_SAMPLES: int = 20
+
+    # LLM providers as a JSON list, each with a name and model, and optionally the
+    # base_url and api_key of an OpenAI-compatible server and requests_per_minute;
+    # empty for LLM_MODEL on OpenAI
+    LLM_PROVIDERS: List[Dict[str, Any]] = []
+    # recent calls per provider that latency and error rate are computed over
+    LLM_ROUTER_WINDOW: int = 50
+    LLM_ROUTER_MIN_SAMPLES: int = 5
+    # a provider failing this share of its calls, or rate limited, is skipped for a while
+    LLM_ROUTER_MAX_ERROR_RATE: float = 0.5
+    LLM_ROUTER_COOLDOWN_SECONDS: float = 30.0
+    # other providers tried within one call before it counts as failed
+    LLM_ROUTER_MAX_FAILOVERS: int = 1
+    # expected latency grows by this share for every call already in flight
+    LLM_ROUTER_IN_FLIGHT_PENALTY: float = 0.05
+
+    # Prometheus metrics at /metrics, off skips all recording
+    METRICS_ENABLED: bool = True
+    # workers serve their own /metrics on this port, 0 disables it
+    WORKER_METRICS_PORT: int = 0
 
     # Convert ALLOWED_ORIGINS from .env into a list
     @field_validator("ALLOWED_ORIGINS")
@@ -20,6 +185,10 @@ class Settings(BaseSettings):
         # Return value separated by commas if exist otherwise return empty list
         return v.split(",") if v else []
 
+    # configured providers, or the default OpenAI one
+    def llm_providers(self) -> List[Dict[str, Any]]:
+        return self.LLM_PROVIDERS or [{"name": "openai", "model": self.LLM_MODEL}]
+
     # Set Configuration
     class Config:
         env_file = ".env"
@@ -0,0 +1,78 @@
+# in-process pub/sub of job status changes, feeds the /jobs/{job_id}/events stream
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Dict, Optional, Set
+
+from sqlalchemy import select
+
+from core.config import settings
+from db.database import AsyncSessionLocal
+from models.job import StoryJob
+from schemas.job import StoryJobResponse
+
+logger = logging.getLogger(__name__)
+
+TERMINAL_STATUSES = ("completed", "failed")
+
+
+class JobEventBus:
+    def __init__(self):
+        # job_id -> queues of the clients streaming that job
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = defaultdict(set)
+        # last (status, story_id) published per job, so repeats are dropped
+        self._last_seen: Dict[str, tuple] = {}
+        self._watcher: Optional[asyncio.Task] = None
+
+    # current is the state the client already has, it is not sent again
+    def subscribe(
+        self, job_id: str, current: Optional[StoryJobResponse] = None
+    ) -> asyncio.Queue:
+        queue = asyncio.Queue()
+        if current is not None:
+            self._last_seen.setdefault(job_id, (current.status, current.story_id))
+        self._subscribers[job_id].add(queue)
+        # one watcher polls the database for every subscribed job at once
+        if self._watcher is None or self._watcher.done():
+            self._watcher = asyncio.create_task(self._watch())
+        return queue
+
+    def unsubscribe(self, job_id: str, queue: asyncio.Queue) -> None:
+        queues = self._subscribers.get(job_id)
+        if queues is None:
+            return
+        queues.discard(queue)
+        if not queues:
+            del self._subscribers[job_id]
+            self._last_seen.pop(job_id, None)
+
+    # push a job state to its subscribers, called by the watcher and by JobQueue
+    def publish(self, job: StoryJobResponse) -> None:
+        state = (job.status, job.story_id)
+        if self._last_seen.get(job.job_id) == state:
+            return
+        queues = self._subscribers.get(job.job_id)
+        if not queues:
+            return
+        self._last_seen[job.job_id] = state
+        for queue in queues:
+            queue.put_nowait(job)
+
+    # workers run in other processes, so pick their transitions up from story_jobs
+    async def _watch(self):
+        while self._subscribers:
+            try:
+                async with AsyncSessionLocal() as db:
+                    result = await db.execute(
+                        select(StoryJob).where(
+                            StoryJob.job_id.in_(list(self._subscribers))
+                        )
+                    )
+                    for job in result.scalars():
+                        self.publish(StoryJobResponse.model_validate(job))
+            except Exception:
+                logger.exception("failed to poll job statuses")
+            await asyncio.sleep(settings.JOB_EVENTS_POLL_INTERVAL)
+
+
+job_events = JobEventBus()
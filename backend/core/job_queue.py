@@ -0,0 +1,397 @@
+# story_jobs doubles as a durable work queue shared by the API and the workers
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import insert, or_, select, update, func
+from sqlalchemy.orm import aliased
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.cache import app_cache, job_cache_key
+from core.config import settings
+from core.events import job_events
+from core.metrics import (
+    elapsed_seconds,
+    job_pending_seconds,
+    job_processing_seconds,
+    jobs_finished,
+)
+from models.batch import StoryBatch
+from models.job import StoryJob
+from schemas.job import StoryJobResponse
+
+
+def utcnow() -> datetime:
+    return datetime.now(timezone.utc)
+
+
+class JobQueue:
+    # add a pending job, workers pick it up on their next poll
+    @classmethod
+    async def enqueue(
+        cls, db: AsyncSession, session_id: str, theme: str, model: Optional[str] = None
+    ) -> StoryJob:
+        job = StoryJob(
+            job_id=str(uuid.uuid4()),
+            session_id=session_id,
+            theme=theme,
+            model=model,
+            status="pending",
+            attempts=0,
+        )
+        db.add(job)
+        await db.commit()
+        # load created_at, which the database fills in
+        await db.refresh(job)
+        return job
+
+    # all jobs of a batch in one transaction, one insert for the jobs
+    @classmethod
+    async def enqueue_batch(
+        cls,
+        db: AsyncSession,
+        session_id: str,
+        themes: List[str],
+        max_concurrency: int,
+        model: Optional[str] = None,
+    ) -> StoryBatch:
+        batch = StoryBatch(
+            batch_id=str(uuid.uuid4()),
+            session_id=session_id,
+            total=len(themes),
+            max_concurrency=max_concurrency,
+        )
+        db.add(batch)
+        await db.execute(
+            insert(StoryJob).values(
+                [
+                    {
+                        "job_id": str(uuid.uuid4()),
+                        "session_id": session_id,
+                        "theme": theme,
+                        "model": model,
+                        "status": "pending",
+                        "attempts": 0,
+                        "batch_id": batch.batch_id,
+                    }
+                    for theme in themes
+                ]
+            )
+        )
+        await db.commit()
+        await db.refresh(batch)
+        return batch
+
+    # the batch, its job count per status and its jobs, None when it doesn't exist
+    @classmethod
+    async def batch_status(
+        cls, db: AsyncSession, batch_id: str
+    ) -> Optional[Tuple[StoryBatch, Dict[str, int], List[StoryJob]]]:
+        batch = await db.scalar(
+            select(StoryBatch).where(StoryBatch.batch_id == batch_id)
+        )
+        if batch is None:
+            return None
+        result = await db.execute(
+            select(StoryJob).where(StoryJob.batch_id == batch_id).order_by(StoryJob.id)
+        )
+        jobs = list(result.scalars().all())
+        counts = {
+            status: 0 for status in ("pending", "processing", "completed", "failed")
+        }
+        for job in jobs:
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return batch, counts, jobs
+
+    # record a job that was served without generation, e.g. from the warm pool
+    @classmethod
+    async def create_completed(
+        cls, db: AsyncSession, session_id: str, theme: str, story_id: int
+    ) -> StoryJob:
+        now = utcnow()
+        job = StoryJob(
+            job_id=str(uuid.uuid4()),
+            session_id=session_id,
+            theme=theme,
+            status="completed",
+            story_id=story_id,
+            attempts=0,
+            completed_at=now,
+        )
+        db.add(job)
+        await db.commit()
+        await db.refresh(job)
+        return job
+
+    # atomically reserve up to limit pending jobs for this worker
+    @classmethod
+    async def claim(
+        cls, db: AsyncSession, worker_id: str, limit: int = 1
+    ) -> List[StoryJob]:
+        if limit <= 0:
+            return []
+        if db.get_bind().dialect.name == "postgresql":
+            jobs = await cls._claim_skip_locked(db, worker_id, limit)
+        else:
+            jobs = await cls._claim_with_lease(db, worker_id, limit)
+        await db.commit()
+        for job in jobs:
+            job_pending_seconds.observe(
+                elapsed_seconds(job.created_at, job.started_at) or 0.0
+            )
+            job_events.publish(StoryJobResponse.model_validate(job))
+        return jobs
+
+    # postgres: rows locked by another worker are skipped instead of waited on
+    @classmethod
+    async def _claim_skip_locked(
+        cls, db: AsyncSession, worker_id: str, limit: int
+    ) -> List[StoryJob]:
+        result = await db.execute(
+            select(StoryJob)
+            .where(StoryJob.status == "pending", cls._batch_has_capacity())
+            .order_by(StoryJob.created_at, StoryJob.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True, of=StoryJob)
+        )
+        jobs = await cls._within_batch_limits(db, result.scalars().all())
+        now = utcnow()
+        for job in jobs:
+            job.status = "processing"
+            job.worker_id = worker_id
+            job.lease_expires_at = now + timedelta(seconds=settings.JOB_LEASE_SECONDS)
+            job.attempts = (job.attempts or 0) + 1
+            job.started_at = now
+        return list(jobs)
+
+    # sqlite has no row locks, so take each job with a compare-and-swap on its status
+    @classmethod
+    async def _claim_with_lease(
+        cls, db: AsyncSession, worker_id: str, limit: int
+    ) -> List[StoryJob]:
+        result = await db.execute(
+            select(StoryJob.id, StoryJob.batch_id)
+            .where(StoryJob.status == "pending", cls._batch_has_capacity())
+            .order_by(StoryJob.created_at, StoryJob.id)
+            .limit(limit)
+        )
+        candidate_ids = [
+            row.id for row in await cls._within_batch_limits(db, result.all())
+        ]
+        now = utcnow()
+        claimed_ids = []
+        for job_pk in candidate_ids:
+            result = await db.execute(
+                update(StoryJob)
+                .where(StoryJob.id == job_pk, StoryJob.status == "pending")
+                .values(
+                    status="processing",
+                    worker_id=worker_id,
+                    lease_expires_at=now
+                    + timedelta(seconds=settings.JOB_LEASE_SECONDS),
+                    attempts=func.coalesce(StoryJob.attempts, 0) + 1,
+                    started_at=now,
+                )
+            )
+            # another worker got there first
+            if result.rowcount == 1:
+                claimed_ids.append(job_pk)
+        if not claimed_ids:
+            return []
+        result = await db.execute(
+            select(StoryJob)
+            .where(StoryJob.id.in_(claimed_ids))
+            .execution_options(populate_existing=True)
+        )
+        return list(result.scalars().all())
+
+    # filter for pending jobs: not in a batch, or in one below its concurrency
+    @classmethod
+    def _batch_has_capacity(cls):
+        running = aliased(StoryJob)
+        processing = (
+            select(func.count())
+            .where(running.batch_id == StoryBatch.batch_id)
+            .where(running.status == "processing")
+            .scalar_subquery()
+        )
+        saturated = select(StoryBatch.batch_id).where(
+            StoryBatch.max_concurrency <= processing
+        )
+        return or_(StoryJob.batch_id.is_(None), StoryJob.batch_id.not_in(saturated))
+
+    # drop candidates that would take a batch past its concurrency within this claim;
+    # workers claiming at the same moment can still overshoot a batch by a few jobs
+    @classmethod
+    async def _within_batch_limits(cls, db: AsyncSession, candidates) -> list:
+        batch_ids = {c.batch_id for c in candidates if c.batch_id is not None}
+        if not batch_ids:
+            return list(candidates)
+        result = await db.execute(
+            select(StoryBatch.batch_id, StoryBatch.max_concurrency).where(
+                StoryBatch.batch_id.in_(batch_ids)
+            )
+        )
+        free = dict(result.all())
+        result = await db.execute(
+            select(StoryJob.batch_id, func.count())
+            .where(StoryJob.batch_id.in_(batch_ids), StoryJob.status == "processing")
+            .group_by(StoryJob.batch_id)
+        )
+        for batch_id, processing in result.all():
+            free[batch_id] -= processing
+
+        allowed = []
+        for candidate in candidates:
+            if candidate.batch_id is not None:
+                if free.get(candidate.batch_id, 0) <= 0:
+                    continue
+                free[candidate.batch_id] -= 1
+            allowed.append(candidate)
+        return allowed
+
+    # push the lease forward for jobs this worker is still working on
+    @classmethod
+    async def renew(cls, db: AsyncSession, worker_id: str, job_ids: List[str]) -> None:
+        if not job_ids:
+            return
+        await db.execute(
+            update(StoryJob)
+            .where(
+                StoryJob.job_id.in_(job_ids),
+                StoryJob.worker_id == worker_id,
+                StoryJob.status == "processing",
+            )
+            .values(
+                lease_expires_at=utcnow()
+                + timedelta(seconds=settings.JOB_LEASE_SECONDS)
+            )
+        )
+        await db.commit()
+
+    # put jobs whose worker died back in the queue, or fail them after too many tries
+    @classmethod
+    async def recover_expired(cls, db: AsyncSession) -> int:
+        now = utcnow()
+        expired = (
+            StoryJob.status == "processing",
+            StoryJob.lease_expires_at < now,
+        )
+        failed = await db.execute(
+            update(StoryJob)
+            .where(*expired, StoryJob.attempts >= settings.JOB_MAX_ATTEMPTS)
+            .values(
+                status="failed",
+                error="Job exceeded the maximum number of attempts",
+                completed_at=now,
+                worker_id=None,
+                lease_expires_at=None,
+            )
+            .returning(StoryJob)
+        )
+        failed = failed.scalars().all()
+        requeued = await db.execute(
+            update(StoryJob)
+            .where(*expired)
+            .values(status="pending", worker_id=None, lease_expires_at=None)
+            .returning(StoryJob)
+        )
+        requeued = requeued.scalars().all()
+        await db.commit()
+        if failed:
+            jobs_finished.inc(len(failed), status="failed")
+        # watchers of these jobs see them fail or go back to pending
+        for job in [*failed, *requeued]:
+            await app_cache.delete(job_cache_key(job.job_id))
+            job_events.publish(StoryJobResponse.model_validate(job))
+        return len(failed) + len(requeued)
+
+    # point a job still being processed at its partially written story
+    @classmethod
+    async def report_progress(
+        cls, db: AsyncSession, job_id: str, worker_id: str, story_id: int
+    ) -> None:
+        result = await db.execute(
+            update(StoryJob)
+            .where(
+                StoryJob.job_id == job_id,
+                StoryJob.worker_id == worker_id,
+                StoryJob.status == "processing",
+            )
+            .values(story_id=story_id)
+            .returning(StoryJob)
+        )
+        job = result.scalars().first()
+        await db.commit()
+        if job is not None:
+            await app_cache.delete(job_cache_key(job_id))
+            job_events.publish(StoryJobResponse.model_validate(job))
+
+    # finish a job, only if this worker still owns it
+    @classmethod
+    async def complete(
+        cls,
+        db: AsyncSession,
+        job_id: str,
+        worker_id: str,
+        story_id: int,
+        attempt_log: Optional[List[dict]] = None,
+    ) -> bool:
+        return await cls._finish(
+            db,
+            job_id,
+            worker_id,
+            attempt_log,
+            status="completed",
+            story_id=story_id,
+            error=None,
+        )
+
+    @classmethod
+    async def fail(
+        cls,
+        db: AsyncSession,
+        job_id: str,
+        worker_id: str,
+        error: str,
+        attempt_log: Optional[List[dict]] = None,
+    ) -> bool:
+        return await cls._finish(
+            db, job_id, worker_id, attempt_log, status="failed", error=error
+        )
+
+    @classmethod
+    async def _finish(
+        cls,
+        db: AsyncSession,
+        job_id: str,
+        worker_id: str,
+        attempt_log: Optional[List[dict]] = None,
+        **values,
+    ) -> bool:
+        if attempt_log is not None:
+            values["llm_attempts"] = len(attempt_log)
+            values["llm_attempt_log"] = attempt_log
+        result = await db.execute(
+            update(StoryJob)
+            .where(
+                StoryJob.job_id == job_id,
+                StoryJob.worker_id == worker_id,
+                StoryJob.status == "processing",
+            )
+            .values(completed_at=utcnow(), lease_expires_at=None, **values)
+            .returning(StoryJob)
+        )
+        job = result.scalars().first()
+        await db.commit()
+        if job is None:
+            return False
+        jobs_finished.inc(status=job.status)
+        job_processing_seconds.observe(
+            elapsed_seconds(job.started_at, job.completed_at) or 0.0,
+            status=job.status,
+        )
+        # drop any cached copy before anyone is told about the new state
+        await app_cache.delete(job_cache_key(job_id))
+        job_events.publish(StoryJobResponse.model_validate(job))
+        return True
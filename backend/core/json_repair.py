@@ -0,0 +1,68 @@
+# best-effort fixes for almost valid JSON from an LLM, before spending a retry on it
+import re
+
+_CODE_FENCE = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$", re.IGNORECASE)
+# a key, or a key and colon, at the end of a truncated object
+_DANGLING_KEY = re.compile(r'[{,]\s*"(?:[^"\\]|\\.)*"\s*:?\s*$')
+
+
+def _drop_trailing_comma(out: list) -> None:
+    while out and out[-1].isspace():
+        out.pop()
+    if out and out[-1] == ",":
+        out.pop()
+
+
+# strip markdown fences and prose, drop trailing commas, close what was left open
+def repair_json(text: str) -> str:
+    text = _CODE_FENCE.sub("", text.strip())
+
+    # anything before the first brace is the model talking
+    start = text.find("{")
+    if start == -1:
+        return text
+
+    out = []
+    closers = []
+    in_string = False
+    escaped = False
+    for char in text[start:]:
+        if in_string:
+            out.append(char)
+            if escaped:
+                escaped = False
+            elif char == "\\":
+                escaped = True
+            elif char == '"':
+                in_string = False
+            continue
+        if char in "}]":
+            _drop_trailing_comma(out)
+            out.append(char)
+            if closers:
+                closers.pop()
+            # the top level object is done, the rest is trailing prose
+            if not closers:
+                return "".join(out)
+            continue
+        out.append(char)
+        if char == '"':
+            in_string = True
+        elif char in "{[":
+            closers.append("}" if char == "{" else "]")
+
+    # a response cut off mid-way: finish the string and close every open bracket
+    if in_string:
+        # a lone backslash would escape the closing quote
+        if escaped:
+            out.pop()
+        out.append('"')
+    _drop_trailing_comma(out)
+    repaired = "".join(out)
+    # a key without a value can't be completed, drop back to the last value
+    dangling = closers and closers[-1] == "}" and _DANGLING_KEY.search(repaired)
+    if dangling:
+        repaired = repaired[: dangling.start() + 1]
+        if repaired.endswith(","):
+            repaired = repaired[:-1]
+    return repaired + "".join(reversed(closers))
@@ -0,0 +1,203 @@
+# timeouts, retries with backoff, hedged requests and JSON repair around LLM calls
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+from typing import Any, Callable, List, Optional, Tuple, TypeVar
+
+import openai
+from langchain_core.exceptions import OutputParserException
+from pydantic import ValidationError
+
+from core.config import settings
+from core.json_repair import repair_json
+from core.metrics import generation_stage_seconds, llm_calls, record_token_usage
+from core.story_analysis import StoryValidationError
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# provider errors worth another try, anything else fails the job straight away
+TRANSIENT_ERRORS = (
+    openai.APIConnectionError,
+    openai.APITimeoutError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+    ConnectionError,
+)
+PARSE_ERRORS = (OutputParserException, ValidationError, ValueError)
+
+
+class LLMCallFailed(Exception):
+    def __init__(self, message: str, attempts: List[dict]):
+        super().__init__(message)
+        self.attempts = attempts
+
+
+# recent call latencies, hedging waits until the configured percentile has passed
+class LatencyTracker:
+    def __init__(self, window: int = 200):
+        self._samples = deque(maxlen=window)
+
+    def record(self, seconds: float) -> None:
+        self._samples.append(seconds)
+
+    def percentile(self, pct: float) -> Optional[float]:
+        if len(self._samples) < settings.LLM_HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(self._samples)
+        index = min(int(len(ordered) * pct / 100), len(ordered) - 1)
+        return ordered[index]
+
+
+class LLMCallPolicy:
+    latencies = LatencyTracker()
+
+    # call the LLM and parse its answer, retrying until it parses or attempts run out;
+    # every attempt is appended to attempt_log
+    @classmethod
+    async def ainvoke_parsed(
+        cls,
+        llm,
+        messages,
+        parse: Callable[[Any], T],
+        attempt_log: Optional[List[dict]] = None,
+        # names the call in the log when one generation makes several
+        call: Optional[str] = None,
+    ) -> T:
+        attempt_log = attempt_log if attempt_log is not None else []
+        for attempt in range(1, settings.LLM_MAX_ATTEMPTS + 1):
+            started = time.perf_counter()
+            record = {"attempt": attempt, "hedged": False, "repaired": False}
+            if call is not None:
+                record["call"] = call
+            try:
+                response, record["hedged"] = await cls._ainvoke_hedged(llm, messages)
+                cls._record_provider(record, response)
+                result, record["repaired"] = cls.parse_with_repair(parse, response)
+                cls.record_attempt(attempt_log, record, started, "ok")
+                return result
+            except Exception as e:
+                cause = cls.classify(e)
+                cls.record_attempt(attempt_log, record, started, cause, e)
+                if cause == "error" or attempt == settings.LLM_MAX_ATTEMPTS:
+                    raise LLMCallFailed(
+                        f"LLM call failed after {attempt} attempt(s): {cause}: {e}",
+                        attempt_log,
+                    ) from e
+                await asyncio.sleep(cls.backoff(attempt))
+
+    # parse as is, then once more after repairing the JSON; returns (result, repaired)
+    @classmethod
+    def parse_with_repair(cls, parse: Callable[[Any], T], response) -> Tuple[T, bool]:
+        try:
+            return parse(response), False
+        except PARSE_ERRORS:
+            if not settings.LLM_JSON_REPAIR:
+                raise
+            text = response.content if hasattr(response, "content") else response
+            repaired = repair_json(text)
+            if repaired == text:
+                raise
+            return parse(repaired), True
+
+    # timeout, transient, invalid_story, invalid_json, or error for failures a
+    # retry won't fix
+    @classmethod
+    def classify(cls, error: Exception) -> str:
+        if isinstance(error, asyncio.TimeoutError):
+            return "timeout"
+        if isinstance(error, TRANSIENT_ERRORS):
+            return "transient"
+        if isinstance(error, StoryValidationError):
+            return "invalid_story"
+        if isinstance(error, PARSE_ERRORS):
+            return "invalid_json"
+        return "error"
+
+    # exponential backoff with full jitter
+    @classmethod
+    def backoff(cls, attempt: int) -> float:
+        ceiling = min(
+            settings.LLM_RETRY_BASE_DELAY * 2 ** (attempt - 1),
+            settings.LLM_RETRY_MAX_DELAY,
+        )
+        return random.uniform(0, ceiling)
+
+    # one call under the timeout; a duplicate request is sent when the first one is
+    # slower than the hedge percentile, the first answer wins. returns (response, hedged)
+    @classmethod
+    async def _ainvoke_hedged(cls, llm, messages) -> Tuple[Any, bool]:
+        started = time.perf_counter()
+        hedge_after = (
+            cls.latencies.percentile(settings.LLM_HEDGE_PERCENTILE)
+            if settings.LLM_HEDGE_ENABLED
+            else None
+        )
+        async with asyncio.timeout(settings.LLM_TIMEOUT_SECONDS):
+            primary = asyncio.ensure_future(llm.ainvoke(messages))
+            if hedge_after is None:
+                response = await primary
+                cls._observe(response, time.perf_counter() - started)
+                return response, False
+
+            tasks = {primary}
+            try:
+                done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+                if not done:
+                    logger.info("LLM call slower than %.1fs, hedging", hedge_after)
+                    tasks.add(asyncio.ensure_future(llm.ainvoke(messages)))
+                while True:
+                    done, _ = await asyncio.wait(
+                        tasks, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for task in done:
+                        tasks.discard(task)
+                        # the other request may still succeed
+                        if task.exception() is not None and tasks:
+                            continue
+                        response = task.result()
+                        cls._observe(response, time.perf_counter() - started)
+                        return response, task is not primary
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+    @classmethod
+    def _observe(cls, response, seconds: float) -> None:
+        cls.latencies.record(seconds)
+        generation_stage_seconds.observe(seconds, stage="llm")
+        record_token_usage(response)
+
+    # the provider LLMRouter sent the call to, when it went through the router
+    @classmethod
+    def _record_provider(cls, record: dict, response) -> None:
+        metadata = getattr(response, "response_metadata", None) or {}
+        if "llm_provider" in metadata:
+            record["provider"] = metadata["llm_provider"]
+
+    # append one attempt to the log that ends up on the job
+    @classmethod
+    def record_attempt(
+        cls,
+        attempt_log: List[dict],
+        record: dict,
+        started: float,
+        outcome: str,
+        error: Optional[Exception] = None,
+    ) -> None:
+        record["outcome"] = outcome
+        record["seconds"] = round(time.perf_counter() - started, 3)
+        if error is not None:
+            record["error"] = str(error)[:200] or type(error).__name__
+        attempt_log.append(record)
+        llm_calls.inc(outcome=outcome)
+        if error is not None:
+            logger.warning(
+                "LLM attempt %d failed (%s): %s",
+                record["attempt"],
+                outcome,
+                record["error"],
+            )
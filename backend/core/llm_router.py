@@ -0,0 +1,277 @@
+# spreads LLM calls over the configured providers: each call goes to the one with the
+# best observed latency and error rate that still has rate-limit budget, and moves on
+# to the next one when a provider fails
+import asyncio
+import logging
+import statistics
+import time
+from collections import deque
+from typing import Any, List, Optional
+
+import openai
+
+from core.config import settings
+from core.llm_policy import TRANSIENT_ERRORS
+from core.metrics import llm_provider_calls, llm_provider_seconds
+
+logger = logging.getLogger(__name__)
+
+# failures that say nothing about the request itself, another provider may succeed
+FAILOVER_ERRORS = TRANSIENT_ERRORS + (asyncio.TimeoutError,)
+
+
+class LLMProvider:
+    def __init__(
+        self,
+        name: str,
+        model: str,
+        base_url: Optional[str] = None,
+        api_key: Optional[str] = None,
+        # 0 for no limit
+        requests_per_minute: int = 0,
+        # a ready client, e.g. a fake in load tests, instead of ChatOpenAI
+        client: Any = None,
+    ):
+        self.name = name
+        self.model = model
+        self.base_url = base_url
+        self.api_key = api_key
+        self.requests_per_minute = requests_per_minute
+        self._client = client
+        window = settings.LLM_ROUTER_WINDOW
+        self.latencies = deque(maxlen=window)
+        # True for a success, False for a failure
+        self.outcomes = deque(maxlen=window)
+        # start times of calls in the last minute
+        self.recent_calls = deque()
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+
+    # one client per provider, reused by every call
+    @property
+    def client(self):
+        if self._client is None:
+            api_key = self.api_key or settings.OPENAI_API_KEY
+            if not api_key:
+                raise RuntimeError(f"No API key for LLM provider {self.name}")
+            # imported on the first generation, it takes longer to load than the app
+            from langchain_openai import ChatOpenAI
+
+            model_kwargs = {}
+            # the API then guarantees syntactically valid JSON
+            if settings.LLM_JSON_MODE:
+                model_kwargs["response_format"] = {"type": "json_object"}
+            self._client = ChatOpenAI(
+                model=self.model,
+                # an OpenAI-compatible server, e.g. a local model, when set
+                base_url=self.base_url,
+                api_key=api_key,
+                timeout=settings.LLM_TIMEOUT_SECONDS,
+                # LLMCallPolicy does the retrying and records every attempt
+                max_retries=0,
+                model_kwargs=model_kwargs,
+            )
+        return self._client
+
+    def matches(self, hint: str) -> bool:
+        return hint in (self.name, self.model)
+
+    def error_rate(self) -> float:
+        if len(self.outcomes) < settings.LLM_ROUTER_MIN_SAMPLES:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    def remaining_budget(self, now: float) -> float:
+        if not self.requests_per_minute:
+            return float("inf")
+        while self.recent_calls and self.recent_calls[0] < now - 60:
+            self.recent_calls.popleft()
+        return self.requests_per_minute - len(self.recent_calls)
+
+    def available(self, now: float) -> bool:
+        if now < self.cooldown_until:
+            return False
+        return self.remaining_budget(now) > 0
+
+    # expected seconds per call, lower is better; failures and load make it worse
+    def score(self, default_latency: float) -> float:
+        latency = (
+            statistics.median(self.latencies) if self.latencies else default_latency
+        )
+        # calls already waiting on this provider
+        latency *= 1 + self.in_flight * settings.LLM_ROUTER_IN_FLIGHT_PENALTY
+        return latency / max(1.0 - self.error_rate(), 0.05)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+            "name": self.name,
+            "model": self.model,
+            "median_latency_s": (
+                round(statistics.median(self.latencies), 3) if self.latencies else None
+            ),
+            "error_rate": round(self.error_rate(), 3),
+            "in_flight": self.in_flight,
+            "remaining_budget": (
+                self.remaining_budget(now) if self.requests_per_minute else None
+            ),
+            "cooling_down": now < self.cooldown_until,
+        }
+
+
+class LLMRouter:
+    def __init__(self):
+        self._providers: Optional[List[LLMProvider]] = None
+
+    @property
+    def providers(self) -> List[LLMProvider]:
+        if self._providers is None:
+            self._providers = [
+                LLMProvider(**config) for config in settings.llm_providers()
+            ]
+        return self._providers
+
+    # replace the providers, e.g. with fakes for a load test
+    def configure(self, providers: List[LLMProvider]) -> None:
+        self._providers = providers
+
+    # an object with the ChatOpenAI call methods that routes every call
+    def llm(self, hint: Optional[str] = None) -> "RoutedLLM":
+        return RoutedLLM(self, hint)
+
+    # providers in the order to try them: healthy ones matching the hint, other
+    # healthy ones, then the rest so a call is still made when all are degraded
+    def candidates(self, hint: Optional[str] = None) -> List[LLMProvider]:
+        now = time.monotonic()
+        observed = [
+            statistics.median(provider.latencies)
+            for provider in self.providers
+            if provider.latencies
+        ]
+        # unused providers are assumed as fast as the best one, so they get tried
+        default_latency = min(observed, default=1.0)
+
+        def rank(provider: LLMProvider):
+            return (
+                not provider.available(now),
+                hint is not None and not provider.matches(hint),
+                provider.score(default_latency),
+            )
+
+        ranked = sorted(self.providers, key=rank)
+        return ranked[: settings.LLM_ROUTER_MAX_FAILOVERS + 1]
+
+    def started(self, provider: LLMProvider) -> float:
+        now = time.monotonic()
+        provider.in_flight += 1
+        if provider.requests_per_minute:
+            provider.recent_calls.append(now)
+        return now
+
+    # outcome of one call; error is None for a success and the exception otherwise
+    def finished(
+        self, provider: LLMProvider, started: float, error: Optional[BaseException]
+    ) -> None:
+        provider.in_flight -= 1
+        seconds = time.monotonic() - started
+        if isinstance(error, (asyncio.CancelledError, GeneratorExit)):
+            # lost a hedge or hit the call timeout, only known to be this slow
+            provider.latencies.append(seconds)
+            llm_provider_calls.inc(provider=provider.name, outcome="cancelled")
+            return
+
+        provider.latencies.append(seconds)
+        provider.outcomes.append(error is None)
+        llm_provider_seconds.observe(seconds, provider=provider.name)
+        llm_provider_calls.inc(
+            provider=provider.name, outcome="ok" if error is None else "error"
+        )
+        if error is None:
+            return
+
+        if isinstance(error, openai.RateLimitError):
+            self._cool_down(provider, "rate limited")
+        elif provider.error_rate() >= settings.LLM_ROUTER_MAX_ERROR_RATE:
+            self._cool_down(provider, f"error rate {provider.error_rate():.0%}")
+
+    def _cool_down(self, provider: LLMProvider, reason: str) -> None:
+        provider.cooldown_until = (
+            time.monotonic() + settings.LLM_ROUTER_COOLDOWN_SECONDS
+        )
+        # it starts over with a clean record once the cooldown is over
+        provider.outcomes.clear()
+        logger.warning(
+            "LLM provider %s skipped for %.0fs: %s",
+            provider.name,
+            settings.LLM_ROUTER_COOLDOWN_SECONDS,
+            reason,
+        )
+
+    def stats(self) -> List[dict]:
+        return [provider.stats() for provider in self.providers]
+
+
+class RoutedLLM:
+    def __init__(self, router: LLMRouter, hint: Optional[str] = None):
+        self.router = router
+        self.hint = hint
+
+    async def ainvoke(self, messages, **kwargs):
+        candidates = self.router.candidates(self.hint)
+        for index, provider in enumerate(candidates):
+            started = self.router.started(provider)
+            try:
+                response = await provider.client.ainvoke(messages, **kwargs)
+            except BaseException as e:
+                self.router.finished(provider, started, e)
+                if not self._fail_over(e, provider, index, candidates):
+                    raise
+                continue
+            self.router.finished(provider, started, None)
+            return self._tagged(response, provider)
+
+    # a stream only moves to another provider before its first chunk
+    async def astream(self, messages, **kwargs):
+        candidates = self.router.candidates(self.hint)
+        for index, provider in enumerate(candidates):
+            started = self.router.started(provider)
+            streamed = False
+            try:
+                async for chunk in provider.client.astream(messages, **kwargs):
+                    streamed = True
+                    yield chunk
+            except BaseException as e:
+                self.router.finished(provider, started, e)
+                if streamed or not self._fail_over(e, provider, index, candidates):
+                    raise
+                continue
+            self.router.finished(provider, started, None)
+            return
+
+    @staticmethod
+    def _fail_over(
+        error: BaseException,
+        provider: LLMProvider,
+        index: int,
+        candidates: List[LLMProvider],
+    ) -> bool:
+        if index == len(candidates) - 1 or not isinstance(error, FAILOVER_ERRORS):
+            return False
+        logger.warning(
+            "LLM provider %s failed (%s), trying %s",
+            provider.name,
+            type(error).__name__,
+            candidates[index + 1].name,
+        )
+        return True
+
+    # the attempt log records which provider answered
+    @staticmethod
+    def _tagged(response, provider: LLMProvider):
+        metadata = getattr(response, "response_metadata", None)
+        if isinstance(metadata, dict):
+            metadata["llm_provider"] = provider.name
+        return response
+
+
+llm_router = LLMRouter()
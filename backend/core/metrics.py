@@ -0,0 +1,314 @@
+# in-process counters and histograms rendered in the prometheus text format
+import asyncio
+import bisect
+import threading
+import time
+from datetime import timezone
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from core.config import settings
+
+# request and generation latencies, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# jobs can wait in the queue or run for minutes
+JOB_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+# a free pooled connection is handed out in well under a millisecond
+POOL_WAIT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames: Tuple[str, ...], values: Tuple[str, ...], **extra):
+    pairs = list(zip(labelnames, values)) + list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], object] = {}
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            lines.extend(self._samples(key, value))
+        return lines
+
+    def _samples(self, key, value) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value}"]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        if not settings.METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Iterable[str] = (),
+        buckets: Tuple[float, ...] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        if not settings.METRICS_ENABLED:
+            return
+        key = self._key(labels)
+        # only the first bucket that fits is counted, render() accumulates them
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * (len(self.buckets) + 1), 0.0))
+            counts[index] += 1
+            self._values[key] = (counts, total + value)
+
+    # time the body of a with block
+    @contextmanager
+    def timer(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _samples(self, key, value) -> List[str]:
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(float(bound))
+            labels = _format_labels(self.labelnames, key, le=le)
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {total}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: List[Metric] = []
+        # refresh gauges from state kept elsewhere, called before every render
+        self._collectors: List[Callable[[], None]] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def collect_with(self, collector: Callable[[], None]) -> Callable[[], None]:
+        self._collectors.append(collector)
+        return collector
+
+    def render(self) -> str:
+        for collector in self._collectors:
+            collector()
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+http_request_seconds = registry.register(
+    Histogram(
+        "http_request_duration_seconds",
+        "Time to the first response byte per route",
+        ("method", "route", "status"),
+    )
+)
+generation_stage_seconds = registry.register(
+    Histogram(
+        "story_generation_stage_seconds",
+        "Time spent in each stage of story generation",
+        ("stage",),
+    )
+)
+llm_tokens = registry.register(
+    Counter(
+        "story_llm_tokens_total", "Tokens sent to and received from the LLM", ("kind",)
+    )
+)
+llm_calls = registry.register(
+    Counter("story_llm_calls_total", "LLM call attempts by outcome", ("outcome",))
+)
+llm_provider_calls = registry.register(
+    Counter(
+        "story_llm_provider_calls_total",
+        "LLM calls per provider by outcome",
+        ("provider", "outcome"),
+    )
+)
+llm_provider_seconds = registry.register(
+    Histogram(
+        "story_llm_provider_seconds", "LLM call latency per provider", ("provider",)
+    )
+)
+jobs_by_status = registry.register(
+    Gauge("story_jobs", "Jobs in the queue by status", ("status",))
+)
+job_pending_seconds = registry.register(
+    Histogram(
+        "story_job_pending_seconds",
+        "Time jobs waited in the queue before a worker claimed them",
+        buckets=JOB_BUCKETS,
+    )
+)
+job_processing_seconds = registry.register(
+    Histogram(
+        "story_job_processing_seconds",
+        "Time from claim to completion or failure",
+        ("status",),
+        buckets=JOB_BUCKETS,
+    )
+)
+jobs_finished = registry.register(
+    Counter("story_jobs_finished_total", "Jobs finished by outcome", ("status",))
+)
+
+retention_rows_deleted = registry.register(
+    Counter(
+        "story_retention_rows_deleted_total",
+        "Rows removed by the retention job",
+        ("table",),
+    )
+)
+retention_rows_archived = registry.register(
+    Counter(
+        "story_retention_rows_archived_total",
+        "Rows copied to the archive before they were removed",
+        ("table",),
+    )
+)
+
+response_cache_lookups = registry.register(
+    Counter(
+        "story_response_cache_lookups_total",
+        "Response cache lookups by cache tier and result",
+        ("cache", "result"),
+    )
+)
+response_cache_evictions = registry.register(
+    Counter(
+        "story_response_cache_evictions_total",
+        "Response cache entries evicted to stay under the size limit",
+        ("cache",),
+    )
+)
+response_cache_hit_ratio = registry.register(
+    Gauge(
+        "story_response_cache_hit_ratio",
+        "Share of response cache lookups that were hits since the process started",
+        ("cache",),
+    )
+)
+response_cache_bytes = registry.register(
+    Gauge("story_response_cache_bytes", "Bytes held by the response cache", ("cache",))
+)
+response_cache_entries = registry.register(
+    Gauge("story_response_cache_entries", "Entries in the response cache", ("cache",))
+)
+db_pool_wait_seconds = registry.register(
+    Histogram(
+        "db_pool_checkout_wait_seconds",
+        "Time spent waiting for a connection from the pool",
+        ("pool",),
+        buckets=POOL_WAIT_BUCKETS,
+    )
+)
+db_pool_timeouts = registry.register(
+    Counter(
+        "db_pool_checkout_timeouts_total",
+        "Checkouts that gave up waiting for a connection",
+        ("pool",),
+    )
+)
+db_pool_connections = registry.register(
+    Gauge(
+        "db_pool_connections",
+        "Pool size and connections checked out or in overflow",
+        ("pool", "state"),
+    )
+)
+
+
+# seconds between two timestamps, treating naive values (sqlite) as utc
+def elapsed_seconds(start, end) -> Optional[float]:
+    if start is None or end is None:
+        return None
+    if start.tzinfo is not None:
+        start = start.astimezone(timezone.utc).replace(tzinfo=None)
+    if end.tzinfo is not None:
+        end = end.astimezone(timezone.utc).replace(tzinfo=None)
+    return max((end - start).total_seconds(), 0.0)
+
+
+# input and output token counts from a langchain message, when the provider reports them
+def record_token_usage(message) -> None:
+    usage = getattr(message, "usage_metadata", None)
+    if not usage:
+        return
+    llm_tokens.inc(usage.get("input_tokens", 0), kind="input")
+    llm_tokens.inc(usage.get("output_tokens", 0), kind="output")
+
+
+# minimal http endpoint for processes without a web app, e.g. workers
+async def serve_metrics(port: int) -> asyncio.AbstractServer:
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            # the request itself doesn't matter, every path returns the metrics
+            await reader.readuntil(b"\r\n\r\n")
+            body = registry.render().encode()
+            writer.write(
+                b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                + f"Content-Length: {len(body)}\r\n".encode()
+                + b"Connection: close\r\n\r\n"
+                + body
+            )
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host="0.0.0.0", port=port)
@@ -0,0 +1,59 @@
+# keyset (cursor) pagination over (created_at, id), newest first
+import base64
+import json
+from datetime import datetime
+from typing import Any, List, Optional, Tuple
+
+from sqlalchemy import String, literal, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+# opaque to clients, the position of the last row of a page
+def encode_cursor(created_at: datetime, row_id: int) -> str:
+    raw = json.dumps([created_at.isoformat(), row_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, row_id = json.loads(raw)
+        return datetime.fromisoformat(created_at), int(row_id)
+    except (ValueError, TypeError) as e:
+        raise InvalidCursor("Invalid cursor") from e
+
+
+# sqlite keeps server_default timestamps as "YYYY-MM-DD HH:MM:SS" text, while a bound
+# datetime is rendered with microseconds, so compare against the same text form
+def _cursor_timestamp(db: AsyncSession, created_at: datetime):
+    if db.get_bind().dialect.name == "sqlite" and created_at.microsecond == 0:
+        return literal(created_at.strftime("%Y-%m-%d %H:%M:%S"), String)
+    return created_at
+
+
+# one page of statement, rows after the cursor; returns (rows, next cursor or None)
+async def keyset_page(
+    db: AsyncSession,
+    statement,
+    model,
+    cursor: Optional[str],
+    limit: int,
+) -> Tuple[List[Any], Optional[str]]:
+    if cursor:
+        created_at, row_id = decode_cursor(cursor)
+        # a row comparison the (session_id, created_at, id) index can seek on
+        statement = statement.where(
+            tuple_(model.created_at, model.id)
+            < tuple_(_cursor_timestamp(db, created_at), row_id)
+        )
+    statement = statement.order_by(model.created_at.desc(), model.id.desc())
+    # one extra row tells whether there is a next page
+    rows = (await db.execute(statement.limit(limit + 1))).all()
+    if len(rows) <= limit:
+        return rows, None
+    last = rows[limit - 1]
+    return rows[:limit], encode_cursor(last.created_at, last.id)
@@ -1,3 +1,50 @@
+# the same shape as StoryLLMResponse in a fraction of the tokens of its JSON schema
+NODE_TYPES = """type Node = {content: string, isEnding: boolean, isWinningEnding: boolean, options?: Option[]}
+type Option = {text: string, nextNode: Node}"""
+
+COMPACT_FORMAT_INSTRUCTIONS = f"""JSON only, no markdown, matching these TypeScript types:
+{NODE_TYPES}
+type Story = {{title: string, rootNode: Node}}
+Ending nodes have no options."""
+
+# fan-out generation, see core/story_fanout.py
+OUTLINE_PROMPT = """
+                You are a creative story writer that creates engaging choose-your-own-adventure stories.
+                Start a branching story: a compelling title, the starting situation (root node) and {branches} options.
+
+                For every option write only the node it leads to: its content, with isEnding and
+                isWinningEnding false and no options. The rest of each branch is written separately.
+
+                Output your story in this exact JSON structure:
+                {format_instructions}
+
+                Don't add any text outside of the JSON structure.
+                """
+
+BRANCH_PROMPT = """
+                You are a creative story writer continuing one branch of a choose-your-own-adventure story.
+
+                Story title: {title}
+                Starting situation: {root}
+                The player chose: {choice}
+                Which led to: {situation}
+
+                Write the rest of this branch as a single node: the situation above, unchanged, with 2-3 options.
+                - Each option leads to another node with its own options, except for ending nodes
+                - The branch should be {depth} levels deep, counting the given situation
+                - Add variety in the path lengths (some end earlier, some later)
+                - {winning}
+
+                Output the node in this exact JSON structure:
+                {format_instructions}
+
+                Don't add any text outside of the JSON structure.
+                """
+
+BRANCH_FORMAT_INSTRUCTIONS = f"""JSON only, no markdown, a single Node matching these TypeScript types:
+{NODE_TYPES}
+Ending nodes have no options."""
+
 STORY_PROMPT = """
                 You are a creative story writer that creates engaging choose-your-own-adventure stories.
                 Generate a complete branching story with multiple paths and endings in the JSON format I'll specify.
@@ -0,0 +1,262 @@
+# removes rows nothing reads any more: finished jobs past their TTL, batches without
+# jobs, old single-flight records, and stories whose generation died half way; every
+# batch of deletes is its own short transaction so writers are never held up for long
+import asyncio
+import gzip
+import json
+import logging
+import os
+import socket
+import time
+from datetime import date, datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from sqlalchemy import delete, exists, func, or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.config import settings
+from core.job_queue import utcnow
+from core.metrics import retention_rows_archived, retention_rows_deleted
+from db.database import AsyncSessionLocal
+from models.batch import StoryBatch
+from models.cache import GenerationFlight, StoryCacheEntry
+from models.job import StoryJob
+from models.story import Story, StoryBlob, StoryNode, StoryOption
+
+logger = logging.getLogger(__name__)
+
+# rows that reference a story, deleted before it in this order
+STORY_DEPENDENTS = (
+    (StoryOption, StoryOption.story_id),
+    (StoryNode, StoryNode.story_id),
+    (StoryBlob, StoryBlob.story_id),
+    (StoryCacheEntry, StoryCacheEntry.story_id),
+)
+
+
+class Retention:
+    # one pass over every kind of expired row, returns the rows removed per table,
+    # or the rows that would be with dry_run
+    @classmethod
+    async def run(
+        cls,
+        dry_run: bool = False,
+        archive_dir: Optional[str] = None,
+        batch_size: Optional[int] = None,
+    ) -> Dict[str, int]:
+        archive_dir = (
+            settings.RETENTION_ARCHIVE_DIR if archive_dir is None else archive_dir
+        )
+        batch_size = batch_size or settings.RETENTION_BATCH_SIZE
+        now = utcnow()
+        removed: Dict[str, int] = {}
+        started = time.perf_counter()
+
+        # job status lookups only ever need recent jobs
+        job_ttls = {
+            "completed": settings.RETENTION_COMPLETED_JOB_TTL_SECONDS,
+            "failed": settings.RETENTION_FAILED_JOB_TTL_SECONDS,
+        }
+        for status, ttl in job_ttls.items():
+            if ttl > 0:
+                await cls._purge(
+                    StoryJob,
+                    StoryJob.id,
+                    [
+                        StoryJob.status == status,
+                        StoryJob.completed_at < now - timedelta(seconds=ttl),
+                    ],
+                    removed,
+                    dry_run,
+                    archive_dir,
+                    batch_size,
+                )
+
+        # a batch goes with its last job; the age keeps it clear of one being enqueued
+        batch_ttl = min((ttl for ttl in job_ttls.values() if ttl > 0), default=0)
+        if batch_ttl > 0:
+            await cls._purge(
+                StoryBatch,
+                StoryBatch.id,
+                [
+                    StoryBatch.created_at < now - timedelta(seconds=batch_ttl),
+                    ~exists().where(StoryJob.batch_id == StoryBatch.batch_id),
+                ],
+                removed,
+                dry_run,
+                archive_dir,
+                batch_size,
+            )
+
+        if settings.RETENTION_FLIGHT_TTL_SECONDS > 0:
+            await cls._purge(
+                GenerationFlight,
+                GenerationFlight.flight_id,
+                [
+                    GenerationFlight.status != "running",
+                    GenerationFlight.created_at
+                    < now - timedelta(seconds=settings.RETENTION_FLIGHT_TTL_SECONDS),
+                ],
+                removed,
+                dry_run,
+                # coordination state, there is nothing in it worth keeping
+                "",
+                batch_size,
+            )
+
+        if settings.RETENTION_ORPHAN_STORY_TTL_SECONDS > 0:
+            await cls._purge(
+                Story,
+                Story.id,
+                cls._orphaned_story_conditions(
+                    now - timedelta(seconds=settings.RETENTION_ORPHAN_STORY_TTL_SECONDS)
+                ),
+                removed,
+                dry_run,
+                archive_dir,
+                batch_size,
+                archive_rows=cls._story_archive_rows,
+                delete_rows=cls._delete_stories,
+            )
+
+        logger.info(
+            "retention %s %s in %.1fs",
+            "would remove" if dry_run else "removed",
+            ", ".join(f"{count} {table}" for table, count in removed.items())
+            or "nothing",
+            time.perf_counter() - started,
+        )
+        return removed
+
+    # stories left behind by a generation that failed or lost its worker: streamed
+    # ones never marked complete, and ones committed before any node was
+    @classmethod
+    def _orphaned_story_conditions(cls, cutoff: datetime) -> list:
+        return [
+            Story.created_at < cutoff,
+            or_(
+                Story.is_complete.is_(False),
+                ~exists().where(StoryNode.story_id == Story.id),
+            ),
+            # a job still working on it could yet finish it
+            ~exists().where(
+                StoryJob.story_id == Story.id,
+                StoryJob.status.in_(("pending", "processing")),
+            ),
+        ]
+
+    # delete the rows matching conditions batch by batch until none are left
+    @classmethod
+    async def _purge(
+        cls,
+        model,
+        key,
+        conditions: list,
+        removed: Dict[str, int],
+        dry_run: bool,
+        archive_dir: str,
+        batch_size: int,
+        archive_rows: Optional[Callable[..., Awaitable[List[dict]]]] = None,
+        delete_rows: Optional[Callable[..., Awaitable[Dict[str, int]]]] = None,
+    ) -> None:
+        table = model.__tablename__
+        if dry_run:
+            async with AsyncSessionLocal() as db:
+                count = await db.scalar(
+                    select(func.count()).select_from(model).where(*conditions)
+                )
+            if count:
+                removed[table] = removed.get(table, 0) + count
+            return
+
+        archive_rows = archive_rows or cls._archive_rows
+        delete_rows = delete_rows or cls._delete_rows
+        while True:
+            async with AsyncSessionLocal() as db:
+                statement = (
+                    select(key).where(*conditions).order_by(key).limit(batch_size)
+                )
+                # postgres: another worker's retention pass keeps the rows it locked
+                if db.get_bind().dialect.name == "postgresql":
+                    statement = statement.with_for_update(skip_locked=True)
+                keys = (await db.execute(statement)).scalars().all()
+                if not keys:
+                    return
+                if archive_dir:
+                    rows = await archive_rows(db, model, key, keys)
+                    await asyncio.to_thread(cls._archive, archive_dir, table, rows)
+                    retention_rows_archived.inc(len(rows), table=table)
+                counts = await delete_rows(db, model, key, keys)
+                await db.commit()
+
+            for name, count in counts.items():
+                removed[name] = removed.get(name, 0) + count
+                retention_rows_deleted.inc(count, table=name)
+            if len(keys) < batch_size:
+                return
+            # let queued writers in between two batches
+            await asyncio.sleep(settings.RETENTION_BATCH_PAUSE_SECONDS)
+
+    @classmethod
+    async def _archive_rows(cls, db: AsyncSession, model, key, keys) -> List[dict]:
+        result = await db.execute(select(model.__table__).where(key.in_(keys)))
+        return [dict(row) for row in result.mappings()]
+
+    # stories are archived with their nodes, the options live in the node JSON
+    @classmethod
+    async def _story_archive_rows(
+        cls, db: AsyncSession, model, key, keys
+    ) -> List[dict]:
+        stories = await cls._archive_rows(db, model, key, keys)
+        result = await db.execute(
+            select(StoryNode.__table__)
+            .where(StoryNode.story_id.in_(keys))
+            .order_by(StoryNode.id)
+        )
+        nodes: Dict[int, List[dict]] = {}
+        for node in result.mappings():
+            nodes.setdefault(node["story_id"], []).append(dict(node))
+        for story in stories:
+            story["nodes"] = nodes.get(story["id"], [])
+        return stories
+
+    @classmethod
+    async def _delete_rows(cls, db: AsyncSession, model, key, keys) -> Dict[str, int]:
+        result = await db.execute(delete(model).where(key.in_(keys)))
+        return {model.__tablename__: result.rowcount}
+
+    @classmethod
+    async def _delete_stories(
+        cls, db: AsyncSession, model, key, keys
+    ) -> Dict[str, int]:
+        counts = {}
+        for dependent, story_id in STORY_DEPENDENTS:
+            result = await db.execute(delete(dependent).where(story_id.in_(keys)))
+            if result.rowcount:
+                counts[dependent.__tablename__] = result.rowcount
+        # failed jobs that reported progress keep their row, not the dangling id
+        await db.execute(
+            update(StoryJob).where(StoryJob.story_id.in_(keys)).values(story_id=None)
+        )
+        counts.update(await cls._delete_rows(db, model, key, keys))
+        return counts
+
+    # append rows to today's file for the table, one gzip member per batch; the host
+    # and pid in the name keep workers sharing a directory out of each other's files
+    @classmethod
+    def _archive(cls, archive_dir: str, table: str, rows: List[dict]) -> None:
+        os.makedirs(archive_dir, exist_ok=True)
+        path = os.path.join(
+            archive_dir,
+            f"{table}-{date.today():%Y%m%d}-{socket.gethostname()}-{os.getpid()}"
+            ".jsonl.gz",
+        )
+        lines = "".join(json.dumps(row, default=_json_default) + "\n" for row in rows)
+        with gzip.open(path, "at", encoding="utf-8") as archive:
+            archive.write(lines)
+
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"cannot archive a {type(value).__name__}")
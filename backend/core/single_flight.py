@@ -0,0 +1,184 @@
+# coalesces concurrent jobs for the same theme onto one LLM generation, across workers
+import asyncio
+import uuid
+from datetime import timedelta, timezone
+from typing import Awaitable, Callable, List, Optional
+
+from sqlalchemy import select, text, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.config import settings
+from core.job_queue import utcnow
+from core.story_blob import StoryBlobs
+from core.story_cache import StoryCache
+from core.story_generator import StoryGenerator
+from db.database import insert_ignore
+from models.cache import GenerationFlight
+from models.story import Story
+
+
+class SingleFlight:
+    # generate the story for a job, or wait for the job already generating this theme
+    @classmethod
+    async def generate(
+        cls,
+        db: AsyncSession,
+        job_id: str,
+        theme: str,
+        session_id: str,
+        on_playable: Optional[Callable[[int], Awaitable[None]]] = None,
+        # only the leader calls the LLM, so only its attempts are recorded
+        attempt_log: Optional[List[dict]] = None,
+        # jobs only share a generation when they prefer the same model
+        model: Optional[str] = None,
+    ) -> Story:
+        flight_key = StoryCache.cache_key(theme, model)
+        error = None
+        for _ in range(settings.SINGLE_FLIGHT_MAX_ROUNDS):
+            flight_id, leader_job_id = await cls._join(db, flight_key, job_id)
+
+            if leader_job_id == job_id:
+                return await cls._lead(
+                    db, flight_id, theme, session_id, on_playable, attempt_log, model
+                )
+
+            story_id, error = await cls._wait(db, flight_id)
+            if story_id is not None:
+                story = await StoryCache.clone_story(db, story_id, session_id)
+                if story is not None:
+                    await StoryBlobs.materialize(db, story)
+                    await db.commit()
+                    return story
+            # the leader failed or vanished, run the election again
+        raise RuntimeError(error or "Shared story generation failed")
+
+    # push the flight lease forward for flights led by these jobs
+    @classmethod
+    async def renew(cls, db: AsyncSession, job_ids: List[str]) -> None:
+        if not job_ids:
+            return
+        await db.execute(
+            update(GenerationFlight)
+            .where(
+                GenerationFlight.leader_job_id.in_(job_ids),
+                GenerationFlight.status == "running",
+            )
+            .values(expires_at=cls._lease_expiry())
+        )
+        await db.commit()
+
+    # become leader of the running flight for this key, or learn who is
+    @classmethod
+    async def _join(cls, db: AsyncSession, flight_key: str, job_id: str):
+        # a leader that stopped renewing no longer blocks the key
+        await db.execute(
+            update(GenerationFlight)
+            .where(
+                GenerationFlight.flight_key == flight_key,
+                GenerationFlight.status == "running",
+                GenerationFlight.expires_at < utcnow(),
+            )
+            .values(status="failed", error="Generation leader stopped responding")
+        )
+        await db.execute(
+            insert_ignore(
+                db.get_bind().dialect.name,
+                GenerationFlight,
+                {
+                    "flight_id": str(uuid.uuid4()),
+                    "flight_key": flight_key,
+                    "leader_job_id": job_id,
+                    "status": "running",
+                    "expires_at": cls._lease_expiry(),
+                },
+                index_elements=["flight_key"],
+                index_where=text("status = 'running'"),
+            )
+        )
+        row = (
+            await db.execute(
+                select(
+                    GenerationFlight.flight_id, GenerationFlight.leader_job_id
+                ).where(
+                    GenerationFlight.flight_key == flight_key,
+                    GenerationFlight.status == "running",
+                )
+            )
+        ).first()
+        await db.commit()
+        # the running flight finished between the insert and the select
+        if row is None:
+            return await cls._join(db, flight_key, job_id)
+        return row.flight_id, row.leader_job_id
+
+    @classmethod
+    async def _lead(
+        cls,
+        db: AsyncSession,
+        flight_id: str,
+        theme: str,
+        session_id: str,
+        on_playable: Optional[Callable[[int], Awaitable[None]]],
+        attempt_log: Optional[List[dict]] = None,
+        model: Optional[str] = None,
+    ) -> Story:
+        try:
+            story = await StoryGenerator.agenerate_story(
+                db,
+                session_id,
+                theme,
+                on_playable,
+                attempt_log=attempt_log,
+                model=model,
+            )
+        except Exception as e:
+            await db.rollback()
+            await cls._finish(db, flight_id, status="failed", error=str(e))
+            raise
+        await cls._finish(db, flight_id, status="completed", story_id=story.id)
+        return story
+
+    # poll the flight until it ends, returns (story_id, error)
+    @classmethod
+    async def _wait(cls, db: AsyncSession, flight_id: str):
+        while True:
+            row = (
+                await db.execute(
+                    select(
+                        GenerationFlight.status,
+                        GenerationFlight.story_id,
+                        GenerationFlight.error,
+                        GenerationFlight.expires_at,
+                    ).where(GenerationFlight.flight_id == flight_id)
+                )
+            ).first()
+            # end the read transaction so the next poll sees fresh data
+            await db.commit()
+
+            if row is None or row.status == "failed":
+                return None, row.error if row else None
+            if row.status == "completed":
+                return row.story_id, None
+            if cls._as_utc(row.expires_at) < utcnow():
+                return None, "Generation leader stopped responding"
+            await asyncio.sleep(settings.SINGLE_FLIGHT_POLL_INTERVAL)
+
+    @classmethod
+    async def _finish(cls, db: AsyncSession, flight_id: str, **values) -> None:
+        await db.execute(
+            update(GenerationFlight)
+            .where(GenerationFlight.flight_id == flight_id)
+            .values(**values)
+        )
+        await db.commit()
+
+    @classmethod
+    def _lease_expiry(cls):
+        return utcnow() + timedelta(seconds=settings.JOB_LEASE_SECONDS)
+
+    # sqlite hands datetimes back without a timezone, they are stored as UTC
+    @classmethod
+    def _as_utc(cls, value):
+        if value.tzinfo is None:
+            return value.replace(tzinfo=timezone.utc)
+        return value
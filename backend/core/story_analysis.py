@@ -0,0 +1,139 @@
+# checks a generated story before it is stored and computes the stats kept on Story
+from collections import deque
+from typing import Any, Dict, List, Optional
+
+from core.config import settings
+
+# Story columns filled in from StoryAnalyzer.stats
+STORY_STATS_FIELDS = (
+    "depth",
+    "node_count",
+    "ending_count",
+    "winning_ending_count",
+    "shortest_winning_path",
+)
+
+
+# a story that parsed but breaks the rules, retried like an unparsable answer
+class StoryValidationError(ValueError):
+    def __init__(self, problems: List[str]):
+        super().__init__("; ".join(problems))
+        self.problems = problems
+
+
+class StoryAnalyzer:
+    # stats of a story flattened by flatten_story_tree, the root first
+    @classmethod
+    def stats(cls, flat: List[Dict[str, Any]]) -> Dict[str, Optional[int]]:
+        # breadth first, so the first winning ending found is the nearest one
+        depths = {0: 1}
+        queue = deque([0])
+        shortest_winning_path = None
+        while queue:
+            index = queue.popleft()
+            entry = flat[index]
+            if (
+                shortest_winning_path is None
+                and entry["is_ending"]
+                and entry["is_winning_ending"]
+            ):
+                shortest_winning_path = depths[index]
+            for _, child in entry["children"]:
+                if child is not None and child not in depths:
+                    depths[child] = depths[index] + 1
+                    queue.append(child)
+        return {
+            # levels including the root
+            "depth": max(depths.values()),
+            "node_count": len(flat),
+            "ending_count": sum(1 for entry in flat if entry["is_ending"]),
+            "winning_ending_count": sum(
+                1 for entry in flat if entry["is_ending"] and entry["is_winning_ending"]
+            ),
+            # nodes from the root to the nearest winning ending, both included
+            "shortest_winning_path": shortest_winning_path,
+        }
+
+    # what is wrong with the story, empty when it can be stored
+    @classmethod
+    def problems(
+        cls,
+        flat: List[Dict[str, Any]],
+        min_depth: Optional[int] = None,
+        require_winning: Optional[bool] = None,
+    ) -> List[str]:
+        min_depth = settings.STORY_MIN_DEPTH if min_depth is None else min_depth
+        if require_winning is None:
+            require_winning = settings.STORY_REQUIRE_WINNING_ENDING
+        stats = cls.stats(flat)
+        problems = []
+        if stats["depth"] < min_depth:
+            problems.append(
+                f"the story is {stats['depth']} levels deep, {min_depth} are required"
+            )
+        if require_winning and stats["shortest_winning_path"] is None:
+            problems.append("no path leads to a winning ending")
+
+        min_options = settings.STORY_MIN_OPTIONS
+        max_options = settings.STORY_MAX_OPTIONS
+        wrong_options = sum(
+            1
+            for entry in flat
+            if not entry["is_ending"]
+            and not min_options <= len(entry["children"]) <= max_options
+        )
+        if wrong_options:
+            problems.append(
+                f"{wrong_options} non-ending node(s) without "
+                f"{min_options}-{max_options} options"
+            )
+        winning_non_endings = sum(
+            1 for entry in flat if entry["is_winning_ending"] and not entry["is_ending"]
+        )
+        if winning_non_endings:
+            problems.append(
+                f"{winning_non_endings} winning node(s) that are not endings"
+            )
+        return problems
+
+    # raise StoryValidationError when the story breaks the rules
+    @classmethod
+    def validate(
+        cls,
+        flat: List[Dict[str, Any]],
+        min_depth: Optional[int] = None,
+        require_winning: Optional[bool] = None,
+    ) -> None:
+        if not settings.STORY_VALIDATION_ENABLED:
+            return
+        problems = cls.problems(flat, min_depth, require_winning)
+        if problems:
+            raise StoryValidationError(problems)
+
+
+# stored nodes in the shape flatten_story_tree returns, for stories written before
+# stats existed; options from story_options replace the JSON column when given
+def flat_from_nodes(
+    nodes: List[Any], options: Optional[Dict[int, List[dict]]] = None
+) -> List[Dict[str, Any]]:
+    # the root goes first, the rest keep their order
+    ordered = sorted(nodes, key=lambda node: not node.is_root)
+    positions = {node.id: index for index, node in enumerate(ordered)}
+    flat = []
+    for node in ordered:
+        node_options = (
+            options.get(node.id, []) if options is not None else node.options or []
+        )
+        flat.append(
+            {
+                "content": node.content,
+                "is_root": node.is_root,
+                "is_ending": bool(node.is_ending),
+                "is_winning_ending": bool(node.is_winning_ending),
+                "children": [
+                    (option["text"], positions.get(option["node_id"]))
+                    for option in node_options
+                ],
+            }
+        )
+    return flat
@@ -0,0 +1,86 @@
+# stores the finished JSON of a story so reads skip the ORM and Pydantic
+import gzip
+import hashlib
+from typing import Dict, List, Optional
+
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.config import settings
+from core.story_analysis import STORY_STATS_FIELDS
+from models.story import Story, StoryBlob, StoryNode
+from schemas.story import (
+    CompleteStoryNodeResponse,
+    CompleteStoryResponse,
+    StoryOptionsSchema,
+)
+
+
+# CompleteStoryResponse for a story and its nodes, None when there is no root node;
+# options from story_options replace the JSON column when given
+def story_response_from_nodes(
+    story: Story,
+    nodes: List[StoryNode],
+    options: Optional[Dict[int, List[dict]]] = None,
+) -> Optional[CompleteStoryResponse]:
+    # for every node in nodes create a response object
+    # store it in node_dict using the nodes id as the key
+    node_dict = {
+        node.id: CompleteStoryNodeResponse.model_validate(node) for node in nodes
+    }
+    if options is not None:
+        for node_id, response in node_dict.items():
+            response.options = [
+                StoryOptionsSchema(**option) for option in options.get(node_id, [])
+            ]
+    # search for node that is the root node
+    root_node = next((node for node in nodes if node.is_root), None)
+    if not root_node:
+        return None
+
+    return CompleteStoryResponse(
+        id=story.id,
+        title=story.title,
+        session_id=story.session_id,
+        created_at=story.created_at,
+        root_node=node_dict[root_node.id],
+        all_nodes=node_dict,
+        **{field: getattr(story, field) for field in STORY_STATS_FIELDS},
+    )
+
+
+def json_etag(body: bytes) -> str:
+    return f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+
+
+class StoryBlobs:
+    # serialize a finished story into story_blobs, the caller commits
+    @classmethod
+    async def materialize(cls, db: AsyncSession, story: Story) -> Optional[StoryBlob]:
+        # created_at is filled in by the database
+        await db.refresh(story)
+        result = await db.execute(
+            select(StoryNode).where(StoryNode.story_id == story.id)
+        )
+        response = story_response_from_nodes(story, result.scalars().all())
+        if response is None:
+            return None
+
+        body = response.model_dump_json().encode("utf-8")
+        blob = await db.get(StoryBlob, story.id) or StoryBlob(story_id=story.id)
+        blob.etag = json_etag(body)
+        if settings.STORY_BLOB_COMPRESSION:
+            blob.payload = gzip.compress(body, compresslevel=6)
+            blob.encoding = "gzip"
+        else:
+            blob.payload = body
+            blob.encoding = "identity"
+        db.add(blob)
+        return blob
+
+    # the stored JSON, decompressed, for clients that do not accept gzip
+    @classmethod
+    def decoded_payload(cls, encoding: str, payload: bytes) -> bytes:
+        if encoding == "gzip":
+            return gzip.decompress(payload)
+        return payload
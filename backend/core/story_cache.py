@@ -0,0 +1,213 @@
+# content-addressed cache of generated stories, keyed by normalized theme
+import hashlib
+import re
+from datetime import timedelta
+from typing import Dict, Optional
+
+from sqlalchemy import delete, func, insert, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.config import settings
+from core.job_queue import utcnow
+from core.prompts import STORY_PROMPT
+from core.story_analysis import STORY_STATS_FIELDS
+from core.story_graph import StoryGraph
+from core.story_tree import areserve_node_ids, clone_node_rows
+from db.database import insert_ignore
+from models.cache import StoryCacheEntry, StoryCacheKey
+from models.story import Story, StoryNode
+
+
+# "  Space   Pirates! " and "space pirates" share a key
+def normalize_theme(theme: str) -> str:
+    theme = re.sub(r"[^\w\s-]", "", theme.lower())
+    return " ".join(theme.split())
+
+
+class StoryCache:
+    # hash of everything that shapes the generated story
+    @classmethod
+    def cache_key(cls, theme: str, model: Optional[str] = None) -> str:
+        key_source = "\0".join(
+            [
+                normalize_theme(theme),
+                STORY_PROMPT,
+                settings.LLM_PROMPT_FORMAT,
+                # fan-out stories are deeper than single-call ones
+                "fanout" if settings.STORY_FANOUT_ENABLED else "single",
+                model or settings.LLM_MODEL,
+            ]
+        )
+        return hashlib.sha256(key_source.encode("utf-8")).hexdigest()
+
+    # clone a cached story for the session, None on a miss
+    @classmethod
+    async def get_story(
+        cls,
+        db: AsyncSession,
+        theme: str,
+        session_id: str,
+        model: Optional[str] = None,
+    ) -> Optional[Story]:
+        cache_key = cls.cache_key(theme, model)
+        await cls._ensure_key(db, cache_key, normalize_theme(theme))
+        now = utcnow()
+
+        # only serve from a key once its pool holds enough distinct stories
+        result = await db.execute(
+            select(StoryCacheEntry).where(
+                StoryCacheEntry.cache_key == cache_key,
+                StoryCacheEntry.created_at
+                > now - timedelta(seconds=settings.STORY_CACHE_TTL_SECONDS),
+            )
+            # least recently served first, spreads requests across the pool
+            .order_by(
+                StoryCacheEntry.last_used_at.is_not(None),
+                StoryCacheEntry.last_used_at,
+            )
+        )
+        entries = result.scalars().all()
+
+        story = None
+        if len(entries) >= settings.STORY_CACHE_POOL_SIZE:
+            entry = entries[0]
+            story = await cls.clone_story(db, entry.story_id, session_id)
+            if story is None:
+                # the source story is gone, drop the entry
+                await db.delete(entry)
+            else:
+                entry.last_used_at = now
+
+        counter = StoryCacheKey.hits if story else StoryCacheKey.misses
+        await db.execute(
+            update(StoryCacheKey)
+            .where(StoryCacheKey.cache_key == cache_key)
+            .values({counter: func.coalesce(counter, 0) + 1, "last_used_at": now})
+        )
+        return story
+
+    # add a freshly generated story to the pool of its theme
+    @classmethod
+    async def add_story(
+        cls, db: AsyncSession, theme: str, story_id: int, model: Optional[str] = None
+    ) -> None:
+        cache_key = cls.cache_key(theme, model)
+        await cls._ensure_key(db, cache_key, normalize_theme(theme))
+        db.add(StoryCacheEntry(cache_key=cache_key, story_id=story_id))
+        await cls._evict(db, cache_key)
+
+    # expired entries of this key and least recently used keys past the limit
+    @classmethod
+    async def _evict(cls, db: AsyncSession, cache_key: str) -> None:
+        now = utcnow()
+        await db.execute(
+            delete(StoryCacheEntry).where(
+                StoryCacheEntry.cache_key == cache_key,
+                StoryCacheEntry.created_at
+                < now - timedelta(seconds=settings.STORY_CACHE_TTL_SECONDS),
+            )
+        )
+
+        key_count = await db.scalar(select(func.count()).select_from(StoryCacheKey))
+        overflow = key_count - settings.STORY_CACHE_MAX_KEYS
+        if overflow <= 0:
+            return
+        result = await db.execute(
+            select(StoryCacheKey.cache_key)
+            .where(StoryCacheKey.cache_key != cache_key)
+            .order_by(StoryCacheKey.last_used_at)
+            .limit(overflow)
+        )
+        evicted_keys = result.scalars().all()
+        await db.execute(
+            delete(StoryCacheEntry).where(StoryCacheEntry.cache_key.in_(evicted_keys))
+        )
+        await db.execute(
+            delete(StoryCacheKey).where(StoryCacheKey.cache_key.in_(evicted_keys))
+        )
+
+    # insert the key row once, concurrent workers may race on it
+    @classmethod
+    async def _ensure_key(cls, db: AsyncSession, cache_key: str, theme: str) -> None:
+        if await db.get(StoryCacheKey, cache_key) is not None:
+            return
+        await db.execute(
+            insert_ignore(
+                db.get_bind().dialect.name,
+                StoryCacheKey,
+                {
+                    "cache_key": cache_key,
+                    "theme": theme,
+                    "hits": 0,
+                    "misses": 0,
+                    "last_used_at": utcnow(),
+                },
+                index_elements=["cache_key"],
+            )
+        )
+
+    # copy a stored story and its nodes into a new story owned by session_id
+    @classmethod
+    async def clone_story(
+        cls, db: AsyncSession, source_story_id: int, session_id: str
+    ) -> Optional[Story]:
+        source = await db.get(Story, source_story_id)
+        result = await db.execute(
+            select(StoryNode)
+            .where(StoryNode.story_id == source_story_id)
+            .order_by(StoryNode.id)
+        )
+        nodes = result.scalars().all()
+        if source is None or not nodes:
+            return None
+
+        story_db = Story(
+            title=source.title,
+            session_id=session_id,
+            **{field: getattr(source, field) for field in STORY_STATS_FIELDS},
+        )
+        db.add(story_db)
+        await db.flush()
+
+        node_ids = await areserve_node_ids(db, len(nodes))
+        if node_ids is None:
+            # no id reservation for this dialect, let the database assign them
+            clones = [
+                StoryNode(
+                    story_id=story_db.id,
+                    content=node.content,
+                    is_root=node.is_root,
+                    is_ending=node.is_ending,
+                    is_winning_ending=node.is_winning_ending,
+                    options=[],
+                )
+                for node in nodes
+            ]
+            db.add_all(clones)
+            await db.flush()
+            node_ids = [clone.id for clone in clones]
+            rows = clone_node_rows(nodes, story_db.id, node_ids)
+            for clone, row in zip(clones, rows):
+                clone.options = row["options"]
+        else:
+            rows = clone_node_rows(nodes, story_db.id, node_ids)
+            await db.execute(insert(StoryNode).values(rows))
+        await StoryGraph.awrite_options(
+            db, story_db.id, ((row["id"], row["options"]) for row in rows)
+        )
+        return story_db
+
+    # counters summed over every key, shared by all API and worker processes
+    @classmethod
+    async def stats(cls, db: AsyncSession) -> Dict[str, int]:
+        row = (
+            await db.execute(
+                select(
+                    func.count(StoryCacheKey.cache_key),
+                    func.coalesce(func.sum(StoryCacheKey.hits), 0),
+                    func.coalesce(func.sum(StoryCacheKey.misses), 0),
+                )
+            )
+        ).one()
+        entries = await db.scalar(select(func.count()).select_from(StoryCacheEntry))
+        return {"keys": row[0], "entries": entries, "hits": row[1], "misses": row[2]}
@@ -0,0 +1,135 @@
+# larger stories from several smaller LLM calls: an outline first, then every
+# first-level branch at the same time, so latency follows the longest branch
+import asyncio
+import functools
+import inspect
+from typing import Dict, List, Optional
+
+from langchain_core.output_parsers import PydanticOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+
+from core.config import settings
+from core.llm_policy import LLMCallPolicy
+from core.models import StoryLLMResponse, StoryNodeLLM
+from core.prompts import (
+    BRANCH_FORMAT_INSTRUCTIONS,
+    BRANCH_PROMPT,
+    COMPACT_FORMAT_INSTRUCTIONS,
+    OUTLINE_PROMPT,
+)
+from core.story_analysis import StoryAnalyzer
+from core.story_tree import flatten_story_tree
+
+
+class StoryFanout:
+    # built once and shared, like StoryGenerator's prompt and parser
+    _prompts: Dict[str, ChatPromptTemplate] = {}
+    _story_parser = PydanticOutputParser(pydantic_object=StoryLLMResponse)
+    _node_parser = PydanticOutputParser(pydantic_object=StoryNodeLLM)
+
+    # outline, then all branches, stitched into one story
+    @classmethod
+    async def agenerate(
+        cls, llm, theme: str, attempt_log: Optional[List[dict]] = None
+    ) -> StoryLLMResponse:
+        outline = await LLMCallPolicy.ainvoke_parsed(
+            llm,
+            cls._prompt("outline").invoke(
+                {"theme": theme, "branches": settings.STORY_FANOUT_BRANCHES}
+            ),
+            cls._parse_outline,
+            attempt_log,
+            call="outline",
+        )
+        root = outline.rootNode
+        options = root.options
+
+        # at most STORY_FANOUT_CONCURRENCY branch calls in flight
+        semaphore = asyncio.Semaphore(settings.STORY_FANOUT_CONCURRENCY)
+
+        async def branch(index: int) -> StoryNodeLLM:
+            option = options[index]
+            messages = cls._prompt("branch").invoke(
+                {
+                    "theme": theme,
+                    "title": outline.title,
+                    "root": root.content,
+                    "choice": option.text,
+                    "situation": option.nextNode.get("content", ""),
+                    "depth": settings.STORY_FANOUT_BRANCH_DEPTH,
+                    # the first branch carries the winning path the story needs
+                    "winning": (
+                        "Include at least one winning ending in this branch"
+                        if index == 0
+                        else "Endings in this branch may be winning or losing"
+                    ),
+                }
+            )
+            async with semaphore:
+                return await LLMCallPolicy.ainvoke_parsed(
+                    llm,
+                    messages,
+                    functools.partial(cls._parse_branch, winning=index == 0),
+                    attempt_log,
+                    call=f"branch {index + 1}",
+                )
+
+        tasks = [asyncio.create_task(branch(i)) for i in range(len(options))]
+        try:
+            branches = await asyncio.gather(*tasks)
+        except BaseException:
+            # one failed branch fails the story, stop paying for the others
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+        # each branch replaces the node its option pointed at, the rest of the
+        # pipeline only ever sees one nested story
+        for option, subtree in zip(options, branches):
+            option.nextNode = subtree.model_dump()
+        return outline
+
+    @classmethod
+    def _prompt(cls, kind: str) -> ChatPromptTemplate:
+        if kind not in cls._prompts:
+            if kind == "outline":
+                system, instructions = OUTLINE_PROMPT, COMPACT_FORMAT_INSTRUCTIONS
+            else:
+                system, instructions = BRANCH_PROMPT, BRANCH_FORMAT_INSTRUCTIONS
+            cls._prompts[kind] = ChatPromptTemplate.from_messages(
+                [
+                    ("system", inspect.cleandoc(system)),
+                    ("human", "The story theme: {theme}"),
+                ]
+            ).partial(format_instructions=instructions)
+        return cls._prompts[kind]
+
+    @classmethod
+    def _parse_outline(cls, raw_response) -> StoryLLMResponse:
+        text = (
+            raw_response.content if hasattr(raw_response, "content") else raw_response
+        )
+        outline = cls._story_parser.parse(text)
+        if outline.rootNode.isEnding or not outline.rootNode.options:
+            raise ValueError("The story outline has no options to branch from")
+        for option in outline.rootNode.options:
+            StoryNodeLLM.model_validate(option.nextNode)
+        return outline
+
+    # a branch that breaks the story rules is regenerated on its own; branches are one
+    # level below the root and only the first must reach a winning ending
+    @classmethod
+    def _parse_branch(cls, raw_response, winning: bool = False) -> StoryNodeLLM:
+        text = (
+            raw_response.content if hasattr(raw_response, "content") else raw_response
+        )
+        subtree = cls._node_parser.parse(text)
+        # validates every nested node, a cut off branch is retried
+        flat = flatten_story_tree(subtree)
+        StoryAnalyzer.validate(
+            flat,
+            min_depth=max(settings.STORY_MIN_DEPTH - 1, 1),
+            require_winning=winning and settings.STORY_REQUIRE_WINNING_ENDING,
+        )
+        return subtree
@@ -1,8 +1,5 @@
 # interacting with the database
-from sqlalchemy.orm import Session
-
-# class to interact with OpenAI chat models
-from langchain_openai import ChatOpenAI
+from sqlalchemy.ext.asyncio import AsyncSession
 
 # define templates for the prompts
 from langchain_core.prompts import ChatPromptTemplate
@@ -11,52 +8,327 @@ from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import PydanticOutputParser
 
 # prompt template
-from core.prompts import STORY_PROMPT
+from core.prompts import COMPACT_FORMAT_INSTRUCTIONS, STORY_PROMPT
+from core.config import settings
+from core.story_cache import StoryCache
+from core.story_blob import StoryBlobs
+from core.metrics import generation_stage_seconds, record_token_usage
+from core.llm_policy import LLMCallFailed, LLMCallPolicy
+from core.llm_router import llm_router
+from core.story_fanout import StoryFanout
+from core.story_analysis import StoryAnalyzer
+from core.story_graph import StoryGraph
+
+from sqlalchemy import delete, insert, select, update
 
 # SQLAlchemy model representing the story table in the database
-from models.story import Story, StoryNode
+from models.job import StoryJob
+from models.story import Story, StoryNode, StoryOption
+from core.story_tree import (
+    areserve_node_ids,
+    build_node_rows,
+    flatten_story_tree,
+)
 from core.models import StoryLLMResponse, StoryNodeLLM
+from core.streaming_json import JsonEventParser
+from core.story_streaming import StreamingStoryBuilder
 from dotenv import load_dotenv
+import asyncio
+import inspect
+import logging
 import os
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 
 # defines a class to handle story generation logic
 class StoryGenerator:
+    # built once per configuration and shared by every generation
+    _prompts: Dict[str, ChatPromptTemplate] = {}
+    _story_parser: Optional[PydanticOutputParser] = None
+
+    # calls go through the router, which keeps one client per provider;
+    # model prefers the provider with that name or model
     @classmethod
-    def _get_llm(cls):
-        return ChatOpenAI(
-            model="gpt-4o-mini",
-        )
+    def _get_llm(cls, model: Optional[str] = None):
+        return llm_router.llm(model)
 
-    # returns an instance of ChatOpenAI
+    # generate a story and save it into the database, the LLM call does not hold a thread
     @classmethod
-    # generate a story and save it into the database
-    def generate_story(
-        # SQLAlchemy Session for database operations,
-        # Identifier for this story session, theme
+    async def agenerate_story(
         cls,
-        db: Session,
+        db: AsyncSession,
         session_id: str,
         theme: str = "fantasy",
+        # streaming mode calls this with the story id once the root is playable
+        on_playable: Optional[Callable[[int], Awaitable[None]]] = None,
+        # warm pool generations are stored unassigned under this key
+        pool_key: Optional[str] = None,
+        # receives one entry per LLM attempt
+        attempt_log: Optional[List[dict]] = None,
+        # preferred provider name or model, see LLMRouter
+        model: Optional[str] = None,
+    ) -> Story:
+        # repeated themes are cloned from a stored story, no LLM call needed
+        if settings.STORY_CACHE_ENABLED and pool_key is None:
+            with generation_stage_seconds.timer(stage="cache_lookup"):
+                story_db = await StoryCache.get_story(db, theme, session_id, model)
+                if story_db is not None:
+                    await StoryBlobs.materialize(db, story_db)
+                await db.commit()
+            if story_db is not None:
+                return story_db
+
+        with generation_stage_seconds.timer(stage="prompt"):
+            llm = cls._get_llm(model)
+            messages, story_parser = cls._build_prompt(theme)
+
+        # no connection is held during the LLM round trip, persisting checks one out again
+        await db.commit()
+
+        # nobody is waiting on a pooled story, so it is not streamed
+        if (
+            settings.STORY_STREAMING_ENABLED
+            and not settings.STORY_FANOUT_ENABLED
+            and pool_key is None
+        ):
+            story_db = await cls._agenerate_streaming(
+                db, session_id, llm, messages, story_parser, on_playable, attempt_log
+            )
+        else:
+            if settings.STORY_FANOUT_ENABLED:
+                # outline first, then the branches concurrently
+                story_structure = await StoryFanout.agenerate(llm, theme, attempt_log)
+            else:
+                # awaits the LLM without blocking the event loop, retrying bad answers
+                story_structure = await LLMCallPolicy.ainvoke_parsed(
+                    llm, messages, cls._timed_parser(story_parser), attempt_log
+                )
+
+            with generation_stage_seconds.timer(stage="persist"):
+                story_db = await cls._apersist_story(db, session_id, story_structure)
+
+        if pool_key is not None:
+            # the blob is written when a session claims the story
+            story_db.pool_key = pool_key
+            await db.commit()
+            return story_db
+
+        with generation_stage_seconds.timer(stage="finalize"):
+            if settings.STORY_CACHE_ENABLED:
+                await StoryCache.add_story(db, theme, story_db.id, model)
+            # stored JSON so /complete never rebuilds the tree
+            await StoryBlobs.materialize(db, story_db)
+            await db.commit()
+        return story_db
+
+    # persist nodes while the LLM streams so the root is playable early
+    @classmethod
+    async def _agenerate_streaming(
+        cls,
+        db: AsyncSession,
+        session_id: str,
+        llm,
+        messages,
+        story_parser,
+        on_playable: Optional[Callable[[int], Awaitable[None]]],
+        attempt_log: Optional[List[dict]] = None,
     ) -> Story:
-        # get the LLM calls the private method
-        llm = cls._get_llm()
-        # ensures LLM ouput is parsed into the StoryLLMReponse Pydantic model
-        story_parser = PydanticOutputParser(pydantic_object=StoryLLMResponse)
-        # creates a chat-style prompt with system instructions and user input
-        prompt = ChatPromptTemplate.from_messages(
-            [
-                ("system", STORY_PROMPT),
-                ("human", f"Create the story with this theme: {theme}"),
-            ]
-            # inserts the format instructions so the LLM knows to output JSON conforming to StoryLLMReponse
-        ).partial(format_instructions=story_parser.get_format_instructions())
-
-        # sends the prompt to the LLM and stores the response in raw_response
-        raw_response = llm.invoke(prompt.invoke({}))
+        started = time.perf_counter()
+        playable_after = None
+        attempt_log = attempt_log if attempt_log is not None else []
+
+        async def playable(story_id: int):
+            nonlocal playable_after
+            playable_after = time.perf_counter() - started
+            if on_playable is not None:
+                await on_playable(story_id)
 
+        for attempt in range(1, settings.LLM_MAX_ATTEMPTS + 1):
+            attempt_started = time.perf_counter()
+            record = {"attempt": attempt, "hedged": False, "repaired": False}
+            builder = StreamingStoryBuilder(db, session_id, on_playable=playable)
+            json_parser = JsonEventParser()
+            chunks = []
+            try:
+                async with asyncio.timeout(settings.LLM_TIMEOUT_SECONDS):
+                    async for chunk in llm.astream(messages):
+                        # providers report usage on a last chunk without content
+                        record_token_usage(chunk)
+                        text = chunk.content if hasattr(chunk, "content") else chunk
+                        if not text:
+                            continue
+                        chunks.append(text)
+                        await builder.handle(json_parser.feed(text))
+
+                # the full answer must still be a valid story
+                story_structure, record["repaired"] = LLMCallPolicy.parse_with_repair(
+                    story_parser.parse, "".join(chunks)
+                )
+                flat = flatten_story_tree(cls._root_node(story_structure))
+                # players may already be in this story, so rule breaks are only logged
+                problems = (
+                    StoryAnalyzer.problems(flat)
+                    if settings.STORY_VALIDATION_ENABLED
+                    else []
+                )
+                if problems and builder.story is not None:
+                    logger.warning(
+                        "streamed story %s kept despite: %s",
+                        builder.story.id,
+                        "; ".join(problems),
+                    )
+                await builder.sync(final=True, stats=StoryAnalyzer.stats(flat))
+                if builder.story is None:
+                    raise ValueError("The LLM response did not contain a story")
+                LLMCallPolicy.record_attempt(attempt_log, record, attempt_started, "ok")
+                break
+            except Exception as e:
+                cause = LLMCallPolicy.classify(e)
+                LLMCallPolicy.record_attempt(
+                    attempt_log, record, attempt_started, cause, e
+                )
+                # a half written story is dropped, the next attempt streams a new one
+                # and reports it as playable again
+                partial_id = builder.story.id if builder.story is not None else None
+                await db.rollback()
+                if partial_id is not None:
+                    await cls._discard_partial_story(db, partial_id)
+                if cause == "error" or attempt == settings.LLM_MAX_ATTEMPTS:
+                    raise LLMCallFailed(
+                        f"LLM call failed after {attempt} attempt(s): {cause}: {e}",
+                        attempt_log,
+                    ) from e
+                await asyncio.sleep(LLMCallPolicy.backoff(attempt))
+
+        # nodes are persisted while streaming, so this covers llm and persist together
+        generation_stage_seconds.observe(time.perf_counter() - started, stage="stream")
+        if playable_after is not None:
+            generation_stage_seconds.observe(playable_after, stage="playable")
+        logger.info(
+            "story %s playable after %.2fs, complete after %.2fs",
+            builder.story.id,
+            playable_after or 0.0,
+            time.perf_counter() - started,
+        )
+        return builder.story
+
+    # delete what a failed stream stored, the job stops pointing at it
+    @classmethod
+    async def _discard_partial_story(cls, db: AsyncSession, story_id: int) -> None:
+        try:
+            await db.execute(
+                update(StoryJob)
+                .where(StoryJob.story_id == story_id)
+                .values(story_id=None)
+            )
+            await db.execute(
+                delete(StoryOption).where(StoryOption.story_id == story_id)
+            )
+            await db.execute(delete(StoryNode).where(StoryNode.story_id == story_id))
+            await db.execute(delete(Story).where(Story.id == story_id))
+            await db.commit()
+        except Exception:
+            # left incomplete, retention removes it later
+            await db.rollback()
+            logger.exception("could not discard partial story %s", story_id)
+
+    # write the story and all of its nodes: story insert, id reservation, one node insert
+    @classmethod
+    async def _apersist_story(
+        cls, db: AsyncSession, session_id: str, story_structure: StoryLLMResponse
+    ) -> Story:
+        root_node = cls._root_node(story_structure)
+        flat = flatten_story_tree(root_node)
+        # create a new Story object for the database, stats are only computed here
+        story_db = Story(
+            title=story_structure.title,
+            session_id=session_id,
+            **StoryAnalyzer.stats(flat),
+        )
+        # adds it to the session
+        db.add(story_db)
+        # ensures the object gets an ID immediately so you can link child nodes later
+        await db.flush()
+
+        node_ids = await areserve_node_ids(db, len(flat))
+        # unknown dialect, fall back to one insert per node
+        if node_ids is None:
+            await cls._aprocess_story_node(db, story_db.id, root_node, is_root=True)
+            result = await db.execute(
+                select(StoryNode.id, StoryNode.options).where(
+                    StoryNode.story_id == story_db.id
+                )
+            )
+            await StoryGraph.awrite_options(db, story_db.id, result.all())
+            return story_db
+
+        rows = build_node_rows(flat, story_db.id, node_ids)
+        await db.execute(insert(StoryNode).values(rows))
+        await StoryGraph.awrite_options(
+            db, story_db.id, ((row["id"], row["options"]) for row in rows)
+        )
+        return story_db
+
+    # ensures LLM ouput is parsed into the StoryLLMReponse Pydantic model
+    @classmethod
+    def _get_story_parser(cls) -> PydanticOutputParser:
+        if cls._story_parser is None:
+            cls._story_parser = PydanticOutputParser(pydantic_object=StoryLLMResponse)
+        return cls._story_parser
+
+    # how the answer's JSON shape is described to the LLM
+    @classmethod
+    def format_instructions(cls, prompt_format: Optional[str] = None) -> str:
+        if (prompt_format or settings.LLM_PROMPT_FORMAT) == "schema":
+            # the full JSON schema of StoryLLMResponse, several times longer
+            return cls._get_story_parser().get_format_instructions()
+        return COMPACT_FORMAT_INSTRUCTIONS
+
+    # chat-style prompt with system instructions and the theme as its only input
+    @classmethod
+    def _get_prompt_template(
+        cls, prompt_format: Optional[str] = None
+    ) -> ChatPromptTemplate:
+        prompt_format = prompt_format or settings.LLM_PROMPT_FORMAT
+        if prompt_format not in cls._prompts:
+            cls._prompts[prompt_format] = ChatPromptTemplate.from_messages(
+                [
+                    # the indentation of the source file is only wasted tokens
+                    ("system", inspect.cleandoc(STORY_PROMPT)),
+                    ("human", "Create the story with this theme: {theme}"),
+                ]
+                # inserts the format instructions so the LLM knows what JSON to output
+            ).partial(format_instructions=cls.format_instructions(prompt_format))
+        return cls._prompts[prompt_format]
+
+    # the prompt messages for a theme and the parser used to read the answer
+    @classmethod
+    def _build_prompt(cls, theme: str):
+        messages = cls._get_prompt_template().invoke({"theme": theme})
+        return messages, cls._get_story_parser()
+
+    # parser for LLMCallPolicy that reports its time as the parse stage
+    @classmethod
+    def _timed_parser(cls, story_parser) -> Callable[[Any], StoryLLMResponse]:
+        def parse(raw_response) -> StoryLLMResponse:
+            with generation_stage_seconds.timer(stage="parse"):
+                story_structure = cls._parse_response(story_parser, raw_response)
+                # the parser closes truncated JSON by itself, nested nodes are
+                # validated here so a cut off story is retried instead of persisted
+                flat = flatten_story_tree(cls._root_node(story_structure))
+                # a story without a winning path or too shallow is regenerated too
+                StoryAnalyzer.validate(flat)
+                return story_structure
+
+        return parse
+
+    @classmethod
+    def _parse_response(cls, story_parser, raw_response) -> StoryLLMResponse:
         # handles different response formats from the LLM
         response_text = raw_response
         # has attribute
@@ -64,60 +336,29 @@ class StoryGenerator:
             response_text = raw_response.content
 
         # converts the raw LLM output into a typed StoryLLMResponse object
-        story_structure = story_parser.parse(response_text)
+        return story_parser.parse(response_text)
 
-        # create a new Story object for the database
-        story_db = Story(title=story_structure.title, session_id=session_id)
-        # adds it to the session
-        db.add(story_db)
-        # ensures the object gets an ID immediately so you can link child nodes later
-        db.flush()
-
-        # convert dict from the LLM into a Pydantic StoryNodeLLM object using model_validate
+    # convert dict from the LLM into a Pydantic StoryNodeLLM object using model_validate
+    @classmethod
+    def _root_node(cls, story_structure: StoryLLMResponse) -> StoryNodeLLM:
         root_node_data = story_structure.rootNode
         if isinstance(root_node_data, dict):
             root_node_data = StoryNodeLLM.model_validate(root_node_data)
-
-        cls._process_story_node(db, story_db.id, root_node_data, is_root=True)
-
-        db.commit()
-        return story_db
+        return root_node_data
 
     @classmethod
-    def _process_story_node(
-        cls, db: Session, story_id: int, node_data: StoryNodeLLM, is_root: bool = False
+    async def _aprocess_story_node(
+        cls,
+        db: AsyncSession,
+        story_id: int,
+        node_data: StoryNodeLLM,
+        is_root: bool = False,
     ) -> StoryNode:
-        # create database StoryNode
-        node = StoryNode(
-            # link node to its Story
-            story_id=story_id,
-            # extract node content safely
-            content=(
-                node_data.content
-                if hasattr(node_data, "content")
-                else node_data["content"]
-            ),
-            # whether this is the root node
-            is_root=is_root,
-            # determine if ending node
-            is_ending=(
-                node_data.isEnding
-                if hasattr(node_data, "isEnding")
-                else node_data["isEnding"]
-            ),
-            # determine if winning ending
-            is_winning_ending=(
-                node_data.isWinningEnding
-                if hasattr(node_data, "isWinningEnding")
-                else node_data["isWinningEnding"]
-            ),
-            # initialize options
-            options=[],
-        )
+        node = cls._build_node(story_id, node_data, is_root)
         # add node to database
         db.add(node)
         # ensures node.id exists before you attach child nodes or options
-        db.flush()
+        await db.flush()
 
         # check if the node can have children
         if not node.is_ending and (hasattr(node_data, "options") and node_data.options):
@@ -131,7 +372,9 @@ class StoryGenerator:
                     next_node = StoryNodeLLM.model_validate(next_node)
                 # recursively create the child node
                 # false indicates this is not the root node
-                child_node = cls._process_story_node(db, story_id, next_node, False)
+                child_node = await cls._aprocess_story_node(
+                    db, story_id, next_node, False
+                )
 
                 # option text shown to the player
                 options_list.append(
@@ -143,6 +386,38 @@ class StoryGenerator:
                 # attach options to the current node
             node.options = options_list
 
-        db.flush()
+        await db.flush()
         # return fully-processed node
         return node
+
+    @classmethod
+    def _build_node(
+        cls, story_id: int, node_data: StoryNodeLLM, is_root: bool
+    ) -> StoryNode:
+        # create database StoryNode
+        return StoryNode(
+            # link node to its Story
+            story_id=story_id,
+            # extract node content safely
+            content=(
+                node_data.content
+                if hasattr(node_data, "content")
+                else node_data["content"]
+            ),
+            # whether this is the root node
+            is_root=is_root,
+            # determine if ending node
+            is_ending=(
+                node_data.isEnding
+                if hasattr(node_data, "isEnding")
+                else node_data["isEnding"]
+            ),
+            # determine if winning ending
+            is_winning_ending=(
+                node_data.isWinningEnding
+                if hasattr(node_data, "isWinningEnding")
+                else node_data["isWinningEnding"]
+            ),
+            # initialize options
+            options=[],
+        )
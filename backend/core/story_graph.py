@@ -0,0 +1,144 @@
+# story graphs as story_options edges: writes, reads with a fallback to the JSON
+# options column, and path queries run in the database as recursive CTEs
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import String, case, cast, exists, func, insert, literal, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.config import settings
+from core.story_tree import option_rows
+from models.story import StoryNode, StoryOption
+
+# a walk stops this deep, stories are trees but stored rows could still form a loop
+MAX_WALK_DEPTH = 64
+
+
+class StoryGraph:
+    # (node id, JSON options) pairs as edges, the caller commits
+    @classmethod
+    async def awrite_options(
+        cls, db: AsyncSession, story_id: int, nodes: Iterable[Tuple[int, List[dict]]]
+    ) -> None:
+        rows = option_rows(story_id, nodes)
+        if settings.STORY_OPTION_EDGES_ENABLED and rows:
+            await db.execute(insert(StoryOption).values(rows))
+
+    @classmethod
+    async def has_edges(cls, db: AsyncSession, story_id: int) -> bool:
+        return bool(
+            await db.scalar(select(exists().where(StoryOption.story_id == story_id)))
+        )
+
+    # node id -> options for the whole story, None when it has no edges and the
+    # JSON column is still the only copy
+    @classmethod
+    async def aload_options(
+        cls, db: AsyncSession, story_id: int
+    ) -> Optional[Dict[int, List[dict]]]:
+        if not settings.STORY_OPTION_EDGES_ENABLED:
+            return None
+        result = await db.execute(
+            select(StoryOption.from_node_id, StoryOption.text, StoryOption.to_node_id)
+            .where(StoryOption.story_id == story_id)
+            .order_by(StoryOption.from_node_id, StoryOption.ordinal)
+        )
+        rows = result.all()
+        if not rows:
+            return None
+        options = defaultdict(list)
+        for from_node_id, text, to_node_id in rows:
+            options[from_node_id].append({"text": text, "node_id": to_node_id})
+        return dict(options)
+
+    # one node's options, and the nodes they lead to when load_children is set;
+    # None when the node has no edges, the JSON column answers then
+    @classmethod
+    async def anode_options(
+        cls, db: AsyncSession, story_id: int, node_id: int, load_children: bool
+    ) -> Optional[Tuple[List[dict], List[StoryNode]]]:
+        if not settings.STORY_OPTION_EDGES_ENABLED:
+            return None
+        statement = select(StoryOption.text, StoryOption.to_node_id).where(
+            StoryOption.story_id == story_id, StoryOption.from_node_id == node_id
+        )
+        if load_children:
+            statement = statement.add_columns(StoryNode).outerjoin(
+                StoryNode, StoryNode.id == StoryOption.to_node_id
+            )
+        rows = (await db.execute(statement.order_by(StoryOption.ordinal))).all()
+        if not rows:
+            return None
+        options = [{"text": row[0], "node_id": row[1]} for row in rows]
+        children = [row[2] for row in rows if load_children and row[2] is not None]
+        return options, children
+
+    # every node reachable from the root with its depth (root is 1) and the
+    # comma separated node ids leading to it
+    @classmethod
+    def walk(cls, story_id: int):
+        walk = (
+            select(
+                StoryNode.id.label("node_id"),
+                literal(1).label("depth"),
+                cast(StoryNode.id, String).label("path"),
+            )
+            .where(StoryNode.story_id == story_id, StoryNode.is_root.is_(True))
+            .cte("walk", recursive=True)
+        )
+        return walk.union_all(
+            select(
+                StoryOption.to_node_id,
+                walk.c.depth + 1,
+                walk.c.path + "," + cast(StoryOption.to_node_id, String),
+            )
+            .join(walk, StoryOption.from_node_id == walk.c.node_id)
+            .where(
+                StoryOption.story_id == story_id,
+                StoryOption.to_node_id.is_not(None),
+                walk.c.depth < MAX_WALK_DEPTH,
+            )
+        )
+
+    # depth, reachable nodes and endings, and every root-to-winning-ending path
+    @classmethod
+    async def astats(cls, db: AsyncSession, story_id: int, max_paths: int) -> dict:
+        walk = cls.walk(story_id)
+        reached = select(walk.c.node_id, walk.c.depth, walk.c.path).subquery()
+        counts = (
+            await db.execute(
+                select(
+                    func.count(),
+                    func.max(reached.c.depth),
+                    func.sum(case((StoryNode.is_ending.is_(True), 1), else_=0)),
+                    func.sum(case((StoryNode.is_winning_ending.is_(True), 1), else_=0)),
+                ).join(StoryNode, StoryNode.id == reached.c.node_id)
+            )
+        ).one()
+        winning = await db.execute(
+            select(reached.c.path)
+            .join(StoryNode, StoryNode.id == reached.c.node_id)
+            .where(StoryNode.is_winning_ending.is_(True))
+            .order_by(reached.c.depth, reached.c.path)
+            .limit(max_paths)
+        )
+        unreachable = await db.execute(
+            select(StoryNode.id)
+            .where(
+                StoryNode.story_id == story_id,
+                StoryNode.id.not_in(select(reached.c.node_id)),
+            )
+            .order_by(StoryNode.id)
+        )
+        reachable, depth, endings, winning_endings = counts
+        return {
+            "reachable_nodes": reachable,
+            "depth": depth or 0,
+            "endings": endings or 0,
+            "winning_endings": winning_endings or 0,
+            "winning_paths": [
+                [int(node_id) for node_id in path.split(",")]
+                for path in winning.scalars()
+            ],
+            "unreachable_node_ids": list(unreachable.scalars()),
+        }
@@ -0,0 +1,208 @@
+# builds and persists a story while the LLM is still writing it
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from sqlalchemy import bindparam, insert, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.story_graph import StoryGraph
+from core.streaming_json import JsonEvent
+from core.story_tree import areserve_node_ids
+from models.story import Story, StoryNode
+
+NODE_FIELDS = {
+    "content": "content",
+    "isEnding": "is_ending",
+    "isWinningEnding": "is_winning_ending",
+}
+
+
+# a node seen in the stream, path is where it sits in the JSON document
+class StreamedNode:
+    def __init__(self, path: tuple, parent: Optional["StreamedNode"], index: int):
+        self.path = path
+        self.parent = parent
+        # position among the parent's options
+        self.index = index
+        self.depth = 0 if parent is None else parent.depth + 1
+        self.fields: Dict[str, object] = {}
+        # option index -> option text / child node
+        self.option_texts: Dict[int, str] = {}
+        self.children: Dict[int, "StreamedNode"] = {}
+        self.closed = False
+        self.id: Optional[int] = None
+        # options as last written to the database
+        self.stored_options: Optional[List[dict]] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.closed or len(self.fields) == len(NODE_FIELDS)
+
+    # only children that already have a row can be linked
+    def options(self) -> List[dict]:
+        if self.fields.get("is_ending"):
+            return []
+        return [
+            {"text": self.option_texts.get(index, ""), "node_id": child.id}
+            for index, child in sorted(self.children.items())
+            if child.id is not None
+        ]
+
+
+class StreamingStoryBuilder:
+    def __init__(
+        self,
+        db: AsyncSession,
+        session_id: str,
+        on_playable: Optional[Callable[[int], Awaitable[None]]] = None,
+    ):
+        self.db = db
+        self.session_id = session_id
+        # called once the story has a root node the player can start from
+        self.on_playable = on_playable
+        self.title: Optional[str] = None
+        self.story: Optional[Story] = None
+        self.nodes: Dict[tuple, StreamedNode] = {}
+        self._playable = False
+
+    # apply parser events, writing to the database at the milestones
+    async def handle(self, events: List[JsonEvent]) -> None:
+        sync_needed = False
+        for kind, path, payload in events:
+            if kind == "value" and path == ("title",):
+                self.title = payload
+            elif kind == "start" and payload == "object" and self._is_node_path(path):
+                parent = self.nodes.get(path[:-3]) if path != ("rootNode",) else None
+                index = path[-2] if parent is not None else 0
+                node = StreamedNode(path, parent, index)
+                self.nodes[path] = node
+                if parent is not None:
+                    parent.children[index] = node
+            elif kind == "value" and path[:-1] in self.nodes:
+                node = self.nodes[path[:-1]]
+                if path[-1] in NODE_FIELDS:
+                    was_ready = node.ready
+                    node.fields[NODE_FIELDS[path[-1]]] = payload
+                    # root and first level are written as soon as they are known
+                    if not was_ready and node.ready and node.depth <= 1:
+                        sync_needed = True
+            elif (
+                kind == "value"
+                and len(path) >= 3
+                and path[-1] == "text"
+                and path[-3] == "options"
+                and path[:-3] in self.nodes
+            ):
+                self.nodes[path[:-3]].option_texts[path[-2]] = payload
+            elif kind == "end" and path in self.nodes:
+                node = self.nodes[path]
+                node.closed = True
+                # a finished first-level branch is written in one go
+                if node.depth <= 1:
+                    sync_needed = True
+        if sync_needed:
+            await self.sync()
+
+    # insert ready nodes, relink options, commit; the last sync stores the story's stats
+    async def sync(self, final: bool = False, stats: Optional[dict] = None) -> None:
+        if final:
+            for node in self.nodes.values():
+                node.closed = True
+        root = self.nodes.get(("rootNode",))
+        if root is None or not root.ready:
+            return
+
+        if self.story is None:
+            self.story = Story(
+                title=self.title or "Untitled story",
+                session_id=self.session_id,
+                is_complete=False,
+            )
+            self.db.add(self.story)
+            await self.db.flush()
+        elif self.title and self.story.title != self.title:
+            self.story.title = self.title
+
+        new_nodes = [
+            node for node in self.nodes.values() if node.id is None and node.ready
+        ]
+        if new_nodes:
+            node_ids = await areserve_node_ids(self.db, len(new_nodes))
+            if node_ids is None:
+                await self._insert_one_by_one(new_nodes)
+            else:
+                for node, node_id in zip(new_nodes, node_ids):
+                    node.id = node_id
+                await self.db.execute(
+                    insert(StoryNode).values(
+                        [self._row(node, node.options()) for node in new_nodes]
+                    )
+                )
+                for node in new_nodes:
+                    node.stored_options = node.options()
+
+        # nodes written earlier whose children got ids since
+        changed = []
+        for node in self.nodes.values():
+            if node.id is None:
+                continue
+            options = node.options()
+            if options != node.stored_options:
+                changed.append({"node_pk": node.id, "new_options": options})
+                node.stored_options = options
+        if changed:
+            await self.db.execute(
+                update(StoryNode.__table__)
+                .where(StoryNode.__table__.c.id == bindparam("node_pk"))
+                .values(options=bindparam("new_options")),
+                changed,
+            )
+
+        if final:
+            # edges once the tree is final, readers use the JSON column until then
+            await StoryGraph.awrite_options(
+                self.db,
+                self.story.id,
+                [
+                    (node.id, node.stored_options)
+                    for node in self.nodes.values()
+                    if node.id is not None
+                ],
+            )
+            self.story.is_complete = True
+            for field, value in (stats or {}).items():
+                setattr(self.story, field, value)
+        await self.db.commit()
+
+        if not self._playable and self.on_playable is not None:
+            self._playable = True
+            await self.on_playable(self.story.id)
+
+    async def _insert_one_by_one(self, nodes: List[StreamedNode]) -> None:
+        orm_nodes = [StoryNode(**self._row(node, [])) for node in nodes]
+        self.db.add_all(orm_nodes)
+        await self.db.flush()
+        for node, orm_node in zip(nodes, orm_nodes):
+            node.id = orm_node.id
+            node.stored_options = []
+
+    def _row(self, node: StreamedNode, options: List[dict]) -> dict:
+        row = {
+            "story_id": self.story.id,
+            "content": node.fields.get("content", ""),
+            "is_root": node.parent is None,
+            "is_ending": bool(node.fields.get("is_ending", False)),
+            "is_winning_ending": bool(node.fields.get("is_winning_ending", False)),
+            "options": options,
+        }
+        if node.id is not None:
+            row["id"] = node.id
+        return row
+
+    @staticmethod
+    def _is_node_path(path: tuple) -> bool:
+        return path == ("rootNode",) or (
+            len(path) >= 4
+            and path[0] == "rootNode"
+            and path[-1] == "nextNode"
+            and path[-3] == "options"
+        )
@@ -0,0 +1,138 @@
+# turns the nested StoryLLMResponse into flat StoryNode rows written in one INSERT
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.models import StoryNodeLLM
+
+
+# walk the tree depth first, children point at their position in the returned list
+def flatten_story_tree(root: StoryNodeLLM) -> List[Dict[str, Any]]:
+    flat = []
+    stack = [(root, None, None)]
+    while stack:
+        node_data, parent, option_text = stack.pop()
+        if isinstance(node_data, dict):
+            node_data = StoryNodeLLM.model_validate(node_data)
+
+        entry = {
+            "content": node_data.content,
+            "is_root": parent is None,
+            "is_ending": node_data.isEnding,
+            "is_winning_ending": node_data.isWinningEnding,
+            # (option text, index of the child node)
+            "children": [],
+        }
+        index = len(flat)
+        flat.append(entry)
+        if parent is not None:
+            flat[parent]["children"].append((option_text, index))
+
+        # ending nodes never get options, same as the recursive path
+        if not node_data.isEnding and node_data.options:
+            # reversed so children are popped, and linked, in their original order
+            for option_data in reversed(node_data.options):
+                stack.append((option_data.nextNode, index, option_data.text))
+    return flat
+
+
+# query that reserves n primary keys for story_nodes in a single round trip
+def node_id_allocation_query(dialect_name: str, count: int):
+    if dialect_name == "postgresql":
+        return text(
+            "SELECT nextval(pg_get_serial_sequence('story_nodes', 'id')) "
+            "FROM generate_series(1, :count)"
+        ).bindparams(count=count)
+    if dialect_name == "sqlite":
+        # only safe while holding sqlite's write lock, see SQLITE_WRITE_LOCK
+        return text("SELECT COALESCE(MAX(id), 0) FROM story_nodes")
+    return None
+
+
+# a write that changes nothing, so the transaction takes the write lock before MAX(id)
+# is read; streamed stories reserve ids again after their first commit
+SQLITE_WRITE_LOCK = text("UPDATE story_nodes SET id = id WHERE 0")
+
+
+# turn the allocation query result into the list of ids
+def allocated_node_ids(dialect_name: str, rows: List[Any], count: int) -> List[int]:
+    if dialect_name == "sqlite":
+        start = rows[0][0] + 1
+        return list(range(start, start + count))
+    return [row[0] for row in rows]
+
+
+# reserve count node ids, None when the dialect has no single-query allocation
+async def areserve_node_ids(db: AsyncSession, count: int) -> Optional[List[int]]:
+    dialect_name = db.get_bind().dialect.name
+    allocation = node_id_allocation_query(dialect_name, count)
+    if allocation is None:
+        return None
+    if dialect_name == "sqlite":
+        await db.execute(SQLITE_WRITE_LOCK)
+    rows = (await db.execute(allocation)).all()
+    return allocated_node_ids(dialect_name, rows, count)
+
+
+# StoryNode rows with ids and options filled in, ready for insert().values()
+def build_node_rows(
+    flat: List[Dict[str, Any]], story_id: int, node_ids: List[int]
+) -> List[Dict[str, Any]]:
+    rows = []
+    for entry, node_id in zip(flat, node_ids):
+        options = [
+            {"text": option_text, "node_id": node_ids[child]}
+            for option_text, child in entry["children"]
+        ]
+        rows.append(
+            {
+                "id": node_id,
+                "story_id": story_id,
+                "content": entry["content"],
+                "is_root": entry["is_root"],
+                "is_ending": entry["is_ending"],
+                "is_winning_ending": entry["is_winning_ending"],
+                "options": options,
+            }
+        )
+    return rows
+
+
+# copy existing StoryNode objects into another story under new ids
+def clone_node_rows(
+    nodes: List[Any], story_id: int, node_ids: List[int]
+) -> List[Dict[str, Any]]:
+    id_map = {node.id: node_id for node, node_id in zip(nodes, node_ids)}
+    return [
+        {
+            "id": id_map[node.id],
+            "story_id": story_id,
+            "content": node.content,
+            "is_root": node.is_root,
+            "is_ending": node.is_ending,
+            "is_winning_ending": node.is_winning_ending,
+            "options": [
+                {"text": option["text"], "node_id": id_map.get(option["node_id"])}
+                for option in node.options or []
+            ],
+        }
+        for node in nodes
+    ]
+
+
+# story_options rows for (node id, JSON options) pairs, ordinal is the list position
+def option_rows(
+    story_id: int, nodes: Iterable[Tuple[int, List[dict]]]
+) -> List[Dict[str, Any]]:
+    return [
+        {
+            "story_id": story_id,
+            "from_node_id": node_id,
+            "ordinal": ordinal,
+            "text": option["text"],
+            "to_node_id": option.get("node_id"),
+        }
+        for node_id, options in nodes
+        for ordinal, option in enumerate(options or [])
+    ]
@@ -0,0 +1,140 @@
+# incremental JSON parser, reports values as soon as they are complete in the stream
+import json
+from typing import Any, List, Tuple
+
+# (kind, path, payload): ("start", path, "object"|"array"), ("end", path, ...),
+# ("value", path, value). path is a tuple of object keys and array indexes
+JsonEvent = Tuple[str, tuple, Any]
+
+WHITESPACE = " \t\r\n"
+LITERALS = {"true": True, "false": False, "null": None}
+
+
+class JsonEventParser:
+    def __init__(self):
+        # open containers, each [kind, current key or index]
+        self._stack: List[list] = []
+        self._state = "before_root"
+        self._token = ""
+        # the token being read is an object key rather than a value
+        self._reading_key = False
+        self._escaped = False
+        self.done = False
+
+    # feed the next chunk of text, returns the events it completed
+    def feed(self, chunk: str) -> List[JsonEvent]:
+        events: List[JsonEvent] = []
+        for char in chunk:
+            if self.done:
+                break
+            self._consume(char, events)
+        return events
+
+    def _path(self) -> tuple:
+        return tuple(frame[1] for frame in self._stack)
+
+    def _consume(self, char: str, events: List[JsonEvent]) -> None:
+        state = self._state
+
+        if state == "before_root":
+            # skip anything the model writes before the JSON, like a ``` fence
+            if char == "{":
+                self._open("object", events)
+            return
+
+        if state == "string":
+            self._token += char
+            if self._escaped:
+                self._escaped = False
+            elif char == "\\":
+                self._escaped = True
+            elif char == '"':
+                self._finish_string(events)
+            return
+
+        if state == "scalar":
+            if char in ",}] \t\r\n":
+                self._finish_scalar(events)
+                self._consume(char, events)
+            else:
+                self._token += char
+            return
+
+        if char in WHITESPACE:
+            return
+
+        if state == "key_or_end":
+            if char == '"':
+                self._start_string(is_key=True)
+            elif char == "}":
+                self._close(events)
+        elif state == "colon":
+            if char == ":":
+                self._state = "value"
+        elif state in ("value", "value_or_end"):
+            if char == "]" and state == "value_or_end":
+                self._close(events)
+            elif char == "{":
+                self._open("object", events)
+            elif char == "[":
+                self._open("array", events)
+            elif char == '"':
+                self._start_string(is_key=False)
+            else:
+                self._token = char
+                self._state = "scalar"
+        elif state == "after_value":
+            if char == ",":
+                frame = self._stack[-1]
+                if frame[0] == "object":
+                    self._state = "key"
+                else:
+                    frame[1] += 1
+                    self._state = "value"
+            elif char in "}]":
+                self._close(events)
+        elif state == "key":
+            if char == '"':
+                self._start_string(is_key=True)
+
+    def _open(self, kind: str, events: List[JsonEvent]) -> None:
+        events.append(("start", self._path(), kind))
+        if kind == "object":
+            self._stack.append(["object", None])
+            self._state = "key_or_end"
+        else:
+            self._stack.append(["array", 0])
+            self._state = "value_or_end"
+
+    def _close(self, events: List[JsonEvent]) -> None:
+        kind = self._stack.pop()[0]
+        events.append(("end", self._path(), kind))
+        self._value_done()
+
+    def _start_string(self, is_key: bool) -> None:
+        self._token = '"'
+        self._reading_key = is_key
+        self._state = "string"
+
+    def _finish_string(self, events: List[JsonEvent]) -> None:
+        value = json.loads(self._token)
+        self._token = ""
+        if self._reading_key:
+            self._stack[-1][1] = value
+            self._state = "colon"
+        else:
+            events.append(("value", self._path(), value))
+            self._value_done()
+
+    def _finish_scalar(self, events: List[JsonEvent]) -> None:
+        token, self._token = self._token, ""
+        value = LITERALS[token] if token in LITERALS else json.loads(token)
+        events.append(("value", self._path(), value))
+        self._value_done()
+
+    def _value_done(self) -> None:
+        if self._stack:
+            self._state = "after_value"
+        else:
+            # the root object is closed, ignore whatever follows it
+            self.done = True
@@ -0,0 +1,130 @@
+# pre-generated, unassigned stories for popular themes, handed out on create
+import logging
+from collections import Counter
+from datetime import timedelta
+from typing import Dict, List, Optional
+
+from sqlalchemy import func, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.config import settings
+from core.job_queue import utcnow
+from core.story_blob import StoryBlobs
+from core.story_cache import StoryCache, normalize_theme
+from db.database import AsyncSessionLocal
+from models.job import StoryJob
+from models.story import Story
+
+logger = logging.getLogger(__name__)
+
+
+class WarmPool:
+    # hand a pooled story for this theme to the session, None when the pool is empty
+    @classmethod
+    async def claim(
+        cls, db: AsyncSession, theme: str, session_id: str
+    ) -> Optional[Story]:
+        pool_key = StoryCache.cache_key(theme)
+        available = (
+            select(Story.id)
+            .where(Story.pool_key == pool_key, Story.session_id.is_(None))
+            .order_by(Story.id)
+            .limit(1)
+        )
+        is_postgres = db.get_bind().dialect.name == "postgresql"
+        if is_postgres:
+            available = available.with_for_update(skip_locked=True)
+
+        # another request may take the same story first, try the next one
+        for _ in range(3):
+            story_id = await db.scalar(available)
+            if story_id is None:
+                return None
+            result = await db.execute(
+                update(Story)
+                .where(Story.id == story_id, Story.session_id.is_(None))
+                .values(session_id=session_id)
+            )
+            if result.rowcount == 1:
+                story = await db.get(Story, story_id)
+                # the blob is written now that the story has an owner
+                await StoryBlobs.materialize(db, story)
+                return story
+        return None
+
+    # themes to generate now, one entry per missing pooled story
+    @classmethod
+    async def plan_refills(
+        cls, db: AsyncSession, limit: int, running: Optional[List[str]] = None
+    ) -> List[str]:
+        # refills still in progress are not stored yet but will use the budget
+        running = Counter(running or [])
+        budget = await cls._remaining_budget(db) - sum(running.values())
+        limit = min(limit, budget)
+        if limit <= 0:
+            return []
+
+        refills = []
+        for theme in await cls.hot_themes(db):
+            available = await cls._available(db, theme) + running[theme]
+            refills.extend([theme] * max(settings.WARM_POOL_SIZE - available, 0))
+        return refills[:limit]
+
+    # most requested themes over the popularity window
+    @classmethod
+    async def hot_themes(cls, db: AsyncSession) -> List[str]:
+        since = utcnow() - timedelta(seconds=settings.WARM_POOL_WINDOW_SECONDS)
+        result = await db.execute(
+            select(StoryJob.theme, func.count())
+            .where(StoryJob.created_at > since)
+            .group_by(StoryJob.theme)
+        )
+        # "Fantasy" and "fantasy!" count as the same theme
+        counts: Dict[str, int] = Counter()
+        for theme, count in result.all():
+            if theme:
+                counts[normalize_theme(theme)] += count
+        return [
+            theme
+            for theme, count in counts.most_common(settings.WARM_POOL_MAX_THEMES)
+            if count >= settings.WARM_POOL_MIN_REQUESTS
+        ]
+
+    # generate one pooled story in its own session
+    @classmethod
+    async def fill(cls, theme: str) -> None:
+        # the API imports this module to claim stories, only workers load the LLM stack
+        from core.story_generator import StoryGenerator
+
+        async with AsyncSessionLocal() as db:
+            try:
+                await StoryGenerator.agenerate_story(
+                    db, None, theme, pool_key=StoryCache.cache_key(theme)
+                )
+            except Exception:
+                await db.rollback()
+                logger.exception("failed to pre-generate a %r story", theme)
+
+    @classmethod
+    async def _available(cls, db: AsyncSession, theme: str) -> int:
+        return await db.scalar(
+            select(func.count())
+            .select_from(Story)
+            .where(
+                Story.pool_key == StoryCache.cache_key(theme),
+                Story.session_id.is_(None),
+            )
+        )
+
+    # pooled stories generated in the last hour count against the LLM budget
+    @classmethod
+    async def _remaining_budget(cls, db: AsyncSession) -> int:
+        generated = await db.scalar(
+            select(func.count())
+            .select_from(Story)
+            .where(
+                Story.pool_key.is_not(None),
+                Story.created_at > utcnow() - timedelta(hours=1),
+            )
+        )
+        return settings.WARM_POOL_LLM_BUDGET_PER_HOUR - generated
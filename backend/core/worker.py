@@ -0,0 +1,225 @@
+# runs story generation outside the web process, pulling jobs from story_jobs
+import asyncio
+import logging
+import os
+import socket
+import time
+import uuid
+from typing import Dict, Optional
+
+from core.config import settings
+from core.job_queue import JobQueue
+from core.retention import Retention
+from core.single_flight import SingleFlight
+from core.story_generator import StoryGenerator
+from core.warm_pool import WarmPool
+from db.database import AsyncSessionLocal
+
+logger = logging.getLogger(__name__)
+
+
+# generate the story for a job this worker has claimed
+async def generate_story_task(
+    job_id: str,
+    theme: str,
+    session_id: str,
+    worker_id: str,
+    model: Optional[str] = None,
+):
+    # streamed stories are attached to the job as soon as the root is playable
+    async def report_playable(story_id: int):
+        async with AsyncSessionLocal() as progress_db:
+            await JobQueue.report_progress(progress_db, job_id, worker_id, story_id)
+
+    # every LLM attempt and its outcome, stored on the job
+    attempt_log = []
+
+    # the session only checks out a connection once the story is persisted
+    async with AsyncSessionLocal() as db:
+        try:
+            if settings.SINGLE_FLIGHT_ENABLED:
+                story = await SingleFlight.generate(
+                    db, job_id, theme, session_id, report_playable, attempt_log, model
+                )
+            else:
+                story = await StoryGenerator.agenerate_story(
+                    db,
+                    session_id,
+                    theme,
+                    report_playable,
+                    attempt_log=attempt_log,
+                    model=model,
+                )
+
+            # the lease may have expired and the job handed to someone else
+            if not await JobQueue.complete(
+                db, job_id, worker_id, story.id, attempt_log
+            ):
+                logger.warning("job %s was reclaimed before it completed", job_id)
+        # mark job as failed
+        except Exception as e:
+            await db.rollback()
+            await JobQueue.fail(db, job_id, worker_id, str(e), attempt_log)
+
+
+class Worker:
+    def __init__(
+        self,
+        concurrency: Optional[int] = None,
+        poll_interval: Optional[float] = None,
+    ):
+        self.concurrency = concurrency or settings.WORKER_CONCURRENCY
+        self.poll_interval = poll_interval or settings.WORKER_POLL_INTERVAL
+        # unique per process so leases can be traced back to a worker
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        # job_id -> running generation
+        self._in_flight: Dict[str, asyncio.Task] = {}
+        self._stop = asyncio.Event()
+        self._last_renewal = 0.0
+        # warm pool generations, task -> theme
+        self._refills: Dict[asyncio.Task, str] = {}
+        self._last_refill = 0.0
+        # the running retention pass, at most one per worker
+        self._retention: Optional[asyncio.Task] = None
+        # the first pass runs on the first tick
+        self._last_retention: Optional[float] = None
+
+    # ask the loop to exit once in-flight jobs are finished
+    def stop(self):
+        self._stop.set()
+
+    def run(self):
+        asyncio.run(self.arun())
+
+    async def arun(self):
+        logger.info(
+            "worker %s started with concurrency %d", self.worker_id, self.concurrency
+        )
+        try:
+            while not self._stop.is_set():
+                claimed = await self._tick()
+                # only sleep when there was nothing to pick up
+                if not claimed:
+                    try:
+                        await asyncio.wait_for(self._stop.wait(), self.poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+        finally:
+            await self._drain()
+            # pooled stories are optional, don't hold up shutdown for them
+            for task in self._refills:
+                task.cancel()
+            # an interrupted batch is rolled back and picked up by the next pass
+            if self._retention is not None:
+                self._retention.cancel()
+            logger.info("worker %s stopped", self.worker_id)
+
+    # one pass of the loop: recover, renew, claim, returns the number of new jobs
+    async def _tick(self) -> int:
+        self._in_flight = {
+            job_id: task for job_id, task in self._in_flight.items() if not task.done()
+        }
+
+        try:
+            async with AsyncSessionLocal() as db:
+                await JobQueue.recover_expired(db)
+                await self._renew_leases(db)
+
+                free_slots = self.concurrency - len(self._in_flight)
+                jobs = await JobQueue.claim(db, self.worker_id, free_slots)
+        except Exception:
+            logger.exception("worker %s failed to poll the queue", self.worker_id)
+            return 0
+
+        for job in jobs:
+            self._in_flight[job.job_id] = asyncio.create_task(
+                generate_story_task(
+                    job.job_id, job.theme, job.session_id, self.worker_id, job.model
+                )
+            )
+
+        # spare capacity goes to the warm pool, queued jobs always come first
+        if settings.WARM_POOL_ENABLED and not jobs:
+            await self._refill_warm_pool()
+        if settings.RETENTION_ENABLED:
+            self._start_retention()
+        return len(jobs)
+
+    # renew well before the lease runs out
+    async def _renew_leases(self, db) -> None:
+        now = time.monotonic()
+        renew_every = settings.JOB_LEASE_SECONDS / 3
+        if self._in_flight and now - self._last_renewal > renew_every:
+            await JobQueue.renew(db, self.worker_id, list(self._in_flight))
+            await SingleFlight.renew(db, list(self._in_flight))
+            self._last_renewal = now
+
+    # wait for in-flight jobs on shutdown, still renewing their leases so no other
+    # worker recovers and runs them a second time
+    async def _drain(self) -> None:
+        while True:
+            self._in_flight = {
+                job_id: task
+                for job_id, task in self._in_flight.items()
+                if not task.done()
+            }
+            if not self._in_flight:
+                return
+            await asyncio.wait(
+                list(self._in_flight.values()),
+                timeout=settings.JOB_LEASE_SECONDS / 3,
+            )
+            try:
+                async with AsyncSessionLocal() as db:
+                    await self._renew_leases(db)
+            except Exception:
+                logger.exception("worker %s failed to renew leases", self.worker_id)
+
+    # run a retention pass in the background once the interval has passed
+    def _start_retention(self):
+        if self._retention is not None and not self._retention.done():
+            return
+        now = time.monotonic()
+        if (
+            self._last_retention is not None
+            and now - self._last_retention < settings.RETENTION_INTERVAL_SECONDS
+        ):
+            return
+        self._last_retention = now
+        self._retention = asyncio.create_task(self._run_retention())
+
+    async def _run_retention(self):
+        try:
+            await Retention.run()
+        except Exception:
+            logger.exception("worker %s failed to run retention", self.worker_id)
+
+    # start pooled generations for hot themes that are running low
+    async def _refill_warm_pool(self):
+        self._refills = {
+            task: theme for task, theme in self._refills.items() if not task.done()
+        }
+        now = time.monotonic()
+        if now - self._last_refill < settings.WARM_POOL_REFILL_INTERVAL:
+            return
+        self._last_refill = now
+
+        free_slots = min(
+            settings.WARM_POOL_REFILL_CONCURRENCY - len(self._refills),
+            self.concurrency - len(self._in_flight) - len(self._refills),
+        )
+        if free_slots <= 0:
+            return
+        try:
+            async with AsyncSessionLocal() as db:
+                themes = await WarmPool.plan_refills(
+                    db, free_slots, list(self._refills.values())
+                )
+        except Exception:
+            logger.exception(
+                "worker %s failed to plan warm pool refills", self.worker_id
+            )
+            return
+
+        for theme in themes:
+            self._refills[asyncio.create_task(WarmPool.fill(theme))] = theme
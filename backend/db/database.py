@@ -1,15 +1,48 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 
 from core.config import settings
+from core.metrics import db_pool_connections, registry
+from db.pool import configure_sqlite, engine_options, pool_stats
 
 # create connection to database
-engine = create_engine(settings.DATABASE_URL)
+engine = create_engine(
+    settings.DATABASE_URL, **engine_options(settings.DATABASE_URL, is_async=False)
+)
+configure_sqlite(engine)
 
 # generate new database session
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+
+# pick the async driver matching DATABASE_URL unless one is configured explicitly
+def _async_database_url() -> str:
+    if settings.ASYNC_DATABASE_URL:
+        return settings.ASYNC_DATABASE_URL
+    url = make_url(settings.DATABASE_URL)
+    backend = url.get_backend_name()
+    if backend == "sqlite":
+        url = url.set(drivername="sqlite+aiosqlite")
+    elif backend == "postgresql":
+        url = url.set(drivername="postgresql+asyncpg")
+    return url.render_as_string(hide_password=False)
+
+
+# async connection used by the API and the workers
+async_engine = create_async_engine(
+    _async_database_url(), **engine_options(_async_database_url(), is_async=True)
+)
+configure_sqlite(async_engine.sync_engine)
+
+# generate new async database session, objects stay usable after commit
+AsyncSessionLocal = async_sessionmaker(
+    bind=async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+)
+
 # tables inherit from this
 Base = declarative_base()
 
@@ -26,6 +59,63 @@ def get_db():
         db.close()
 
 
+# async version of get_db for async endpoints
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+
+# INSERT that silently skips rows conflicting on index_elements
+def insert_ignore(
+    dialect_name: str, model, values: dict, index_elements: list, index_where=None
+):
+    dialect_insert = (
+        postgresql.insert if dialect_name == "postgresql" else sqlite.insert
+    )
+    return (
+        dialect_insert(model)
+        .values(**values)
+        .on_conflict_do_nothing(index_elements=index_elements, index_where=index_where)
+    )
+
+
+# pool usage of both engines, including how long checkouts waited
+def database_pool_stats() -> dict:
+    return pool_stats({"sync": engine, "async": async_engine.sync_engine})
+
+
+# connections per pool, read when /metrics is rendered
+@registry.collect_with
+def _collect_pool_metrics() -> None:
+    for name, stats in database_pool_stats().items():
+        if "size" not in stats:
+            continue
+        db_pool_connections.set(stats["size"], pool=name, state="size")
+        db_pool_connections.set(stats["checked_out"], pool=name, state="checked_out")
+        # sqlalchemy counts down from -size while the pool is not full yet
+        db_pool_connections.set(max(stats["overflow"], 0), pool=name, state="overflow")
+
+
 # create corresponding tables in the database
 def create_tables():
     Base.metadata.create_all(bind=engine)
+    _upgrade_existing_tables()
+
+
+# create_all skips tables that already exist, so add new columns and indexes by hand
+def _upgrade_existing_tables():
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                conn.execute(
+                    text(
+                        f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+                    )
+                )
+            for index in table.indexes:
+                index.create(bind=conn, checkfirst=True)
@@ -0,0 +1,138 @@
+# engine tuning: pool sizing, sqlite pragmas, statement timeouts, checkout wait timing
+import threading
+import time
+from typing import Dict
+
+from sqlalchemy import event
+from sqlalchemy.engine import URL, Engine, make_url
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+from core.config import settings
+from core.metrics import db_pool_timeouts, db_pool_wait_seconds
+
+
+# how long callers waited for a connection from the pool
+class PoolWaitStats:
+    def __init__(self, name: str):
+        # pool label of its metrics
+        self.name = name
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def observe(self, seconds: float, timed_out: bool = False) -> None:
+        with self._lock:
+            self.checkouts += 1
+            self.total_wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+            if timed_out:
+                self.timeouts += 1
+        db_pool_wait_seconds.observe(seconds, pool=self.name)
+        if timed_out:
+            db_pool_timeouts.inc(pool=self.name)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "checkouts": self.checkouts,
+            "timeouts": self.timeouts,
+            "total_wait_seconds": self.total_wait_seconds,
+            "avg_wait_seconds": (
+                self.total_wait_seconds / self.checkouts if self.checkouts else 0.0
+            ),
+            "max_wait_seconds": self.max_wait_seconds,
+        }
+
+
+pool_wait_stats = {"sync": PoolWaitStats("sync"), "async": PoolWaitStats("async")}
+
+
+class TimedQueuePool(QueuePool):
+    wait_stats = pool_wait_stats["sync"]
+
+    def _do_get(self):
+        started = time.perf_counter()
+        timed_out = True
+        try:
+            connection = super()._do_get()
+            timed_out = False
+            return connection
+        finally:
+            self.wait_stats.observe(time.perf_counter() - started, timed_out)
+
+
+class TimedAsyncQueuePool(AsyncAdaptedQueuePool):
+    wait_stats = pool_wait_stats["async"]
+
+    def _do_get(self):
+        started = time.perf_counter()
+        timed_out = True
+        try:
+            connection = super()._do_get()
+            timed_out = False
+            return connection
+        finally:
+            self.wait_stats.observe(time.perf_counter() - started, timed_out)
+
+
+def _is_memory_sqlite(url: URL) -> bool:
+    return url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")
+
+
+# keyword arguments for create_engine / create_async_engine
+def engine_options(database_url: str, is_async: bool) -> dict:
+    url = make_url(database_url)
+    # in-memory sqlite needs its single shared connection pool
+    if _is_memory_sqlite(url):
+        return {}
+
+    options = {
+        "poolclass": TimedAsyncQueuePool if is_async else TimedQueuePool,
+        "pool_size": settings.DB_POOL_SIZE,
+        "max_overflow": settings.DB_MAX_OVERFLOW,
+        "pool_timeout": settings.DB_POOL_TIMEOUT,
+        "pool_pre_ping": settings.DB_POOL_PRE_PING,
+        "pool_recycle": settings.DB_POOL_RECYCLE,
+    }
+    if url.get_backend_name() == "postgresql" and settings.DB_STATEMENT_TIMEOUT_MS:
+        timeout = str(settings.DB_STATEMENT_TIMEOUT_MS)
+        if url.get_driver_name() == "asyncpg":
+            options["connect_args"] = {
+                "server_settings": {"statement_timeout": timeout}
+            }
+        else:
+            options["connect_args"] = {"options": f"-c statement_timeout={timeout}"}
+    return options
+
+
+# WAL lets API reads run while a worker writes on a single-node sqlite setup
+def configure_sqlite(engine: Engine) -> None:
+    if engine.dialect.name != "sqlite":
+        return
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if settings.SQLITE_WAL:
+            cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA synchronous={settings.SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA busy_timeout={settings.SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.close()
+
+
+# connections in use and waiting times of both engines
+def pool_stats(engines: Dict[str, Engine]) -> Dict[str, dict]:
+    stats = {}
+    for name, engine in engines.items():
+        pool = engine.pool
+        stats[name] = {"status": pool.status(), **pool_wait_stats[name].stats()}
+        if isinstance(pool, QueuePool):
+            stats[name].update(
+                {
+                    "size": pool.size(),
+                    "checked_out": pool.checkedout(),
+                    "overflow": pool.overflow(),
+                }
+            )
+    return stats
@@ -1,12 +1,14 @@
-from fastapi import FastAPI
+import time
+
+from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 
 # Import settings variables
 from core.config import settings
-from routers import story, job
-from db.database import create_tables
+from core.metrics import http_request_seconds
+from routers import story, job, stats, metrics
 
-create_tables()
+# the schema is not touched on boot, run python manage.py migrate before deploying
 
 app = FastAPI(
     # Documentation
@@ -27,9 +29,29 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+if settings.METRICS_ENABLED:
+
+    # latency per route template, so /stories/1 and /stories/2 share a series
+    @app.middleware("http")
+    async def record_request_latency(request: Request, call_next):
+        started = time.perf_counter()
+        response = await call_next(request)
+        route = request.scope.get("route")
+        http_request_seconds.observe(
+            time.perf_counter() - started,
+            method=request.method,
+            route=route.path if route is not None else "unmatched",
+            status=response.status_code,
+        )
+        return response
+
+
 # endpoints
 app.include_router(story.router, prefix=settings.API_PREFIX)
 app.include_router(job.router, prefix=settings.API_PREFIX)
+app.include_router(stats.router, prefix=settings.API_PREFIX)
+app.include_router(metrics.router)
 
 if __name__ == "__main__":
     # Run webserver
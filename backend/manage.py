@@ -0,0 +1,205 @@
+# maintenance commands, run from the backend directory
+#
+#   python manage.py migrate
+#   python manage.py backfill-blobs
+#   python manage.py backfill-options
+#   python manage.py backfill-stats
+#   python manage.py retention --dry-run
+import argparse
+import asyncio
+
+from sqlalchemy import exists, or_, select
+
+from core.cache import app_cache, story_cache_key
+from core.retention import Retention
+from core.story_analysis import StoryAnalyzer, flat_from_nodes
+from core.story_blob import StoryBlobs
+from core.story_graph import StoryGraph
+from db.database import AsyncSessionLocal, create_tables
+from models.story import Story, StoryBlob, StoryNode, StoryOption
+
+# register every table on Base before migrating
+import models.batch  # noqa: F401
+import models.cache  # noqa: F401
+import models.job  # noqa: F401
+
+
+# write story_blobs rows for finished stories created before blobs existed
+async def backfill_blobs(batch_size: int) -> None:
+    written = 0
+    last_id = 0
+    while True:
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                select(Story)
+                .outerjoin(StoryBlob, StoryBlob.story_id == Story.id)
+                .where(
+                    Story.id > last_id,
+                    StoryBlob.story_id.is_(None),
+                    or_(Story.is_complete.is_(None), Story.is_complete.is_(True)),
+                )
+                .order_by(Story.id)
+                .limit(batch_size)
+            )
+            stories = result.scalars().all()
+            if not stories:
+                break
+            for story in stories:
+                if await StoryBlobs.materialize(db, story) is not None:
+                    written += 1
+            last_id = stories[-1].id
+            # one short transaction per batch
+            await db.commit()
+    print(f"wrote {written} story blobs")
+
+
+# copy the JSON options of finished stories into story_options, stories that already
+# have edges are skipped so the command can be run again after an interruption
+async def backfill_options(batch_size: int) -> None:
+    migrated = 0
+    last_id = 0
+    while True:
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                select(Story.id)
+                .where(
+                    Story.id > last_id,
+                    ~exists().where(StoryOption.story_id == Story.id),
+                    or_(Story.is_complete.is_(None), Story.is_complete.is_(True)),
+                )
+                .order_by(Story.id)
+                .limit(batch_size)
+            )
+            story_ids = result.scalars().all()
+            if not story_ids:
+                break
+            result = await db.execute(
+                select(StoryNode.story_id, StoryNode.id, StoryNode.options)
+                .where(StoryNode.story_id.in_(story_ids))
+                .order_by(StoryNode.id)
+            )
+            nodes_by_story = {}
+            for story_id, node_id, options in result:
+                nodes_by_story.setdefault(story_id, []).append((node_id, options))
+            for story_id, nodes in nodes_by_story.items():
+                await StoryGraph.awrite_options(db, story_id, nodes)
+                migrated += 1
+            last_id = story_ids[-1]
+            # one short transaction per batch
+            await db.commit()
+    print(f"migrated the options of {migrated} stories")
+
+
+# depth, node and ending counts for finished stories written before stats existed,
+# their stored JSON is rewritten with the stats so either backfill can run first
+async def backfill_stats(batch_size: int) -> None:
+    updated = 0
+    last_id = 0
+    while True:
+        async with AsyncSessionLocal() as db:
+            result = await db.execute(
+                select(Story)
+                .where(
+                    Story.id > last_id,
+                    Story.node_count.is_(None),
+                    or_(Story.is_complete.is_(None), Story.is_complete.is_(True)),
+                )
+                .order_by(Story.id)
+                .limit(batch_size)
+            )
+            stories = result.scalars().all()
+            if not stories:
+                break
+            result = await db.execute(
+                select(StoryNode).where(
+                    StoryNode.story_id.in_([story.id for story in stories])
+                )
+            )
+            nodes_by_story = {}
+            for node in result.scalars():
+                nodes_by_story.setdefault(node.story_id, []).append(node)
+            updated_ids = []
+            for story in stories:
+                nodes = nodes_by_story.get(story.id)
+                if not nodes or not any(node.is_root for node in nodes):
+                    continue
+                options = await StoryGraph.aload_options(db, story.id)
+                stats = StoryAnalyzer.stats(flat_from_nodes(nodes, options))
+                for field, value in stats.items():
+                    setattr(story, field, value)
+                # the stored /complete JSON carries the stats too, rewrite it;
+                # materialize refreshes the story, so the new values go first
+                await db.flush()
+                await StoryBlobs.materialize(db, story)
+                updated_ids.append(story.id)
+            last_id = stories[-1].id
+            # one short transaction per batch
+            await db.commit()
+        # a shared response cache would keep serving the JSON without stats
+        for story_id in updated_ids:
+            await app_cache.delete(story_cache_key(story_id))
+        updated += len(updated_ids)
+    print(f"computed the stats of {updated} stories")
+
+
+# delete expired jobs and abandoned stories once, whether or not workers do it too
+async def retention(dry_run: bool, archive_dir, batch_size: int) -> None:
+    removed = await Retention.run(dry_run, archive_dir, batch_size)
+    verb = "would delete" if dry_run else "deleted"
+    if not removed:
+        print(f"{verb} nothing")
+    for table, count in removed.items():
+        print(f"{verb} {count} {table} rows")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Story backend maintenance")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser(
+        "migrate", help="create missing tables, columns and indexes, run before deploys"
+    )
+
+    backfill = commands.add_parser(
+        "backfill-blobs", help="store the JSON of stories that have no blob yet"
+    )
+    backfill.add_argument("--batch-size", type=int, default=100)
+
+    backfill = commands.add_parser(
+        "backfill-options",
+        help="copy JSON options into the story_options table for older stories",
+    )
+    backfill.add_argument("--batch-size", type=int, default=100)
+
+    backfill = commands.add_parser(
+        "backfill-stats", help="compute depth and ending stats for older stories"
+    )
+    backfill.add_argument("--batch-size", type=int, default=100)
+
+    prune = commands.add_parser(
+        "retention", help="delete finished jobs and abandoned stories past their TTL"
+    )
+    prune.add_argument(
+        "--dry-run", action="store_true", help="count the rows without deleting them"
+    )
+    prune.add_argument(
+        "--archive-dir", help="gzipped JSONL copies go here, RETENTION_ARCHIVE_DIR"
+    )
+    prune.add_argument("--batch-size", type=int, default=None)
+
+    args = parser.parse_args()
+    if args.command == "migrate":
+        create_tables()
+        print("database schema is up to date")
+    elif args.command == "backfill-blobs":
+        asyncio.run(backfill_blobs(args.batch_size))
+    elif args.command == "backfill-options":
+        asyncio.run(backfill_options(args.batch_size))
+    elif args.command == "backfill-stats":
+        asyncio.run(backfill_stats(args.batch_size))
+    elif args.command == "retention":
+        asyncio.run(retention(args.dry_run, args.archive_dir, args.batch_size))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,19 @@
+# a group of story jobs submitted together, see POST /stories/batch
+from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy.sql import func
+
+from db.database import Base
+
+
+class StoryBatch(Base):
+    __tablename__ = "story_batches"
+
+    id = Column(Integer, primary_key=True, index=True)
+    batch_id = Column(String, index=True, unique=True)
+    # session that submitted the batch
+    session_id = Column(String, index=True)
+    # number of jobs in the batch
+    total = Column(Integer)
+    # jobs of this batch workers may generate at the same time
+    max_concurrency = Column(Integer)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
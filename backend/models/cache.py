@@ -0,0 +1,58 @@
+# stored stories reused for requests with the same normalized theme
+from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Index, text
+from sqlalchemy.sql import func
+
+from db.database import Base
+
+
+# one row per cache key, tracks usage for LRU eviction and hit/miss counters
+class StoryCacheKey(Base):
+    __tablename__ = "story_cache_keys"
+
+    # hash of the normalized theme, prompt and model
+    cache_key = Column(String, primary_key=True)
+    # normalized theme, kept to make the table readable
+    theme = Column(String)
+    hits = Column(Integer, default=0)
+    misses = Column(Integer, default=0)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    last_used_at = Column(DateTime(timezone=True), index=True)
+
+
+# a generated story in the pool of a cache key
+class StoryCacheEntry(Base):
+    __tablename__ = "story_cache_entries"
+
+    id = Column(Integer, primary_key=True, index=True)
+    cache_key = Column(String, ForeignKey("story_cache_keys.cache_key"), index=True)
+    # story the cached tree is cloned from
+    story_id = Column(Integer, ForeignKey("stories.id"))
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    last_used_at = Column(DateTime(timezone=True), nullable=True)
+
+
+# one LLM generation shared by every concurrent job with the same cache key
+class GenerationFlight(Base):
+    __tablename__ = "generation_flights"
+    # at most one running flight per key, this is the leader election
+    __table_args__ = (
+        Index(
+            "ux_generation_flights_running",
+            "flight_key",
+            unique=True,
+            sqlite_where=text("status = 'running'"),
+            postgresql_where=text("status = 'running'"),
+        ),
+    )
+
+    flight_id = Column(String, primary_key=True)
+    flight_key = Column(String, index=True)
+    # job doing the generation, the other jobs wait for its story
+    leader_job_id = Column(String)
+    # running, completed or failed
+    status = Column(String)
+    story_id = Column(Integer, nullable=True)
+    error = Column(String, nullable=True)
+    # followers take over if the leader stops renewing before this
+    expires_at = Column(DateTime(timezone=True))
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
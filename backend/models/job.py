@@ -1,5 +1,5 @@
 # job is an intent to make a story
-from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy import Column, Integer, String, DateTime, Index, JSON
 from sqlalchemy.sql import func
 
 from db.database import Base
@@ -7,15 +7,41 @@ from db.database import Base
 
 class StoryJob(Base):
     __tablename__ = "story_jobs"
+    __table_args__ = (
+        # workers look for the oldest pending jobs first
+        Index("ix_story_jobs_status_created_at", "status", "created_at"),
+        # admission control counts recently finished jobs
+        Index("ix_story_jobs_completed_at", "completed_at"),
+        # the warm pool ranks themes requested over a recent window
+        Index("ix_story_jobs_created_at", "created_at"),
+        # a session's jobs, newest first, see GET /jobs
+        Index("ix_story_jobs_session_created_at_id", "session_id", "created_at", "id"),
+    )
+
     id = Column(Integer, primary_key=True, index=True)
     # id that uses a long string value
     job_id = Column(String, index=True, unique=True)
     # id of the user who created this job
     session_id = Column(String, index=True)
     theme = Column(String)
+    # provider name or model the story should preferably be generated with
+    model = Column(String, nullable=True)
     status = Column(String)
     story_id = Column(Integer, nullable=True)
     error = Column(String, nullable=True)
     # timestamp when job was created
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     completed_at = Column(DateTime(timezone=True), nullable=True)
+    # worker currently holding the job
+    worker_id = Column(String, nullable=True)
+    # the job goes back to the queue if the worker does not renew it before this
+    lease_expires_at = Column(DateTime(timezone=True), nullable=True)
+    # how many times a worker has claimed this job
+    attempts = Column(Integer, default=0)
+    # timestamp when a worker last picked the job up
+    started_at = Column(DateTime(timezone=True), nullable=True)
+    # LLM calls made for the last generation and why each one ended
+    llm_attempts = Column(Integer, nullable=True)
+    llm_attempt_log = Column(JSON, nullable=True)
+    # set for jobs created through POST /stories/batch
+    batch_id = Column(String, nullable=True, index=True)
@@ -1,5 +1,15 @@
 # SQLalchemy - ORM Object Relational Mapping
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, JSON
+from sqlalchemy import (
+    Column,
+    Integer,
+    String,
+    DateTime,
+    Boolean,
+    ForeignKey,
+    JSON,
+    LargeBinary,
+    Index,
+)
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 
@@ -9,6 +19,10 @@ from db.database import Base
 class Story(Base):
     # table name
     __tablename__ = "stories"
+    __table_args__ = (
+        # a session's stories, newest first, see GET /stories
+        Index("ix_stories_session_created_at_id", "session_id", "created_at", "id"),
+    )
 
     # primary key
     id = Column(Integer, primary_key=True, index=True)
@@ -18,6 +32,18 @@ class Story(Base):
     session_id = Column(String, index=True)
     # timestamp when story was created
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    # false while a streamed story is still being written
+    is_complete = Column(Boolean, default=True)
+    # set on stories pre-generated for the warm pool, unclaimed while session_id is null
+    pool_key = Column(String, nullable=True, index=True)
+    # computed once when the story is written, see core/story_analysis.py;
+    # null for stories written before, until manage.py backfill-stats
+    depth = Column(Integer, nullable=True)
+    node_count = Column(Integer, nullable=True)
+    ending_count = Column(Integer, nullable=True)
+    winning_ending_count = Column(Integer, nullable=True)
+    # nodes from the root to the nearest winning ending
+    shortest_winning_path = Column(Integer, nullable=True)
 
     # one to many relationship, a single story can have many stories. links to the story attibute in StoryNode
     nodes = relationship("StoryNode", back_populates="story")
@@ -38,6 +64,47 @@ class StoryNode(Base):
     # where to end story
     is_ending = Column(Boolean, default=False)
     is_winning_ending = Column(Boolean, default=False)
+    # same list as the story_options rows, kept while readers move over to them
     options = Column(JSON, default=list)
     # define relationship to story, makes it bi-directional you can access story.nodes and node.story
     story = relationship("Story", back_populates="nodes")
+
+
+# one row per option, an edge from the node showing it to the node it leads to
+class StoryOption(Base):
+    __tablename__ = "story_options"
+    __table_args__ = (
+        # a node's options in the order the player sees them
+        Index(
+            "ix_story_options_story_from_ordinal",
+            "story_id",
+            "from_node_id",
+            "ordinal",
+            unique=True,
+        ),
+    )
+
+    id = Column(Integer, primary_key=True)
+    story_id = Column(Integer, ForeignKey("stories.id"), nullable=False)
+    from_node_id = Column(Integer, ForeignKey("story_nodes.id"), nullable=False)
+    # position among the node's options, from 0
+    ordinal = Column(Integer, nullable=False)
+    text = Column(String)
+    # null when the option's node was never written
+    to_node_id = Column(
+        Integer, ForeignKey("story_nodes.id"), nullable=True, index=True
+    )
+
+
+# serialized CompleteStoryResponse, written once when the story is finished
+class StoryBlob(Base):
+    __tablename__ = "story_blobs"
+
+    story_id = Column(Integer, ForeignKey("stories.id"), primary_key=True)
+    # JSON body of /stories/{id}/complete, compressed when encoding is gzip
+    payload = Column(LargeBinary)
+    # gzip or identity
+    encoding = Column(String)
+    # hash of the uncompressed JSON
+    etag = Column(String)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -1,24 +1,129 @@
-from fastapi import APIRouter, Depends, HTTPException, Cookie
-from sqlalchemy.orm import Session
+import asyncio
 
-from db.database import get_db
+from typing import Optional
+
+from fastapi import APIRouter, Depends, HTTPException, Cookie, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.cache import app_cache, job_cache_key
+from core.config import settings
+from core.events import TERMINAL_STATUSES, job_events
+from core.pagination import InvalidCursor, keyset_page
+from db.database import get_async_db
 from models.job import StoryJob
-from schemas.job import StoryJobResponse
+from schemas.job import StoryJobListResponse, StoryJobResponse
 
 # create FastAPI router to group related endpoints
 router = APIRouter(prefix="/jobs", tags=["jobs"])
 
 
+# a session's jobs, newest first, one page at a time
+@router.get("", response_model=StoryJobListResponse)
+async def list_jobs(
+    # defaults to the caller's own session cookie
+    session: Optional[str] = Query(None),
+    cursor: Optional[str] = Query(None),
+    limit: int = Query(20, ge=1, le=100),
+    session_id: Optional[str] = Cookie(None),
+    db: AsyncSession = Depends(get_async_db),
+):
+    session = session or session_id
+    if not session:
+        return StoryJobListResponse(items=[])
+    # the attempt log can be large and isn't part of the summary
+    statement = select(
+        StoryJob.id,
+        StoryJob.job_id,
+        StoryJob.status,
+        StoryJob.theme,
+        StoryJob.model,
+        StoryJob.created_at,
+        StoryJob.story_id,
+        StoryJob.completed_at,
+        StoryJob.error,
+        StoryJob.llm_attempts,
+    ).where(StoryJob.session_id == session)
+    try:
+        rows, next_cursor = await keyset_page(db, statement, StoryJob, cursor, limit)
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return StoryJobListResponse(
+        items=[StoryJobResponse.model_validate(row) for row in rows],
+        next_cursor=next_cursor,
+    )
+
+
 # GET job status based on job ID
 # path parameter
 @router.get("/{job_id}", response_model=StoryJobResponse)
 # identify specific background job, injected via FastAPI dependency injection
-def get_job_status(job_id: str, db: Session = Depends(get_db)):
+async def get_job_status(job_id: str, db: AsyncSession = Depends(get_async_db)):
+    # finished jobs never change again, serve them without touching the database
+    cached = await app_cache.get(job_cache_key(job_id))
+    if cached is not None:
+        return Response(content=cached, media_type="application/json")
+
+    job = StoryJobResponse.model_validate(await _load_job(db, job_id))
+    if job.status in TERMINAL_STATUSES:
+        await app_cache.set(
+            job_cache_key(job_id),
+            job.model_dump_json().encode("utf-8"),
+            settings.RESPONSE_CACHE_TTL_SECONDS,
+        )
+    return job
+
+
+async def _load_job(db: AsyncSession, job_id: str) -> StoryJob:
     # query the StoryJob table
-    job = db.query(StoryJob).filter(StoryJob.job_id == job_id).first()
+    result = await db.execute(select(StoryJob).where(StoryJob.job_id == job_id))
+    job = result.scalars().first()
     # raise exception return 404
     if not job:
         raise HTTPException(status_code=404, detail="Job not found")
-
-    # returns the SQLAlchemy model instance
     return job
+
+
+# stream status transitions as Server-Sent Events instead of having the client poll
+@router.get("/{job_id}/events")
+async def stream_job_events(
+    job_id: str, request: Request, db: AsyncSession = Depends(get_async_db)
+):
+    current = StoryJobResponse.model_validate(await _load_job(db, job_id))
+    # the stream outlives this request's session
+    await db.close()
+
+    return StreamingResponse(
+        _job_event_stream(job_id, current, request),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def _job_event_stream(job_id: str, current: StoryJobResponse, request: Request):
+    # send the state the client starts from
+    yield _format_event(current)
+    if current.status in TERMINAL_STATUSES:
+        return
+
+    queue = job_events.subscribe(job_id, current)
+    try:
+        while not await request.is_disconnected():
+            try:
+                job = await asyncio.wait_for(
+                    queue.get(), settings.JOB_EVENTS_KEEPALIVE_SECONDS
+                )
+            except asyncio.TimeoutError:
+                # comment line keeps proxies from closing an idle stream
+                yield ": keepalive\n\n"
+                continue
+            yield _format_event(job)
+            if job.status in TERMINAL_STATUSES:
+                return
+    finally:
+        job_events.unsubscribe(job_id, queue)
+
+
+def _format_event(job: StoryJobResponse) -> str:
+    return f"event: status\ndata: {job.model_dump_json()}\n\n"
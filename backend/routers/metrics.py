@@ -0,0 +1,24 @@
+from fastapi import APIRouter, Depends, Response
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from core.metrics import jobs_by_status, registry
+from db.database import get_async_db
+from models.job import StoryJob
+
+# scraped by prometheus, served outside the API prefix
+router = APIRouter(tags=["metrics"])
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+@router.get("/metrics", include_in_schema=False)
+async def get_metrics(db: AsyncSession = Depends(get_async_db)):
+    # queue depth is read from the table, so it covers every api and worker process
+    result = await db.execute(
+        select(StoryJob.status, func.count()).group_by(StoryJob.status)
+    )
+    counts = dict(result.all())
+    for status in ("pending", "processing", "completed", "failed"):
+        jobs_by_status.set(counts.get(status, 0), status=status)
+    return Response(content=registry.render(), media_type=PROMETHEUS_CONTENT_TYPE)
@@ -0,0 +1,19 @@
+from fastapi import APIRouter
+
+from core.cache import app_cache
+from db.database import database_pool_stats
+
+# operational counters of this API process
+router = APIRouter(prefix="/stats", tags=["stats"])
+
+
+# hit ratio, evictions and memory use of the response cache
+@router.get("/cache")
+def get_response_cache_stats():
+    return app_cache.stats()
+
+
+# connections in use and checkout wait times of the database pools
+@router.get("/pool")
+def get_pool_stats():
+    return database_pool_stats()
@@ -5,31 +5,46 @@ import uuid
 # allows value o be none
 from typing import Optional
 
-# track timestamps
-from datetime import datetime
-
-# FastAPI endpoints, get dependencies, handle cookies, background tasks
-from fastapi import APIRouter, Depends, HTTPException, Cookie, Response, BackgroundTasks
+# FastAPI endpoints, get dependencies, handle cookies
+from fastapi import APIRouter, Depends, HTTPException, Cookie, Header, Response
+from fastapi import Query, Request
 
 # session to interact with the database
-from sqlalchemy.orm import Session
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
 
-from db.database import get_db, SessionLocal
-from models.story import Story, StoryNode
-from models.job import StoryJob
+from db.database import get_async_db
+from models.story import Story, StoryBlob, StoryNode
 
 # what the API expects or returns
 from schemas.story import (
     CompleteStoryResponse,
     CompleteStoryNodeResponse,
     CreateStoryRequest,
+    PartialStoryResponse,
+    StoryGraphResponse,
+    StoryListResponse,
+    StoryNodeDetailResponse,
+    StoryOptionsSchema,
 )
-from schemas.job import StoryJobResponse
-from core.story_generator import StoryGenerator
+from schemas.job import StoryBatchRequest, StoryBatchResponse, StoryJobResponse
+from core.job_queue import JobQueue
+from core.admission import AdmissionRejected, admission
+from core.story_cache import StoryCache
+from core.story_analysis import STORY_STATS_FIELDS
+from core.story_graph import StoryGraph
+from core.warm_pool import WarmPool
+from core.story_blob import StoryBlobs, json_etag, story_response_from_nodes
+from core.cache import app_cache, pack_story_blob, story_cache_key, unpack_story_blob
+from core.config import settings
+from core.pagination import InvalidCursor, keyset_page
 
 # endpoint backend URL/api/stories/endpoint
 router = APIRouter(prefix="/stories", tags=["stories"])
 
+# finished stories never change, so their responses can be cached for good
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
 
 # get session id and identify browser
 def get_session_id(session_id: Optional[str] = Cookie(None)):
@@ -40,131 +55,399 @@ def get_session_id(session_id: Optional[str] = Cookie(None)):
     return session_id
 
 
+# a session's stories, newest first, one page at a time
+@router.get("", response_model=StoryListResponse)
+async def list_stories(
+    # defaults to the caller's own session cookie
+    session: Optional[str] = Query(None),
+    cursor: Optional[str] = Query(None),
+    limit: int = Query(20, ge=1, le=100),
+    session_id: Optional[str] = Cookie(None),
+    db: AsyncSession = Depends(get_async_db),
+):
+    session = session or session_id
+    if not session:
+        return StoryListResponse(items=[])
+    # summary columns only, nodes are never loaded
+    statement = select(
+        Story.id,
+        Story.title,
+        Story.created_at,
+        Story.is_complete,
+        *(getattr(Story, field) for field in STORY_STATS_FIELDS),
+    ).where(Story.session_id == session)
+    try:
+        rows, next_cursor = await keyset_page(db, statement, Story, cursor, limit)
+    except InvalidCursor as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return StoryListResponse(items=rows, next_cursor=next_cursor)
+
+
 # define post endpoint at /stories/create
 @router.post("/create", response_model=StoryJobResponse)
-def create_story(
+async def create_story(
     # JSON body sent by the client to create a story
     request: CreateStoryRequest,
-    # run long tasks async without blocking the response
-    background_tasks: BackgroundTasks,
     # allows modifying headers, cookies
     response: Response,
     # calles you get_session_id function automatically
     session_id: str = Depends(get_session_id),
     # provides database session
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ):
     # sends a cookie to the clients browser
     response.set_cookie(key="session_id", value=session_id, httponly=True)
 
-    # create unique id for this story job
-    job_id = str(uuid.uuid4())
+    # an invalid request must not use up one of the session's tokens
+    _check_model_hint(request.model)
 
-    # create new instance
-    job = StoryJob(
-        job_id=job_id, session_id=session_id, theme=request.theme, status="pending"
-    )
-    # stage job
-    db.add(job)
-    # save into the database
-    db.commit()
-
-    # add background task and start running generate_story_task function
-    background_tasks.add_task(
-        generate_story_task, job_id=job_id, theme=request.theme, session_id=session_id
-    )
+    # reject quickly when overloaded instead of queueing for minutes
+    try:
+        await admission.admit(db, session_id)
+    except AdmissionRejected as e:
+        raise HTTPException(
+            status_code=429,
+            detail=e.detail,
+            headers={"Retry-After": str(e.retry_after)},
+        )
+
+    # popular themes may already have a pre-generated story waiting, made with
+    # the default providers
+    if settings.WARM_POOL_ENABLED and request.model is None:
+        story = await WarmPool.claim(db, request.theme, session_id)
+        if story is not None:
+            return await JobQueue.create_completed(
+                db, session_id, request.theme, story.id
+            )
+
+    # save a pending job, a worker process generates the story (see worker.py)
+    job = await JobQueue.enqueue(db, session_id, request.theme, request.model)
 
     return job
 
 
-# define background task style
-def generate_story_task(job_id: str, theme: str, session_id: str):
-    # make a new session
-    db = SessionLocal()
+# queue many themes at once, e.g. to seed content
+@router.post("/batch", response_model=StoryBatchResponse)
+async def create_story_batch(
+    request: StoryBatchRequest,
+    response: Response,
+    session_id: str = Depends(get_session_id),
+    db: AsyncSession = Depends(get_async_db),
+):
+    response.set_cookie(key="session_id", value=session_id, httponly=True)
+
+    themes = [theme.strip() for theme in request.themes if theme.strip()]
+    if not themes:
+        raise HTTPException(status_code=422, detail="At least one theme is required")
+    if len(themes) > settings.STORY_BATCH_MAX_THEMES:
+        raise HTTPException(
+            status_code=422,
+            detail=f"A batch can have at most {settings.STORY_BATCH_MAX_THEMES} themes",
+        )
+    # every theme takes a token, more than the bucket holds would never get in
+    burst = settings.SESSION_RATE_LIMIT_BURST
+    if settings.SESSION_RATE_LIMIT_PER_MINUTE > 0 and len(themes) > burst:
+        raise HTTPException(
+            status_code=422,
+            detail=f"A batch can have at most {burst} themes per session burst",
+        )
+    _check_model_hint(request.model)
 
-    # get job from database
     try:
-        # grab first entry from database
-        job = db.query(StoryJob).filter(StoryJob.job_id == job_id).first()
-
-        # if no job exist exit quietly
-        if not job:
-            return
-
-        try:
-            # updates job status
-            job.status = "processing"
-            # commit change
-            db.commit()
-
-            story = StoryGenerator.generate_story(
-                db, session_id, theme
-            )  # todo: generate story
-
-            # hardcoded placeholder, mark job as completed
-            job.story_id = story.id
-            job.status = "completed"
-            job.completed_at = datetime.now()
-            db.commit()
-        # mark job as failed
-        except Exception as e:
-            job.status = "failed"
-            job.completed_at = datetime.now()
-            job.error = str(e)
-            db.commit()
-    # close database session
-    finally:
-        db.close()
+        await admission.admit(db, session_id, jobs=len(themes), batch=True)
+    except AdmissionRejected as e:
+        raise HTTPException(
+            status_code=429,
+            detail=e.detail,
+            headers={"Retry-After": str(e.retry_after)},
+        )
+
+    # workers generate at most this many of the batch's stories at a time
+    max_concurrency = min(
+        request.max_concurrency or settings.STORY_BATCH_MAX_CONCURRENCY,
+        settings.STORY_BATCH_MAX_CONCURRENCY,
+    )
+    batch = await JobQueue.enqueue_batch(
+        db, session_id, themes, max(max_concurrency, 1), request.model
+    )
+    return await _batch_response(db, batch.batch_id)
+
+
+# aggregate progress of a batch
+@router.get("/batch/{batch_id}", response_model=StoryBatchResponse)
+async def get_story_batch(batch_id: str, db: AsyncSession = Depends(get_async_db)):
+    return await _batch_response(db, batch_id)
+
+
+# a model hint has to name one of the configured providers or their models
+def _check_model_hint(model: Optional[str]) -> None:
+    if model is None:
+        return
+    known = settings.llm_providers()
+    if not any(model in (provider["name"], provider["model"]) for provider in known):
+        raise HTTPException(status_code=422, detail=f"Unknown model: {model}")
+
+
+async def _batch_response(db: AsyncSession, batch_id: str) -> StoryBatchResponse:
+    status = await JobQueue.batch_status(db, batch_id)
+    if status is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    batch, counts, jobs = status
+    finished = counts["completed"] + counts["failed"]
+    return StoryBatchResponse(
+        batch_id=batch.batch_id,
+        total=batch.total,
+        max_concurrency=batch.max_concurrency,
+        created_at=batch.created_at,
+        counts=counts,
+        progress=finished / batch.total if batch.total else 1.0,
+        done=finished == batch.total,
+        jobs=[StoryJobResponse.model_validate(job) for job in jobs],
+    )
+
+
+# hit and miss counters of the generation cache
+@router.get("/cache/stats")
+async def get_cache_stats(db: AsyncSession = Depends(get_async_db)):
+    return await StoryCache.stats(db)
 
 
 # get story when it is finish
 # registers a GET end point, story id taken from the path,
 # FastAPI will serialize and validate he returned data against this Pydantic model.
 @router.get("/{story_id}/complete", response_model=CompleteStoryResponse)
-def get_complete_story(story_id: int, db: Session = Depends(get_db)):
+async def get_complete_story(
+    story_id: int, request: Request, db: AsyncSession = Depends(get_async_db)
+):
+    # stored JSON is sent as-is, without loading nodes or building models
+    cached = await app_cache.get(story_cache_key(story_id))
+    if cached is not None:
+        return _blob_response(*unpack_story_blob(cached), request)
+
+    blob = await db.get(StoryBlob, story_id)
+    if blob is not None:
+        await app_cache.set(
+            story_cache_key(story_id),
+            pack_story_blob(blob.etag, blob.encoding, blob.payload),
+            settings.RESPONSE_CACHE_TTL_SECONDS,
+        )
+        return _blob_response(blob.etag, blob.encoding, blob.payload, request)
+
     # Queries the Story table, filters by primary key(id)
-    story = db.query(Story).filter(Story.id == story_id).first()
+    story = await db.get(Story, story_id)
     # return 404 Not Found response, stops execution
     if not story:
         raise HTTPException(status_code=404, detail="Story not found")
+    # streamed stories are served from /partial until they are finished
+    if story.is_complete is False:
+        raise HTTPException(status_code=409, detail="Story is still being generated")
 
-    complete_story = build_complete_story_tree(db, story)
+    complete_story = await build_complete_story_tree(db, story)
     # returns SQLAlchemy Story object
     return complete_story
 
 
-def build_complete_story_tree(db: Session, story: Story) -> CompleteStoryResponse:
+# nodes written so far for a story that may still be generating
+@router.get("/{story_id}/partial", response_model=PartialStoryResponse)
+async def get_partial_story(story_id: int, db: AsyncSession = Depends(get_async_db)):
+    story = await db.get(Story, story_id)
+    if not story:
+        raise HTTPException(status_code=404, detail="Story not found")
+
+    partial_story = await build_complete_story_tree(db, story)
+    return PartialStoryResponse(
+        **partial_story.model_dump(), is_complete=story.is_complete is not False
+    )
+
+
+# depth, endings and winning paths of a finished story
+@router.get("/{story_id}/graph", response_model=StoryGraphResponse)
+async def get_story_graph(
+    story_id: int,
+    max_paths: int = Query(20, ge=1, le=100),
+    db: AsyncSession = Depends(get_async_db),
+):
+    story = await db.get(Story, story_id)
+    if not story:
+        raise HTTPException(status_code=404, detail="Story not found")
+    if story.is_complete is False:
+        raise HTTPException(status_code=409, detail="Story is still being generated")
+    if not await StoryGraph.has_edges(db, story_id):
+        # older stories, see python manage.py backfill-options
+        raise HTTPException(
+            status_code=409, detail="Story options have not been migrated yet"
+        )
+
+    node_count = await db.scalar(
+        select(func.count())
+        .select_from(StoryNode)
+        .where(StoryNode.story_id == story_id)
+    )
+    stats = await StoryGraph.astats(db, story_id, max_paths)
+    return StoryGraphResponse(story_id=story_id, node_count=node_count, **stats)
+
+
+# one node at a time for players, prefetch adds the nodes its options lead to
+@router.get("/{story_id}/nodes/root", response_model=StoryNodeDetailResponse)
+async def get_root_node(
+    story_id: int,
+    prefetch: bool = False,
+    if_none_match: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_async_db),
+):
+    return await _node_detail_response(
+        db, story_id, prefetch, if_none_match, StoryNode.is_root.is_(True)
+    )
+
+
+@router.get("/{story_id}/nodes/{node_id}", response_model=StoryNodeDetailResponse)
+async def get_story_node(
+    story_id: int,
+    node_id: int,
+    prefetch: bool = False,
+    if_none_match: Optional[str] = Header(None),
+    db: AsyncSession = Depends(get_async_db),
+):
+    return await _node_detail_response(
+        db, story_id, prefetch, if_none_match, StoryNode.id == node_id
+    )
+
+
+async def _node_detail_response(
+    db: AsyncSession,
+    story_id: int,
+    prefetch: bool,
+    if_none_match: Optional[str],
+    node_filter,
+) -> Response:
+    result = await db.execute(
+        select(StoryNode, Story.is_complete)
+        .join(Story, Story.id == StoryNode.story_id)
+        .where(StoryNode.story_id == story_id, node_filter)
+    )
+    row = result.first()
+    if not row:
+        raise HTTPException(status_code=404, detail="Story node not found")
+    node, is_complete = row
+    node_response = CompleteStoryNodeResponse.model_validate(node)
+
+    # options and prefetched children in one query when the node has edges,
+    # endings never have options
+    edges = None
+    if not node.is_ending:
+        edges = await StoryGraph.anode_options(db, story_id, node.id, prefetch)
+    if edges is not None:
+        options, child_nodes = edges
+        node_response.options = [StoryOptionsSchema(**option) for option in options]
+    elif prefetch and node.options:
+        child_ids = [option["node_id"] for option in node.options]
+        result = await db.execute(
+            select(StoryNode).where(
+                StoryNode.story_id == story_id, StoryNode.id.in_(child_ids)
+            )
+        )
+        child_nodes = result.scalars().all()
+    else:
+        child_nodes = []
+    children = {
+        child.id: CompleteStoryNodeResponse.model_validate(child)
+        for child in child_nodes
+    }
+
+    body = StoryNodeDetailResponse(
+        story_id=story_id,
+        node=node_response,
+        children=children,
+    ).model_dump_json()
+
+    # a streamed story is still changing, do not let anyone cache it yet
+    if is_complete is False:
+        return Response(
+            content=body,
+            media_type="application/json",
+            headers={"Cache-Control": "no-store"},
+        )
+
+    # strong etag, the bytes of a finished story never change
+    headers = {
+        "ETag": json_etag(body.encode("utf-8")),
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL,
+    }
+    if if_none_match and _etag_matches(if_none_match, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+# raw bytes of a stored story, gzip is passed through when the client accepts it
+def _blob_response(
+    etag: str, encoding: str, payload: bytes, request: Request
+) -> Response:
+    send_gzip = encoding == "gzip" and _accepts_gzip(
+        request.headers.get("accept-encoding", "")
+    )
+    headers = {
+        # a strong etag names one representation, so the gzip bytes get their own
+        "ETag": f'{etag[:-1]}-gzip"' if send_gzip else etag,
+        "Cache-Control": IMMUTABLE_CACHE_CONTROL,
+        "Vary": "Accept-Encoding",
+    }
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match and _etag_matches(if_none_match, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+
+    if send_gzip:
+        headers["Content-Encoding"] = "gzip"
+        content = payload
+    else:
+        content = StoryBlobs.decoded_payload(encoding, payload)
+    return Response(content=content, media_type="application/json", headers=headers)
+
+
+# Accept-Encoding with q-values: gzip;q=0 refuses gzip, a * covers it unless gzip
+# is listed on its own
+def _accepts_gzip(accept_encoding: str) -> bool:
+    qualities = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.partition(";")
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for param in params.split(";"):
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding] = quality
+    for coding in ("gzip", "x-gzip", "*"):
+        if coding in qualities:
+            return qualities[coding] > 0
+    return False
+
+
+# If-None-Match may hold several etags, or * for any
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or etag in candidates
+
+
+async def build_complete_story_tree(
+    db: AsyncSession, story: Story
+) -> CompleteStoryResponse:
     # get all nodes for a story from the database
     # query the database table/model
     # select only nodes belonging to the current story
     # return all matching nodes
-    nodes = db.query(StoryNode).filter(StoryNode.story_id == story.id).all()
-
-    # for every node in nodes create a response object
-    # store it in node_dict using the nodes id as the key
-    node_dict = {}
-    for node in nodes:
-        node_response = CompleteStoryNodeResponse(
-            id=node.id,
-            content=node.content,
-            is_ending=node.is_ending,
-            is_winning_ending=node.is_winning_ending,
-            options=node.options,
-        )
-        node_dict[node.id] = node_response
+    result = await db.execute(select(StoryNode).where(StoryNode.story_id == story.id))
+    nodes = result.scalars().all()
+    # stories written before the edge table only have the JSON column
+    options = await StoryGraph.aload_options(db, story.id)
 
-    # search for node that is the root node
-    root_node = next((node for node in nodes if node.is_root), None)
+    complete_story = story_response_from_nodes(story, nodes, options)
     # if no root node is found
-    if not root_node:
+    if complete_story is None:
         raise HTTPException(status_code=500, detail="Story root node not found")
 
-    # return the complete story response
-    return CompleteStoryResponse(
-        id=story.id,
-        title=story.title,
-        session_id=story.session_id,
-        created_at=story.created_at,
-        root_node=node_dict[root_node.id],
-        all_nodes=node_dict,
-    )
+    return complete_story
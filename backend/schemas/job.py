@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Dict, List, Optional
 from datetime import datetime
 from pydantic import BaseModel
 
@@ -13,6 +13,9 @@ class StoryJobResponse(BaseModel):
     job_id: str
     # job lifecycle state
     status: str
+    theme: Optional[str] = None
+    # preferred provider name or model, null for the default
+    model: Optional[str] = None
     # job was created
     created_at: datetime
     # set when job completes successfully
@@ -21,6 +24,8 @@ class StoryJobResponse(BaseModel):
     completed_at: Optional[datetime] = None
     # error message if the job fails
     error: Optional[str] = None
+    # LLM calls the generation needed, retries included
+    llm_attempts: Optional[int] = None
 
     class Config:
         from_attributes = True
@@ -28,3 +33,32 @@ class StoryJobResponse(BaseModel):
 
 class StoryJobCreate(StoryJobBase):
     pass
+
+
+# one page of a session's jobs, pass next_cursor back as cursor for the next
+class StoryJobListResponse(BaseModel):
+    items: List[StoryJobResponse]
+    next_cursor: Optional[str] = None
+
+
+# themes to generate in one request
+class StoryBatchRequest(BaseModel):
+    themes: List[str]
+    # jobs of the batch generated at once, capped by STORY_BATCH_MAX_CONCURRENCY
+    max_concurrency: Optional[int] = None
+    # preferred provider name or model for every story of the batch
+    model: Optional[str] = None
+
+
+# aggregate progress of a batch
+class StoryBatchResponse(BaseModel):
+    batch_id: str
+    total: int
+    max_concurrency: int
+    created_at: datetime
+    # job count per status: pending, processing, completed, failed
+    counts: Dict[str, int]
+    # finished jobs, completed or failed, out of total
+    progress: float
+    done: bool
+    jobs: List[StoryJobResponse] = []
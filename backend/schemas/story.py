@@ -35,8 +35,19 @@ class CompleteStoryNodeResponse(StoryNodeBase):
         from_attributes = True
 
 
+# precomputed shape of a story, null for stories written before stats existed
+class StoryStats(BaseModel):
+    # levels including the root
+    depth: Optional[int] = None
+    node_count: Optional[int] = None
+    ending_count: Optional[int] = None
+    winning_ending_count: Optional[int] = None
+    # nodes from the root to the nearest winning ending
+    shortest_winning_path: Optional[int] = None
+
+
 # represents shared fields for a story
-class StoryBase(BaseModel):
+class StoryBase(StoryStats):
     # stories title
     title: str
     # associate story with user session
@@ -50,6 +61,9 @@ class StoryBase(BaseModel):
 # represents the request body when creating a story
 class CreateStoryRequest(BaseModel):
     theme: str
+    # preferred provider name or model from LLM_PROVIDERS, others take over when
+    # it is degraded
+    model: Optional[str] = None
 
 
 # full story returned by the API
@@ -66,3 +80,50 @@ class CompleteStoryResponse(StoryBase):
     # create model from ORM object
     class Config:
         from_attributes = True
+
+
+# story that may still be streaming in, only nodes written so far are included
+class PartialStoryResponse(CompleteStoryResponse):
+    # false while the LLM is still writing the story
+    is_complete: bool
+
+
+# a single node of a story, optionally with the nodes its options lead to
+class StoryNodeDetailResponse(BaseModel):
+    story_id: int
+    node: CompleteStoryNodeResponse
+    # nodes one choice away, only filled in when prefetch is requested
+    children: Dict[int, CompleteStoryNodeResponse] = {}
+
+
+# a story in a listing, without its nodes
+class StorySummaryResponse(StoryStats):
+    id: int
+    title: str
+    created_at: datetime
+    # null for stories written before streaming existed, which are complete
+    is_complete: Optional[bool] = True
+
+    class Config:
+        from_attributes = True
+
+
+# one page of a session's stories, pass next_cursor back as cursor for the next
+class StoryListResponse(BaseModel):
+    items: List[StorySummaryResponse]
+    next_cursor: Optional[str] = None
+
+
+# shape of a story's graph, computed in the database from story_options
+class StoryGraphResponse(BaseModel):
+    story_id: int
+    node_count: int
+    reachable_nodes: int
+    # levels from the root to the deepest node, the root alone is 1
+    depth: int
+    endings: int
+    winning_endings: int
+    # node ids from the root to each winning ending, shortest first
+    winning_paths: List[List[int]]
+    # nodes no option leads to, empty for a well formed story
+    unreachable_node_ids: List[int]
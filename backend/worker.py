@@ -0,0 +1,46 @@
+# entry point for story generation workers, run separately from the API
+import argparse
+import asyncio
+import logging
+import signal
+
+from core.config import settings
+from core.metrics import serve_metrics
+from core.worker import Worker
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a story generation worker")
+    parser.add_argument(
+        "--concurrency", type=int, default=None, help="jobs to generate at once"
+    )
+    parser.add_argument(
+        "--poll-interval", type=float, default=None, help="seconds between queue polls"
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s %(message)s"
+    )
+    worker = Worker(concurrency=args.concurrency, poll_interval=args.poll_interval)
+    asyncio.run(run_worker(worker))
+
+
+async def run_worker(worker: Worker):
+    # finish in-flight jobs on shutdown instead of abandoning their leases
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, worker.stop)
+
+    metrics_server = None
+    if settings.METRICS_ENABLED and settings.WORKER_METRICS_PORT:
+        metrics_server = await serve_metrics(settings.WORKER_METRICS_PORT)
+    try:
+        await worker.arun()
+    finally:
+        if metrics_server is not None:
+            metrics_server.close()
+
+
+if __name__ == "__main__":
+    main()
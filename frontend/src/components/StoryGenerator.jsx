@@ -13,21 +13,37 @@ function StoryGenerator() {
   const [error, setError] = useState(null);
   const [loading, setLoading] = useState(false);
 
+  const waitingForJob = ["pending", "processing"].includes(jobStatus);
+
   useEffect(() => {
+    if (!jobId || !waitingForJob) {
+      return;
+    }
+
     let pollInterval;
+    // the server pushes status changes, polling is only the fallback
+    const events = new EventSource(`${API_BASE_URL}/jobs/${jobId}/events`);
 
-    if (jobId && jobStatus === "processing") {
-      pollInterval = setInterval(() => {
-        pollJobStatus(jobId);
-      }, 5000);
-    }
+    events.addEventListener("status", (event) => {
+      handleJobStatus(JSON.parse(event.data));
+    });
+
+    events.onerror = () => {
+      events.close();
+      if (!pollInterval) {
+        pollInterval = setInterval(() => {
+          pollJobStatus(jobId);
+        }, 5000);
+      }
+    };
 
     return () => {
+      events.close();
       if (pollInterval) {
         clearInterval(pollInterval);
       }
     };
-  }, [jobId, jobStatus]);
+  }, [jobId, waitingForJob]);
 
   const generateStory = async (theme) => {
     setLoading(true);
@@ -38,29 +54,30 @@ function StoryGenerator() {
       const response = await axios.post(`${API_BASE_URL}/stories/create`, {
         theme,
       });
-      const { job_id, status } = response.data;
-      setJobId(job_id);
-      setJobStatus(status);
-
-      pollJobStatus(job_id);
+      setJobId(response.data.job_id);
+      // a warm pool hit comes back completed, there are no status events to wait for
+      handleJobStatus(response.data);
     } catch (e) {
       setLoading(false);
       setError(`Failed to generate story: ${e.message}`);
     }
   };
 
+  const handleJobStatus = ({ status, story_id, error: jobError }) => {
+    setJobStatus(status);
+
+    if (status === "completed" && story_id) {
+      fetchStory(story_id);
+    } else if (status === "failed" || jobError) {
+      setError(jobError || "Failed to generate story");
+      setLoading(false);
+    }
+  };
+
   const pollJobStatus = async (id) => {
     try {
       const response = await axios.get(`${API_BASE_URL}/jobs/${id}`);
-      const { status, story_id, error: jobError } = response.data;
-      setJobStatus(status);
-
-      if (status === "completed" && story_id) {
-        fetchStory(story_id);
-      } else if (status === "failed" || jobError) {
-        setError(jobError || "Failed to generate story");
-        setLoading(false);
-      }
+      handleJobStatus(response.data);
     } catch (e) {
       if (e.response?.status != 404) {
         setError(`Failed to check story status: ${e.message}`);